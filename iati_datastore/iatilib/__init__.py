@@ -1,8 +1,89 @@
-from flask_sqlalchemy import SQLAlchemy
+import logging
+import time
+
+from flask import has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from flask_rq2 import RQ
 from flask_migrate import Migrate
+from sqlalchemy import exc, orm
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.sql.expression import UpdateBase
+
+
+class ReplicaSession(SignallingSession):
+    """Reads from SQLALCHEMY_BINDS['replica'] during read-only requests
+
+    Requests to the blueprints in REPLICA_BLUEPRINTS run their queries
+    on the replica, when one is configured. Flushes, bulk updates and
+    deletes, and everything outside those requests use the primary.
+
+    The replica is checked once per request. When it can't be connected
+    to, requests read from the primary and it isn't tried again for
+    REPLICA_RETRY_INTERVAL seconds.
+    """
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is not None:
+            # SignallingSession.get_bind takes no keyword arguments, so an
+            # explicit bind goes straight to SQLAlchemy's
+            return orm.Session.get_bind(
+                self, mapper, clause, bind=bind, **kwargs)
+        if (self.reads_from_replica() and not self._flushing
+                and not isinstance(clause, UpdateBase)):
+            replica = self.replica()
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper, clause)
+
+    def reads_from_replica(self):
+        config = self.app.config
+        return (
+            'replica' in (config['SQLALCHEMY_BINDS'] or ())
+            and has_request_context()
+            and request.blueprint in config.get('REPLICA_BLUEPRINTS', ())
+        )
+
+    def replica(self):
+        """The replica's engine, or None if it is down"""
+        if 'iatilib.replica' not in request.environ:
+            request.environ['iatilib.replica'] = self.probe_replica()
+        return request.environ['iatilib.replica']
+
+    def probe_replica(self):
+        engine = db.get_engine(self.app, bind='replica')
+        if _replica_down_until.get(engine.url, 0) > time.monotonic():
+            return None
+        try:
+            engine.connect().close()
+        except exc.DBAPIError:
+            logging.getLogger(__name__).warning(
+                "Replica unavailable, reading from the primary",
+                exc_info=True)
+            _replica_down_until[engine.url] = (
+                time.monotonic() + self.app.config['REPLICA_RETRY_INTERVAL'])
+            return None
+        _replica_down_until.pop(engine.url, None)
+        return engine
+
+
+# When each replica that failed to connect is next tried, by URL
+_replica_down_until = {}
+
+
+class DataStoreSQLAlchemy(SQLAlchemy):
+    def apply_driver_hacks(self, app, sa_url, options):
+        rv = super().apply_driver_hacks(app, sa_url, options)
+        replica = (app.config['SQLALCHEMY_BINDS'] or {}).get('replica')
+        if replica and sa_url == make_url(replica):
+            # Don't hold a request up for long while the replica is down
+            options.setdefault('connect_args', {}).setdefault(
+                'connect_timeout', app.config['REPLICA_CONNECT_TIMEOUT'])
+        return rv
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=ReplicaSession, db=self, **options)
+
 
-db = SQLAlchemy()
+db = DataStoreSQLAlchemy()
 rq = RQ()
 migrate = Migrate()
 
@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 
 class Config:
@@ -9,8 +10,82 @@ class Config:
     # Handle database disconnect error
     # https://stackoverflow.com/questions/55457069/how-to-fix-operationalerror-psycopg2-operationalerror-server-closed-the-conn
     SQLALCHEMY_ENGINE_OPTIONS = {"pool_pre_ping": True}
+    # A read-only copy of the database for the API to read from. Without
+    # one, the API reads from SQLALCHEMY_DATABASE_URI like everything else.
+    SQLALCHEMY_BINDS = {}
+    if os.environ.get('IATI_DATASTORE_REPLICA_DATABASE_URL'):
+        SQLALCHEMY_BINDS['replica'] = os.environ[
+            'IATI_DATASTORE_REPLICA_DATABASE_URL']
+    REPLICA_BLUEPRINTS = ('api1',)
+    # Seconds to wait when connecting to the replica, and to read from the
+    # primary before trying it again once it couldn't be connected to
+    REPLICA_CONNECT_TIMEOUT = int(os.environ.get(
+        'IATI_DATASTORE_REPLICA_CONNECT_TIMEOUT', 5))
+    REPLICA_RETRY_INTERVAL = int(os.environ.get(
+        'IATI_DATASTORE_REPLICA_RETRY_INTERVAL', 30))
+    # Milliseconds each query behind an access API request may run for,
+    # and the largest planner cost it may have, by endpoint name with
+    # None for the rest. The timeout limits each fetch of a stream=True
+    # response, not the whole stream, so the cost limit is what turns
+    # away a runaway stream. Set the cost limit to inf to turn the check
+    # off. See iatilib/frontend/limits.py
+    STATEMENT_TIMEOUTS = {None: int(os.environ.get(
+        'IATI_DATASTORE_STATEMENT_TIMEOUT', 5 * 60 * 1000))}
+    QUERY_COST_LIMITS = {None: float(os.environ.get(
+        'IATI_DATASTORE_QUERY_COST_LIMIT', 5e7))}
     RQ_REDIS_URL = os.environ.get(
         'IATI_DATASTORE_REDIS_URL', 'redis://localhost:6379/0')
+    # Seconds a cached total-count is kept. A crawl changes the cache
+    # keys, so this only bounds how long stale counts take up space.
+    COUNT_CACHE_TIMEOUT = int(os.environ.get(
+        'IATI_DATASTORE_COUNT_CACHE_TIMEOUT', 24 * 60 * 60))
+    # Total bytes of API pages to cache before dropping the least
+    # recently used, and the largest page worth caching. 0 turns the
+    # response cache off.
+    RESPONSE_CACHE_MAX_BYTES = int(os.environ.get(
+        'IATI_DATASTORE_RESPONSE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+    RESPONSE_CACHE_MAX_ENTRY_BYTES = int(os.environ.get(
+        'IATI_DATASTORE_RESPONSE_CACHE_MAX_ENTRY_BYTES', 4 * 1024 * 1024))
+    # Seconds before the response cache rechecks the data version, so
+    # how long a crawl can take to show up in cached pages
+    RESPONSE_CACHE_VERSION_TIMEOUT = int(os.environ.get(
+        'IATI_DATASTORE_RESPONSE_CACHE_VERSION_TIMEOUT', 60))
+    # Seconds the figures behind /api/1/about/ are kept for between
+    # crawler commits. See iatilib/summary.py
+    ABOUT_CACHE_TIMEOUT = int(os.environ.get(
+        'IATI_DATASTORE_ABOUT_CACHE_TIMEOUT', 60))
+    # Compression level for each encoding of stream=True responses. See
+    # `iati benchmark-compression` for what each costs.
+    STREAM_COMPRESSION_LEVELS = {
+        'gzip': int(os.environ.get('IATI_DATASTORE_GZIP_LEVEL', 6)),
+        'br': int(os.environ.get('IATI_DATASTORE_BROTLI_QUALITY', 4)),
+    }
+    # Where export jobs write their files, which the web and worker
+    # processes both need to reach, the seconds a job may run for, the
+    # seconds its file is kept and the rq queue the jobs go on. See
+    # iatilib/frontend/exports.py
+    EXPORT_DIR = os.environ.get(
+        'IATI_DATASTORE_EXPORT_DIR',
+        os.path.join(tempfile.gettempdir(), 'iati-datastore-exports'))
+    EXPORT_JOB_TIMEOUT = int(os.environ.get(
+        'IATI_DATASTORE_EXPORT_JOB_TIMEOUT', 6 * 60 * 60))
+    EXPORT_MAX_AGE = int(os.environ.get(
+        'IATI_DATASTORE_EXPORT_MAX_AGE', 2 * 24 * 60 * 60))
+    EXPORT_QUEUE = os.environ.get('IATI_DATASTORE_EXPORT_QUEUE', 'exports')
+    # Where the bulk dumps are written after each crawl, which slices
+    # besides 'all' are dumped, the seconds writing them may take, the
+    # queue they are written from and the seconds between checks for
+    # the end of a crawl. See iatilib/frontend/dumps.py
+    DUMP_DIR = os.environ.get(
+        'IATI_DATASTORE_DUMP_DIR',
+        os.path.join(tempfile.gettempdir(), 'iati-datastore-dumps'))
+    DUMP_SLICES = os.environ.get(
+        'IATI_DATASTORE_DUMP_SLICES', 'publisher recipient-country').split()
+    DUMP_JOB_TIMEOUT = int(os.environ.get(
+        'IATI_DATASTORE_DUMP_JOB_TIMEOUT', 24 * 60 * 60))
+    DUMP_QUEUE = os.environ.get('IATI_DATASTORE_DUMP_QUEUE', 'dumps')
+    DUMP_RETRY_INTERVAL = int(os.environ.get(
+        'IATI_DATASTORE_DUMP_RETRY_INTERVAL', 5 * 60))
 
 # Due to a nasty OSX bug, we have to prevent checking system for proxies...
 # https://wefearchange.org/2018/11/forkmacos.rst.html
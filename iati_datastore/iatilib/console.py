@@ -6,6 +6,7 @@ import datetime as dt
 import subprocess
 
 import click
+from flask import current_app
 from flask.cli import FlaskGroup, with_appcontext
 import requests
 from sqlalchemy import not_
@@ -13,6 +14,7 @@ import sentry_sdk
 
 from iatilib import parse, codelists, db
 from iatilib.model import Log
+from iatilib.frontend import compression, dumps, exports
 from iatilib.frontend.app import create_app
 
 
@@ -55,13 +57,21 @@ def download_codelists():
 @cli.command()
 @with_appcontext
 def cleanup():
-    """Delete old log messages."""
+    """Delete old log messages and export files."""
     db.session.query(Log).filter(
             Log.created_at < dt.datetime.utcnow() - dt.timedelta(days=5)
     ).filter(not_(Log.logger.in_(
             ['activity_importer', 'failed_activity', 'xml_parser']),
     )).delete('fetch')
     db.session.commit()
+    exports.remove_old_exports()
+
+
+@cli.command('update-dumps')
+@with_appcontext
+def update_dumps():
+    """Write the bulk dumps of the slices that changed since last time."""
+    print("Updated the dumps of {0} slices".format(dumps.update_slices()))
 
 
 @cli.command()
@@ -110,6 +120,42 @@ def parse_file(filenames, verbose=False, fail_xml=False, fail_spec=False):
                 raise
 
 
+@click.option(
+        '--url', default='/api/1/access/transaction.csv?stream=True',
+        help="Access API URL to fetch and compress")
+@click.option(
+        '--max-mb', default=64.0, type=float,
+        help="Megabytes of the response to compress, as it is held in memory")
+@cli.command()
+@with_appcontext
+def benchmark_compression(url, max_mb):
+    """Compare the CPU cost of compressing a stream with the bytes saved."""
+    response = current_app.test_client().get(
+        url, headers={'Accept-Encoding': 'identity'})
+    chunks = []
+    size = 0
+    for chunk in response.iter_encoded():
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= max_mb * 1024 * 1024:
+            print("Compressing the first {0} bytes".format(size))
+            break
+    response.close()
+    levels = [('gzip', level) for level in (1, 6, 9)]
+    if compression.brotli is not None:
+        levels += [('br', quality) for quality in (1, 4, 11)]
+    results = compression.benchmark(chunks, levels)
+    total = results[0][2]
+    print("{0:<10}{1:>6}{2:>16}{3:>8}{4:>10}{5:>10}".format(
+        "encoding", "level", "bytes", "ratio", "cpu s", "MB/s"))
+    for encoding, level, size, seconds in results:
+        print("{0:<10}{1:>6}{2:>16}{3:>8.3f}{4:>10.2f}{5:>10}".format(
+            encoding, "" if level is None else level, size,
+            size / total if total else 1,
+            seconds,
+            "{0:.1f}".format(total / seconds / 1e6) if seconds else ""))
+
+
 @cli.command()
 @with_appcontext
 def drop_database():
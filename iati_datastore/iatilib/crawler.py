@@ -9,14 +9,19 @@ from dateutil.parser import parse as date_parser
 from flask import Blueprint
 import click
 
-from iatilib import db, parse, rq
-from iatilib.model import Dataset, Resource, Activity, Log, DeletedActivity
+from iatilib import db, parse, rq, summary
+from iatilib.model import (
+    Dataset, Resource, Activity, Log, DeletedActivity, DataVersion)
 from iatilib.loghandlers import DatasetMessage as _
 
 from iatilib.currency_conversion import download_imf_exchange_rates, update_exchange_rates
 
 log = logging.getLogger("crawler")
 
+# Label of the DataVersion row bumped whenever a crawl commits a change
+# to the activities, so that anything cached from them can tell
+CRAWL_VERSION = 'crawl'
+
 
 manager = Blueprint('crawler', __name__)
 manager.cli.short_help = "Crawl IATI registry"
@@ -75,12 +80,18 @@ def delete_dataset(dataset):
             deletion_date=now
         ))
     db.session.commit()
+    DataVersion.bump(CRAWL_VERSION)
     return deleted_dataset.delete(synchronize_session='fetch')
 
 
 def fetch_dataset_metadata(dataset):
     d = iatikit.data().datasets.get(dataset.name)
-    dataset.publisher = d.metadata['organization']['name']
+    publisher = d.metadata['organization']['name']
+    if publisher != dataset.publisher:
+        # Its activities' copies are updated as this is flushed, which
+        # changes what the publisher filter returns
+        dataset.publisher = publisher
+        DataVersion.bump(CRAWL_VERSION)
 
     dataset.last_modified = date_parser(
         d.metadata.get(
@@ -249,7 +260,9 @@ def update_activities(dataset_name, ignore_hashes=False):
                 Log.resource == dataset_name,
         )).delete(synchronize_session=False)
         parse_resource(resource)
+        DataVersion.bump(CRAWL_VERSION)
         db.session.commit()
+        summary.refresh()
     except parse.ParserError as exc:
         db.session.rollback()
         resource.last_parse_error = str(exc)
@@ -308,6 +321,7 @@ def update_dataset(dataset_name, ignore_hashes):
 
     resource = fetch_resource(dataset, ignore_hashes)
     db.session.commit()
+    summary.refresh()
 
     if resource.last_status_code == 200 and not resource.last_parsed:
         queue.enqueue(
@@ -453,6 +467,9 @@ def update_registry(ignore_hashes):
     print("Enqueuing %d datasets for update" % datasets.count())
     for dataset in datasets:
         queue.enqueue(update_dataset, args=(dataset.name, ignore_hashes), result_ttl=0)
+    # Imported here, as the frontend imports this module
+    from iatilib.frontend import dumps
+    dumps.enqueue()
 
 
 @click.option('--dataset', 'dataset', type=str,
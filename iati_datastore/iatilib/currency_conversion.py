@@ -1,11 +1,14 @@
 import requests
 import csv
-import datetime
+import time
+from io import StringIO
 
+import sqlalchemy as sa
 from sqlalchemy import union_all, case
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import aliased
 
-from iatilib.model import CurrencyConversion
+from iatilib.model import CurrencyConversion, DataVersion
 from iatilib import db
 from iatilib import codelists
 
@@ -14,6 +17,15 @@ EUR = codelists.by_major_version['2'].Currency.from_string("EUR")
 
 RATES_URL = "https://codeforiati.org/imf-exchangerates/imf_exchangerates.csv"
 
+# Label of the DataVersion row bumped whenever the rates table changes
+RATES_VERSION = 'currency_conversion'
+# Seconds between checks of the rates version, so that rates loaded by
+# another process are picked up without a query on every conversion
+VERSION_CHECK_INTERVAL = 60
+
+# Columns of the IMF rates CSV, in file order
+RATE_COLUMNS = ('date', 'rate', 'currency', 'frequency', 'source', 'country_code', 'country')
+
 def currency_conversion_cache(cache_key='default'):
     cache = {'date': [],
              'rate': [],
@@ -54,11 +66,17 @@ def download_imf_exchange_rates():
 
 def setup_cache():
     conversion_cache = None
+    rates_version = None
+    version_checked = None
 
     def get_rate(currency, date, cache_key='default'):
         """Get exchange rate from cached currency conversion  """
-        key = f'{cache_key}-{datetime.datetime.now().date()}'
-        nonlocal conversion_cache
+        nonlocal conversion_cache, rates_version, version_checked
+        now = time.monotonic()
+        if rates_version is None or now - version_checked >= VERSION_CHECK_INTERVAL:
+            rates_version = DataVersion.current(RATES_VERSION)
+            version_checked = now
+        key = f'{cache_key}-{rates_version}'
         if not conversion_cache or conversion_cache['cache_key'] != key:
             conversion_cache = currency_conversion_cache(cache_key=key)
         items = conversion_cache['data'][currency]
@@ -66,28 +84,59 @@ def setup_cache():
         return closest[1]
 
     def update_exchange_rates(data):
-        """Update currency conversion database table with new """
-        if db.session.query(CurrencyConversion).first():
-            last = db.session.query(CurrencyConversion).order_by(CurrencyConversion.date.desc()).first()
-            last_date = last.date
-        else:
-            last_date = datetime.datetime.strptime('1955-01-01', "%Y-%m-%d").date()
-        to_add = []
-        for row in data:
-            date = datetime.datetime.strptime(row[0], "%Y-%m-%d").date()
-            if date > last_date:
-                new_rate = CurrencyConversion(date=date, rate=float(row[1]), currency=row[2], frequency=row[3],
-                               source=row[4], country_code=row[5], country=row[6])
-                to_add.append(new_rate)
-        if to_add:
-            db.session.add_all(to_add)
-            db.session.commit()
-        nonlocal conversion_cache
-        conversion_cache = None
+        """Upsert rates into the currency conversion database table
+
+        Rows are bulk loaded into a staging table and merged on
+        (currency, date, frequency, country_code), so a reload of the
+        full history only changes rates that have been corrected since
+        the last one. Country code is part of the key because currencies
+        such as XCD and EUR are published once per country using them.
+        """
+        rows = StringIO()
+        csv.writer(rows).writerows(data)
+        rows.seek(0)
+
+        connection = db.session.connection()
+        with connection.connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE TEMPORARY TABLE currency_conversion_staging "
+                "ON COMMIT DROP AS SELECT {0} FROM currency_conversion "
+                "WITH NO DATA".format(", ".join(RATE_COLUMNS)))
+            # An empty country code is loaded as '' rather than NULL, as
+            # NULLs never conflict and would be inserted again each time
+            cursor.copy_expert(
+                "COPY currency_conversion_staging ({0}) FROM STDIN "
+                "WITH (FORMAT csv, FORCE_NOT_NULL (country_code))".format(
+                    ", ".join(RATE_COLUMNS)),
+                rows)
+
+        table = CurrencyConversion.__table__
+        staging = sa.table(
+            'currency_conversion_staging',
+            *[sa.column(c) for c in RATE_COLUMNS])
+        key = ('currency', 'date', 'frequency', 'country_code')
+        updated = [c for c in RATE_COLUMNS if c not in key]
+        stmt = postgresql.insert(table).from_select(
+            RATE_COLUMNS,
+            sa.select(*[staging.c[c] for c in RATE_COLUMNS])
+            .distinct(*[staging.c[c] for c in key])
+            .order_by(*[staging.c[c] for c in key]))
+        stmt = stmt.on_conflict_do_update(
+            index_elements=key,
+            set_={c: stmt.excluded[c] for c in updated},
+            where=sa.or_(*[
+                table.c[c].is_distinct_from(stmt.excluded[c])
+                for c in updated]))
+        result = connection.execute(stmt)
+        if result.rowcount:
+            DataVersion.bump(RATES_VERSION)
+        db.session.commit()
+        clear_cache()
 
     def clear_cache():
-        nonlocal conversion_cache
+        nonlocal conversion_cache, rates_version
         conversion_cache = None
+        rates_version = None
 
     return get_rate, update_exchange_rates, clear_cache
 
@@ -1,17 +1,20 @@
 from collections import OrderedDict
 from datetime import datetime
+from functools import partial
 import sqlalchemy as sa
 from flask import (current_app, request, Response, Blueprint,
                    jsonify, abort, render_template, make_response,
                    url_for, stream_with_context, send_file)
 from flask.views import MethodView
 from werkzeug.datastructures import MultiDict
+from werkzeug.urls import url_encode
 
-from iatilib import db, rq
-from iatilib.model import (Resource, Dataset,
-                           Log, DeletedActivity, Stats)
+from iatilib import db, summary
+from iatilib.model import (Activity, Transaction, Budget, Dataset,
+                           Log, DeletedActivity)
 
-from . import dsfilter, validators, serialize
+from . import (cache, compression, counts, dsfilter, dumps, exports,
+               limits, validators, serialize)
 
 
 api = Blueprint('api1', __name__)
@@ -44,59 +47,38 @@ def meta_filters():
 
 @api.route('/about/')
 def about():
-    # General status info
-    count_activities = db.session.query(
-        Stats.count
-    ).filter_by(label='activities').scalar()
-
-    count_transactions = db.session.query(
-        Stats.count
-    ).filter_by(label='transactions').scalar()
-
-    count_budgets = db.session.query(
-        Stats.count
-    ).filter_by(label='budgets').scalar()
-
-    count_datasets = Dataset.query.count()
+    # General status info, as kept by the crawler. See iatilib/summary.py
+    figures = summary.get()
 
     # Check last updated times
-
-    updated = db.session.query(
-        sa.func.max(Resource.last_fetch).label('last_fetch'),
-        sa.func.max(Resource.last_succ).label('last_succ'),
-        sa.func.max(Resource.last_parsed).label('last_parsed')
-    ).first()
     now = datetime.now()
     # If the file was last fetched less than 2 days
     # ago and parsed less than 1 day
     # ago, then the API is healthy.
-    if ((updated.last_fetch is not None) and
-            (updated.last_succ is not None) and
-            (updated.last_parsed is not None)):
+    if ((figures['last_fetch'] is not None) and
+            (figures['last_succ'] is not None) and
+            (figures['last_parsed'] is not None)):
         healthy = (
-            ((now-updated.last_fetch).days < 2) and
-            ((now-updated.last_succ).days < 2) and
-            ((now-updated.last_parsed).days < 1)
+            ((now-figures['last_fetch']).days < 2) and
+            ((now-figures['last_succ']).days < 2) and
+            ((now-figures['last_parsed']).days < 1)
         )
     else:
         healthy = False
 
-    # Number of items on the queue
-    items_on_queue = rq.get_queue().count
-
     return jsonify(
         ok=healthy,
         status={True: 'healthy', False: 'unhealthy'}[healthy],
         status_data={
-            'last_fetch': updated.last_fetch,
-            'last_successful_fetch': updated.last_succ,
-            'last_parsed': updated.last_parsed
+            'last_fetch': figures['last_fetch'],
+            'last_successful_fetch': figures['last_succ'],
+            'last_parsed': figures['last_parsed']
         },
-        indexed_activities=count_activities,
-        indexed_transactions=count_transactions,
-        indexed_budgets=count_budgets,
-        num_datasets=count_datasets,
-        items_on_queue=items_on_queue
+        indexed_activities=figures['activities'],
+        indexed_transactions=figures['transactions'],
+        indexed_budgets=figures['budgets'],
+        num_datasets=figures['datasets'],
+        items_on_queue=figures['items_on_queue']
     )
 
 
@@ -246,16 +228,52 @@ def dataset_log_error(dataset_id):
     return response
 
 
+@api.route('/exports/<export_id>/')
+def export_status(export_id):
+    if not exports.valid_id(export_id):
+        abort(404)
+    state = exports.status(export_id)
+    if state is None:
+        abort(404)
+    return exports.status_response(export_id, state)
+
+
+@api.route('/exports/<export_id>/download')
+def export_download(export_id):
+    if not exports.valid_id(export_id):
+        abort(404)
+    response = exports.download(export_id)
+    if response is None:
+        abort(404)
+    return response
+
+
+@api.route('/dumps/')
+def dump_index():
+    return dumps.index()
+
+
+@api.route('/dumps/<path:path>')
+def dump_download(path):
+    response = dumps.download(path)
+    if response is None:
+        abort(404)
+    return response
+
+
 class Scrollination:
-    def __init__(self, items, query=None, offset=None, limit=None):
+    def __init__(self, items, query=None, offset=None, limit=None,
+                 count=None, next_cursor=None):
         self.items = items
         self.query = query
         self.offset = offset
         self.limit = limit
+        self.count = count or counts.total
+        self.next_cursor = next_cursor
 
     @property
     def total(self):
-        return self.query.count()
+        return self.count(self.query)
 
 
 class Stream(Scrollination):
@@ -264,12 +282,27 @@ class Stream(Scrollination):
     """
     @property
     def total(self):
-        return self.items.count()
+        return self.count(self.items)
 
 
 class DataStoreView(MethodView):
     filter = None
     serializer = None
+    # The Stats row counting everything the unfiltered query returns
+    stats_label = None
+    # The unique ordering of results. An after= cursor holds these
+    # values for the last row of the previous page, so that the next
+    # page starts with an index lookup instead of skipping an offset.
+    # None where rows have no such key, and only offset can be used.
+    keyset = (Activity.iati_identifier,)
+    # Whether filter takes the dsfilter.transaction_conditions
+    filters_transactions = False
+    # The serializer for split=True, where filter adds the values split
+    # by the breakdown row's percentage
+    split_serializer = None
+    # The file an export job writes the whole result to, instead of
+    # responding. See exports.py
+    export_to = None
 
     @property
     def streaming(self):
@@ -280,31 +313,121 @@ class DataStoreView(MethodView):
         return not self.validate_args().get("unwrap", False)
 
     def paginate(self, query, offset, limit):
-        items = query.order_by('iati_identifier').limit(limit).offset(offset)
-        return Scrollination(items, query, offset, limit)
+        items, next_cursor = self.page(query, offset, limit)
+        return Scrollination(
+            items, query, offset, limit, self.count(), next_cursor)
+
+    def page(self, query, offset, limit):
+        """The rows of one page, and the cursor for the page after"""
+        if self.keyset is None:
+            query = query.order_by('iati_identifier')
+        else:
+            after = self.validate_args().get("after")
+            if after is not None:
+                query = query.filter(
+                    sa.tuple_(*self.keyset) > sa.tuple_(*after))
+            query = query.order_by(*self.keyset)
+        query = query.limit(limit).offset(offset)
+        limits.check_cost(query)
+        items = query.all()
+        if self.keyset is None or len(items) < limit:
+            return items, None
+        return items, validators.encode_cursor(
+            [getattr(items[-1], column.key) for column in self.keyset])
+
+    def count(self):
+        args = self.validate_args()
+        filtered = any(name not in counts.PAGING_ARGS for name in args)
+        return partial(
+            counts.total,
+            mode=args.get("count", "exact"),
+            key=partial(counts.count_key, request.endpoint, args),
+            stats_label=None if filtered else self.stats_label,
+            max_cost=limits.cost_limit())
 
     def validate_args(self):
         if not hasattr(self, "_valid_args"):
             args = MultiDict(request.args)
             args.pop("ref", None)
             args.pop("locale", None)
-            self._valid_args = validators.activity_api_args(args)
+            valid_args = self.parse_args(args)
+            after = valid_args.get("after")
+            if after is not None and (
+                    self.keyset is None or len(after) != len(self.keyset)):
+                raise validators.Invalid(
+                    u"Cursor is not one for this endpoint", path=["after"])
+            if after is not None and not validators.cursor_matches(
+                    after, self.keyset):
+                raise validators.Invalid(
+                    u"Cursor must be a next-cursor returned by the datastore",
+                    path=["after"])
+            if not self.filters_transactions:
+                for name in valid_args:
+                    if name in dsfilter.transaction_conditions:
+                        raise validators.Invalid(
+                            u"Only the transaction endpoints can filter "
+                            u"on transactions", path=[name])
+            if valid_args.get("split") and self.split_serializer is None:
+                raise validators.Invalid(
+                    u"Only the by_country and by_sector transaction and "
+                    u"budget endpoints can split values", path=["split"])
+            self._valid_args = valid_args
         return self._valid_args
 
-    def get_response(self, mimetype, serializer=None):
-        if serializer is None:
-            serializer = self.serializer
+    def parse_args(self, args):
+        return validators.activity_api_args(args)
+
+    def post(self, *args, **kwargs):
+        # Queues an export of the same request, see get_response
+        return self.get(*args, **kwargs)
 
+    def get_response(self, mimetype, serializer=None):
         try:
             valid_args = self.validate_args()
         except (validators.MultipleInvalid, validators.Invalid) as e:
             return make_response(
                 render_template('error/invalid_filter.html', errors=e), 400)
+        if serializer is None:
+            if valid_args.get("split"):
+                serializer = self.split_serializer
+            else:
+                serializer = self.serializer
+        if request.method == 'POST':
+            return exports.enqueue()
+        if self.export_to is not None:
+            return exports.write(self.export_body(serializer), self.export_to)
+        build = partial(self.build_response, mimetype, serializer)
+        if not self.streaming:
+            build = partial(cache.cached, build)
+        try:
+            return cache.conditional(build)
+        except limits.QueryRejected as e:
+            reason = str(e)
+        except sa.exc.OperationalError as e:
+            if not limits.timed_out(e):
+                raise
+            reason = u"The query took too long"
+        db.session.rollback()
+        limits.log_rejection(reason)
+        return make_response(
+            render_template('error/query_rejected.html', reason=reason), 400)
+
+    def export_body(self, serializer):
+        query = self.filter(self.validate_args()).yield_per(100)
+        return serializer(Stream(query, count=self.count()), self.wrapped)
+
+    def build_response(self, mimetype, serializer):
+        valid_args = self.validate_args()
+        limits.set_statement_timeout()
         query = self.filter(valid_args)
 
-        query = query.yield_per(100)
         if self.streaming:
-            pagination = Stream(query)
+            # Fetched through a server-side cursor 100 rows at a time, so
+            # memory stays flat however large the export. Pages are
+            # small enough to fetch in one go.
+            query = query.yield_per(100)
+            limits.check_cost(query)
+            pagination = Stream(query, count=self.count())
         else:
             pagination = self.paginate(
                 query,
@@ -313,20 +436,35 @@ class DataStoreView(MethodView):
             )
         if hasattr(serializer, 'file_mode') and serializer.file_mode:
             filedata = serializer(pagination, self.wrapped)
-            return send_file(
+            response = send_file(
                 filedata['file'],
                 mimetype=mimetype,
                 attachment_filename=filedata['client_filename'],
                 as_attachment=True
             )
         else:
-            return Response(
-                stream_with_context(serializer(pagination, self.wrapped)),
-                mimetype=mimetype)
+            body = serializer(pagination, self.wrapped)
+            encoding = compression.negotiate() if self.streaming else None
+            if encoding is not None:
+                body = compression.compress(body, encoding)
+            response = Response(stream_with_context(body), mimetype=mimetype)
+            if encoding is not None:
+                response.content_encoding = encoding
+            if self.streaming:
+                response.vary.add('Accept-Encoding')
+        if pagination.next_cursor is not None:
+            # CSV and XLSX have nowhere else to put it
+            args = MultiDict(request.args)
+            args.pop("offset", None)
+            args["after"] = pagination.next_cursor
+            response.headers["Link"] = '<{0}?{1}>; rel="next"'.format(
+                request.base_url, url_encode(args))
+        return response
 
 
 class ActivityView(DataStoreView):
     filter = staticmethod(dsfilter.activities)
+    stats_label = 'activities'
 
     def get(self, format):
         forms = {
@@ -340,6 +478,7 @@ class ActivityView(DataStoreView):
 
 class ActivityJSONView(DataStoreView):
     filter = staticmethod(dsfilter.activities_for_json)
+    stats_label = 'activities'
 
     def get(self, format="json"):
         return self.get_response("application/json", serialize.json)  # rfc4627
@@ -350,11 +489,8 @@ class DataStoreCSVView(DataStoreView):
         return self.get_response("text/csv")
 
     def paginate(self, query, offset, limit):
-        items = query\
-            .order_by('iati_identifier')\
-            .limit(limit)\
-            .offset(offset)
-        return Scrollination(items)
+        items, next_cursor = self.page(query, offset, limit)
+        return Scrollination(items, next_cursor=next_cursor)
 
 
 class DataStoreXLSXView(DataStoreView):
@@ -362,11 +498,8 @@ class DataStoreXLSXView(DataStoreView):
         return self.get_response("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 
     def paginate(self, query, offset, limit):
-        items = query\
-            .order_by('iati_identifier')\
-            .limit(limit)\
-            .offset(offset)
-        return Scrollination(items)
+        items, next_cursor = self.page(query, offset, limit)
+        return Scrollination(items, next_cursor=next_cursor)
 
 
 class ActivityCSVView(DataStoreCSVView):
@@ -382,81 +515,147 @@ class ActivityXLSXView(DataStoreXLSXView):
 class ActivityByCountryView(DataStoreCSVView):
     filter = staticmethod(dsfilter.activities_by_country)
     serializer = staticmethod(serialize.csv_activity_by_country)
+    keyset = None
 
 
 class ActivityByCountryXLSXView(DataStoreXLSXView):
     filter = staticmethod(dsfilter.activities_by_country)
     serializer = staticmethod(serialize.xlsx_activity_by_country)
+    keyset = None
 
 
 class ActivityBySectorView(DataStoreCSVView):
     filter = staticmethod(dsfilter.activities_by_sector)
     serializer = staticmethod(serialize.csv_activity_by_sector)
+    keyset = None
 
 
 class ActivityBySectorXLSXView(DataStoreXLSXView):
     filter = staticmethod(dsfilter.activities_by_sector)
     serializer = staticmethod(serialize.xlsx_activity_by_sector)
+    keyset = None
 
 
 class TransactionsView(DataStoreCSVView):
     filter = staticmethod(dsfilter.transactions)
+    filters_transactions = True
     serializer = staticmethod(serialize.transaction_csv)
+    keyset = (Transaction.activity_id, Transaction.id)
 
 
 class TransactionsXLSXView(DataStoreXLSXView):
     filter = staticmethod(dsfilter.transactions)
+    filters_transactions = True
     serializer = staticmethod(serialize.transaction_xlsx)
+    keyset = (Transaction.activity_id, Transaction.id)
 
 
 class TransactionsByCountryView(DataStoreCSVView):
     filter = staticmethod(dsfilter.transactions_by_country)
+    filters_transactions = True
     serializer = staticmethod(serialize.csv_transaction_by_country)
+    split_serializer = staticmethod(serialize.csv_transaction_by_country_split)
+    keyset = None
 
 
 class TransactionsByCountryXLSXView(DataStoreXLSXView):
     filter = staticmethod(dsfilter.transactions_by_country)
+    filters_transactions = True
     serializer = staticmethod(serialize.xlsx_transaction_by_country)
+    split_serializer = staticmethod(serialize.xlsx_transaction_by_country_split)
+    keyset = None
 
 
 class TransactionsBySectorView(DataStoreCSVView):
     filter = staticmethod(dsfilter.transactions_by_sector)
+    filters_transactions = True
     serializer = staticmethod(serialize.csv_transaction_by_sector)
+    split_serializer = staticmethod(serialize.csv_transaction_by_sector_split)
+    keyset = None
 
 
 class TransactionsBySectorXLSXView(DataStoreXLSXView):
     filter = staticmethod(dsfilter.transactions_by_sector)
+    filters_transactions = True
     serializer = staticmethod(serialize.xlsx_transaction_by_sector)
+    split_serializer = staticmethod(serialize.xlsx_transaction_by_sector_split)
+    keyset = None
 
 
 class BudgetsView(DataStoreCSVView):
     filter = staticmethod(dsfilter.budgets)
     serializer = staticmethod(serialize.budget_csv)
+    keyset = (Budget.activity_id, Budget.id)
 
 
 class BudgetsXLSXView(DataStoreXLSXView):
     filter = staticmethod(dsfilter.budgets)
     serializer = staticmethod(serialize.budget_xlsx)
+    keyset = (Budget.activity_id, Budget.id)
 
 
 class BudgetsByCountryView(DataStoreCSVView):
     filter = staticmethod(dsfilter.budgets_by_country)
     serializer = staticmethod(serialize.csv_budget_by_country)
+    split_serializer = staticmethod(serialize.csv_budget_by_country_split)
+    keyset = None
 
 
 class BudgetsByCountryXLSXView(DataStoreXLSXView):
     filter = staticmethod(dsfilter.budgets_by_country)
     serializer = staticmethod(serialize.xlsx_budget_by_country)
+    split_serializer = staticmethod(serialize.xlsx_budget_by_country_split)
+    keyset = None
 
 
 class BudgetsBySectorView(DataStoreCSVView):
     filter = staticmethod(dsfilter.budgets_by_sector)
     serializer = staticmethod(serialize.csv_budget_by_sector)
+    split_serializer = staticmethod(serialize.csv_budget_by_sector_split)
+    keyset = None
 
 
 class BudgetsBySectorXLSXView(DataStoreXLSXView):
     filter = staticmethod(dsfilter.budgets_by_sector)
     serializer = staticmethod(serialize.xlsx_budget_by_sector)
+    split_serializer = staticmethod(serialize.xlsx_budget_by_sector_split)
+    keyset = None
+
+
+class AggregateView(DataStoreView):
+    keyset = None
+
+    def get(self, format="json"):
+        forms = {
+            "json": ("application/json", serialize.aggregate_json),
+            "csv": ("text/csv", serialize.aggregate_csv),
+        }
+        if format not in forms:
+            abort(404)
+        return self.get_response(*forms[format])
+
+    def parse_args(self, args):
+        return validators.aggregate_api_args(args)
+
+    def export_body(self, serializer):
+        return serializer(self.filter(self.validate_args()), self.wrapped)
+
+    def build_response(self, mimetype, serializer):
+        limits.set_statement_timeout()
+        query = self.filter(self.validate_args())
+        limits.check_cost(query)
+        return Response(
+            stream_with_context(serializer(query, self.wrapped)),
+            mimetype=mimetype)
+
+
+class TransactionAggregateView(AggregateView):
+    filter = staticmethod(dsfilter.transaction_aggregate)
+    filters_transactions = True
+
+
+class BudgetAggregateView(AggregateView):
+    filter = staticmethod(dsfilter.budget_aggregate)
 
 
 api.add_url_rule(
@@ -549,3 +748,21 @@ api.add_url_rule(
 api.add_url_rule(
     '/access/budget/by_sector.xlsx',
     view_func=BudgetsBySectorXLSXView.as_view('budget_by_sector_xlsx'))
+
+api.add_url_rule(
+    '/access/transaction/aggregate',
+    defaults={"format": "json"},
+    view_func=TransactionAggregateView.as_view('transaction_aggregate'))
+
+api.add_url_rule(
+    '/access/transaction/aggregate.<format>',
+    view_func=TransactionAggregateView.as_view('transaction_aggregate_format'))
+
+api.add_url_rule(
+    '/access/budget/aggregate',
+    defaults={"format": "json"},
+    view_func=BudgetAggregateView.as_view('budget_aggregate'))
+
+api.add_url_rule(
+    '/access/budget/aggregate.<format>',
+    view_func=BudgetAggregateView.as_view('budget_aggregate_format'))
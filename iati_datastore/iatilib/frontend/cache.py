@@ -0,0 +1,172 @@
+"""
+A cache of the serialized pages of the access API.
+
+The same URLs get asked for over and over between crawls: the query
+builder's previews, dashboards polling for the latest activities. The
+bytes of each page are kept in the Redis that rq already uses, keyed on
+the URL, the locale and the version of the data, so a hit is served
+without touching Postgres. The data version is itself kept in Redis for
+RESPONSE_CACHE_VERSION_TIMEOUT seconds, which bounds how long a crawl
+takes to show up in cached pages.
+
+The cache shares Redis with the job queue, so it can't rely on Redis
+evicting keys. Instead it keeps its own record of when each page was
+last used, and drops the least recently used pages once they take up
+more than RESPONSE_CACHE_MAX_BYTES.
+
+Every response also carries an ETag made from the same key, and the time
+the data last changed as its Last-Modified, so that mirrors polling for
+exports get a 304 until the next crawl without any query being run.
+"""
+import datetime
+import hashlib
+import json
+import logging
+import time
+
+import sqlalchemy as sa
+from flask import current_app, request, Response
+from redis.exceptions import RedisError
+
+from iatilib import db, rq
+from iatilib.crawler import CRAWL_VERSION
+from iatilib.currency_conversion import RATES_VERSION
+from iatilib.model import DataVersion
+
+log = logging.getLogger(__name__)
+
+# Sorted set of cached keys, scored by when they were last used
+LRU_KEY = 'response-cache:lru'
+# Hash of cached keys to their size in bytes
+SIZES_KEY = 'response-cache:sizes'
+# Total size of the cached pages
+BYTES_KEY = 'response-cache:bytes'
+# The crawl and rates versions the current keys are made from, and
+# when either last changed
+VERSION_KEY = 'response-cache:version'
+# Arguments that don't change the response
+IGNORED_ARGS = ('ref', 'locale')
+
+
+def cached(build):
+    """The response for the current request, from the cache or build()"""
+    if not current_app.config['RESPONSE_CACHE_MAX_BYTES']:
+        return build()
+    try:
+        key = response_key()
+        entry = rq.connection.get(key)
+        if entry is not None:
+            rq.connection.zadd(LRU_KEY, {key: time.time()})
+            return load(entry)
+    except RedisError:
+        log.warning("Response cache unavailable", exc_info=True)
+        return build()
+    response = build()
+    if response.status_code == 200:
+        try:
+            store(key, response)
+        except RedisError:
+            log.warning("Response cache unavailable", exc_info=True)
+    return response
+
+
+def conditional(build):
+    """build()'s response with validators, or 304 if the client's is current"""
+    try:
+        version, updated = data_version()
+    except RedisError:
+        log.warning("Response cache unavailable", exc_info=True)
+        return build()
+    etag = '{0}-{1}'.format(version, request_digest())
+    if request.if_none_match:
+        current = request.if_none_match.contains_weak(etag)
+    else:
+        since = request.if_modified_since
+        current = None not in (since, updated) and updated <= since
+    if current:
+        response = Response(status=304)
+    else:
+        response = build()
+        if response.status_code != 200:
+            return response
+    response.set_etag(etag, weak=True)
+    if updated is not None:
+        response.last_modified = updated
+    return response
+
+
+def request_digest():
+    args = sorted(
+        (name, value) for name, value in request.args.items(multi=True)
+        if name not in IGNORED_ARGS)
+    locale = request.args.get("locale", "en")
+    return hashlib.sha1(json.dumps(
+        [request.base_url, locale, args]).encode('utf-8')).hexdigest()
+
+
+def response_key():
+    version, _ = data_version()
+    return 'response:{0}:{1}'.format(version, request_digest())
+
+
+def data_version():
+    """The version of the data, and when it last changed or None"""
+    entry = rq.connection.get(VERSION_KEY)
+    if entry is None:
+        updated = db.session.query(sa.func.max(DataVersion.updated)).filter(
+            DataVersion.label.in_((CRAWL_VERSION, RATES_VERSION))).scalar()
+        entry = json.dumps([
+            '{0}.{1}'.format(
+                DataVersion.current(CRAWL_VERSION),
+                DataVersion.current(RATES_VERSION)),
+            None if updated is None else int(updated.timestamp()),
+        ])
+        rq.connection.set(
+            VERSION_KEY, entry,
+            ex=current_app.config['RESPONSE_CACHE_VERSION_TIMEOUT'])
+    version, updated = json.loads(entry)
+    if updated is not None:
+        updated = datetime.datetime.fromtimestamp(
+            updated, datetime.timezone.utc)
+    return version, updated
+
+
+def load(entry):
+    headers, body = entry.split(b'\n', 1)
+    return Response(body, headers=json.loads(headers.decode('utf-8')))
+
+
+def store(key, response):
+    # Reads file responses such as XLSX into memory
+    response.direct_passthrough = False
+    body = response.get_data()
+    if len(body) > current_app.config['RESPONSE_CACHE_MAX_ENTRY_BYTES']:
+        return
+    headers = [
+        (name, value) for name, value in response.headers
+        if name != 'Content-Length']
+    entry = json.dumps(headers).encode('utf-8') + b'\n' + body
+    replaced = int(rq.connection.hget(SIZES_KEY, key) or 0)
+    pipe = rq.connection.pipeline()
+    pipe.set(key, entry)
+    pipe.zadd(LRU_KEY, {key: time.time()})
+    pipe.hset(SIZES_KEY, key, len(entry))
+    pipe.incrby(BYTES_KEY, len(entry) - replaced)
+    evict(pipe.execute()[-1])
+
+
+def evict(total):
+    """Drop the least recently used pages until total is under the limit"""
+    limit = current_app.config['RESPONSE_CACHE_MAX_BYTES']
+    while total > limit:
+        oldest = rq.connection.zrange(LRU_KEY, 0, 0)
+        if not oldest:
+            break
+        key = oldest[0]
+        size = int(rq.connection.hget(SIZES_KEY, key) or 0)
+        pipe = rq.connection.pipeline()
+        pipe.delete(key)
+        pipe.zrem(LRU_KEY, key)
+        pipe.hdel(SIZES_KEY, key)
+        pipe.decrby(BYTES_KEY, size)
+        total = pipe.execute()[-1]
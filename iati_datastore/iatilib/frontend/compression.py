@@ -0,0 +1,80 @@
+"""
+Compression of the streamed access API responses.
+
+A full stream=True export is gigabytes of CSV, JSON or XML, and compresses
+to a small fraction of that. Streams are compressed as they are
+generated, in the encoding the client prefers of those it accepts, so
+nothing more than the compressor's own window is held in memory. Brotli
+is offered only where the brotli package is installed.
+
+`iati benchmark-compression` weighs the CPU each encoding costs against
+the bytes it saves on a real export.
+"""
+import time
+import zlib
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bytes of input after which a compressor is flushed, so that a slow
+# query still sends something the client can decompress
+FLUSH_BYTES = 1024 * 1024
+
+
+def encodings():
+    """The encodings on offer, in order of preference"""
+    if brotli is None:
+        return ['gzip']
+    return ['br', 'gzip']
+
+
+def negotiate():
+    """The encoding to compress the current response with, or None"""
+    return request.accept_encodings.best_match(encodings())
+
+
+def compress(chunks, encoding, level=None):
+    """The chunks of text or bytes, compressed as they come"""
+    if level is None:
+        level = current_app.config['STREAM_COMPRESSION_LEVELS'][encoding]
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=level)
+        compress_chunk, flush, finish = (
+            compressor.process, compressor.flush, compressor.finish)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compress_chunk, finish = compressor.compress, compressor.flush
+
+        def flush():
+            return compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    unflushed = 0
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        data = compress_chunk(chunk)
+        unflushed += len(chunk)
+        if unflushed >= FLUSH_BYTES:
+            data += flush()
+            unflushed = 0
+        if data:
+            yield data
+    yield finish()
+
+
+def benchmark(chunks, levels):
+    """(encoding, level, bytes, CPU seconds) for each of levels
+
+    levels is a list of (encoding, level). The first row is the chunks
+    uncompressed.
+    """
+    results = [('identity', None, sum(len(c) for c in chunks), 0.0)]
+    for encoding, level in levels:
+        start = time.process_time()
+        size = sum(len(c) for c in compress(chunks, encoding, level))
+        results.append((encoding, level, size, time.process_time() - start))
+    return results
@@ -0,0 +1,119 @@
+"""
+Total counts for the paginated API responses.
+
+Counting the whole filtered query often costs more than fetching the
+page itself, and a client walking through the pages asks for the same
+count each time. Counts are kept in the Redis that rq already uses,
+keyed on the endpoint, the filter arguments and the crawl version, so
+a crawl committing new data leaves the old counts unreachable until
+they expire.
+
+Clients can also ask for the planner's estimate instead, or for no
+count at all, with count=estimate or count=none. An exact count that the
+planner expects to cost more than the endpoint's query cost limit falls
+back to the estimate too.
+"""
+import hashlib
+import json
+import logging
+
+from flask import current_app
+from redis.exceptions import RedisError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from iatilib import db, rq
+from iatilib.crawler import CRAWL_VERSION
+from iatilib.model import DataVersion, Stats
+
+from . import dsfilter
+
+log = logging.getLogger(__name__)
+
+# Arguments that page through a result without changing its size
+PAGING_ARGS = ('offset', 'after', 'limit', 'stream', 'unwrap', 'count')
+
+
+class Explain(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, 'postgresql')
+def compile_explain(element, compiler, **kw):
+    return 'EXPLAIN (FORMAT JSON) ' + compiler.process(element.statement, **kw)
+
+
+def total(query, mode='exact', key=None, stats_label=None, max_cost=None):
+    """The total-count for a query, or None for count=none
+
+    stats_label names the Stats row holding the count when the query
+    is unfiltered. key is called for the count's cache key, only when
+    an exact count of a filtered query is needed.
+    """
+    if mode == 'none':
+        return None
+    if mode == 'estimate':
+        return estimated_count(query)
+    if stats_label is not None:
+        return db.session.query(Stats.count).filter_by(
+            label=stats_label).scalar()
+    return cached_count(query, key and key(), max_cost)
+
+
+def query_plan(query):
+    """The top node of the planner's plan for query"""
+    return db.session.execute(Explain(query.statement)).scalar()[0]['Plan']
+
+
+def estimated_count(query):
+    """The planner's estimate of the rows query will return"""
+    return int(query_plan(query)['Plan Rows'])
+
+
+def canonical_terms(value):
+    """The sorted terms of a filter argument, which match in any order"""
+    return sorted(set(
+        str(getattr(term, 'value', term))
+        for term in dsfilter.split_terms(value)))
+
+
+def count_key(endpoint, args):
+    """The cache key for the count of an endpoint's filtered query"""
+    filters = sorted(
+        (name, canonical_terms(value))
+        for name, value in args.items()
+        if name not in PAGING_ARGS)
+    digest = hashlib.sha1(
+        json.dumps([endpoint, filters]).encode('utf-8')).hexdigest()
+    return 'count:{0}:{1}'.format(DataVersion.current(CRAWL_VERSION), digest)
+
+
+def cached_count(query, key=None, max_cost=None):
+    """query.count(), remembered under key if one is given
+
+    If counting would cost more than max_cost, the planner's estimate,
+    which isn't remembered.
+    """
+    if key is None:
+        return query.count()
+    try:
+        count = rq.connection.get(key)
+    except RedisError:
+        log.warning("Count cache unavailable", exc_info=True)
+        return query.count()
+    if count is not None:
+        return int(count)
+    if max_cost is not None:
+        plan = query_plan(query)
+        if plan['Total Cost'] > max_cost:
+            return int(plan['Plan Rows'])
+    count = query.count()
+    try:
+        rq.connection.set(
+            key, count, ex=current_app.config['COUNT_CACHE_TIMEOUT'])
+    except RedisError:
+        log.warning("Count cache unavailable", exc_info=True)
+    return count
@@ -1,14 +1,18 @@
+from collections import OrderedDict, namedtuple
 from functools import partial
 import six
-from sqlalchemy import or_, and_, orm, func
-from sqlalchemy.sql.operators import eq, gt, lt
-from iatilib import db
+from sqlalchemy import or_, and_, orm, func, select, case, cast, Integer, Unicode
+from sqlalchemy.sql.operators import gt, lt
+from iatilib import codelists, db
+from iatilib.codelists.enum import EnumSymbol
 from iatilib.model import (
     Activity, Budget, Transaction, CountryPercentage, SectorPercentage,
-    RegionPercentage, Participation, Organisation, PolicyMarker,
-    RelatedActivity, Resource)
+    Participation, Organisation, PolicyMarker, RelatedActivity,
+    ActivityFacet, ActivityTotal)
 from flask import request
 
+from .validators import transaction_type_name
+
 
 class BadFilterException(Exception):
     pass
@@ -28,326 +32,245 @@ def filter_from(codelist, column, related_column, code):
     return column.any(related_column == value)
 
 
-def _filter(query, args):
-    # recipient_country = partial(filter_from_codelist, codelists.Country,
-    #    Activity.recipient_country_percentages, CountryPercentage.country)
-    def recipient_country(country_code):
-        return or_(
-            Activity.recipient_country_percentages.any(
-                CountryPercentage.country == country_code
-            ),
-            Activity.transactions.any(
-                Transaction.recipient_country_percentages.any(
-                    CountryPercentage.country == country_code
-                )
-            )
-        )
-
-    def recipient_country_text(country):
-        return or_(
-            Activity.recipient_country_percentages.any(
-                CountryPercentage.name == country
-            ),
-            Activity.transactions.any(
-                Transaction.recipient_country_percentages.any(
-                    CountryPercentage.name == country
-                )
-            )
-        )
-
-    def recipient_region(region_code):
-        return or_(
-            Activity.recipient_region_percentages.any(
-                RegionPercentage.region == region_code
-            ),
-            Activity.transactions.any(
-                Transaction.recipient_region_percentages.any(
-                    RegionPercentage.region == region_code
-                )
-            )
-        )
-
-    def recipient_region_text(region):
-        return or_(
-            Activity.recipient_region_percentages.any(
-                RegionPercentage.name == region
-            ),
-            Activity.transactions.any(
-                Transaction.recipient_region_percentages.any(
-                    RegionPercentage.name == region
-                )
-            )
-        )
-
-    def reporting_org(organisation):
-        return Activity.reporting_org.has(
-            Organisation.ref == organisation
-        )
-
-    def reporting_org_text(organisation):
-        return Activity.reporting_org.has(
-            Organisation.name == organisation
-        )
-
-    def reporting_org_type(organisation_type):
-        return Activity.reporting_org.has(
-            Organisation.type == organisation_type
-        )
-
-    def participating_org(organisation):
-        return Activity.participating_orgs.any(
-            Participation.organisation.has(
-                Organisation.ref == organisation
-            )
-        )
-
-    def participating_org_text(organisation):
-        return Activity.participating_orgs.any(
-            Participation.organisation.has(
-                Organisation.name == organisation
-            )
-        )
-
-    def participating_org_role(role):
-        return Activity.participating_orgs.any(
-            Participation.role == role
-        )
+# Characters that make a like_regex pattern more than a plain substring
+REGEX_METACHARACTERS = frozenset('\\^$.|?*+()[]{}')
 
-    def participating_org_with_role(organisation, role='1'):
-        return Activity.participating_orgs.any(
-            and_(
-                Participation.organisation.has(
-                    Organisation.ref == organisation
-                ),
-                Participation.role == role
-            )
-        )
 
-    def participating_org_with_role_name(organisation, role='1'):
-        return Activity.participating_orgs.any(
-            and_(
-                Participation.organisation.has(
-                    Organisation.name == organisation
-                ),
-                Participation.role == role
-            )
-        )
+def jsonpath_string(value):
+    return u'"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
 
-    def participating_org_with_role_type(organisation_type, role='1'):
-        return Activity.participating_orgs.any(
-            and_(
-                Participation.organisation.has(
-                    Organisation.type == organisation_type
-                ),
-                Participation.role == role
-            )
-        )
 
-    def sector(sector_code):
-        return or_(
-            Activity.sector_percentages.any(
-                SectorPercentage.sector == sector_code
-            ),
-            Activity.transactions.any(
-                Transaction.sector_percentages.any(
-                    SectorPercentage.sector == sector_code
-                )
-            )
-        )
+def term_values(terms):
+    return [
+        term.value if isinstance(term, EnumSymbol) else term
+        for term in terms
+    ]
 
-    def sector_text(sector):
-        return or_(
-            Activity.sector_percentages.any(
-                SectorPercentage.text == sector
-            ),
-            Activity.transactions.any(
-                Transaction.sector_percentages.any(
-                    SectorPercentage.text == sector
-                )
-            )
-        )
 
-    def transaction_ref(transaction):
-        return Activity.transactions.any(
-            Transaction.ref == transaction
-        )
+def any_term(condition):
+    # For conditions that can't compare against a list of values at once
+    def any_term_condition(terms):
+        return or_(*[condition(term) for term in terms])
+    return any_term_condition
 
-    def transaction_provider_org(organisation):
-        return Activity.transactions.any(
-            Transaction.provider_org.has(
-                Organisation.ref == organisation
-            )
-        )
 
-    def transaction_provider_org_name(organisation):
-        return Activity.transactions.any(
-            Transaction.provider_org.has(
-                Organisation.name == organisation
-            )
-        )
+def codes(column, terms):
+    return column.overlap(term_values(terms))
 
-    def transaction_provider_org_type(organisation_type):
-        return Activity.transactions.any(
-            Transaction.provider_org.has(
-                Organisation.type == organisation_type
-            )
-        )
 
-    def transaction_provider_org_activity_id(activity_id):
-        return Activity.transactions.any(
-            Transaction.provider_org_activity_id == activity_id
-        )
-
-    def transaction_receiver_org(organisation):
-        return Activity.transactions.any(
-            Transaction.receiver_org.has(
-                Organisation.ref == organisation
-            )
-        )
-
-    def transaction_receiver_org_type(organisation_type):
-        return Activity.transactions.any(
-            Transaction.receiver_org.has(
-                Organisation.type == organisation_type
-            )
-        )
-
-    def transaction_receiver_org_name(organisation):
-        return Activity.transactions.any(
-            Transaction.receiver_org.has(
-                Organisation.name == organisation
-            )
-        )
-
-    def transaction_receiver_org_activity_id(activity_id):
-        return Activity.transactions.any(
-            Transaction.receiver_org_activity_id == activity_id
-        )
-
-    def policy_marker(policy_marker):
-        return Activity.policy_markers.any(
-            PolicyMarker.code == policy_marker
+def facet(name, terms):
+    return Activity.iati_identifier.in_(
+        db.session.query(ActivityFacet.activity_id).filter(
+            ActivityFacet.facet == name,
+            ActivityFacet.value.in_(term_values(terms)),
         )
+    )
 
-    def policy_significance(policy_significance):
-        return Activity.policy_markers.any(
-            PolicyMarker.significance == policy_significance
-        )
 
-    def related_activity(ref):
-        return Activity.related_activities.any(
-            RelatedActivity.ref == ref
-        )
+def split_terms(search_string):
+    if isinstance(search_string, six.string_types):
+        return search_string.split('|')
+    elif isinstance(search_string, list):
+        return search_string
+    return [search_string]
+
+
+# A one-to-many (or for reporting-org one-to-one) path from an activity to
+# the rows that path filters test. activity_column is matched against
+# row_activity_column selected from from_clause.
+FilterPath = namedtuple(
+    'FilterPath', 'activity_column row_activity_column from_clause to_one')
+
+ProviderOrg = orm.aliased(Organisation)
+ReceiverOrg = orm.aliased(Organisation)
+
+REPORTING_ORG = FilterPath(
+    Activity.reporting_org_id, Organisation.id, Organisation, True)
+PARTICIPATION = FilterPath(
+    Activity.iati_identifier,
+    Participation.activity_identifier,
+    orm.join(Participation, Organisation,
+             Participation.organisation_id == Organisation.id),
+    False)
+TRANSACTION = FilterPath(
+    Activity.iati_identifier,
+    Transaction.activity_id,
+    orm.outerjoin(Transaction, ProviderOrg,
+                  Transaction.provider_org_id == ProviderOrg.id)
+    .outerjoin(ReceiverOrg, Transaction.receiver_org_id == ReceiverOrg.id),
+    False)
+POLICY_MARKER = FilterPath(
+    Activity.iati_identifier, PolicyMarker.activity_id, PolicyMarker, False)
+RELATED_ACTIVITY = FilterPath(
+    Activity.iati_identifier, RelatedActivity.activity_id, RelatedActivity,
+    False)
+
+
+def path_condition(path, conditions, same_row=False):
+    """Match activities with rows on path satisfying conditions
+
+    With same_row every condition has to hold on one row, otherwise
+    each condition only has to hold on some row, as if they were
+    separate EXISTS subqueries, but still as a single semi-join.
+    """
+    subquery = select(path.row_activity_column).select_from(
+        path.from_clause).correlate(None)
+    if same_row or path.to_one or len(conditions) == 1:
+        subquery = subquery.where(and_(*conditions))
+    else:
+        subquery = subquery.where(or_(*conditions)).group_by(
+            path.row_activity_column
+        ).having(and_(*[func.bool_or(c) for c in conditions]))
+    return path.activity_column.in_(subquery)
+
+
+def participating_org_with_role(column, organisations, role='1'):
+    return and_(Participation.role == role, column.in_(organisations))
+
+
+# Filters on rows of a path. Several of them in one request are merged
+# into one subquery per path - see path_condition.
+path_conditions = {
+        'reporting-org': (REPORTING_ORG, Organisation.ref.in_),
+        'reporting-org.ref': (REPORTING_ORG, Organisation.ref.in_),
+        'reporting-org.type': (REPORTING_ORG, Organisation.type.in_),
+        'reporting-org.text': (REPORTING_ORG, Organisation.name.in_),
+        'participating-org': (PARTICIPATION, Organisation.ref.in_),
+        'participating-org.ref': (PARTICIPATION, Organisation.ref.in_),
+        'participating-org.text': (PARTICIPATION, Organisation.name.in_),
+        'participating-org.type': (PARTICIPATION, Organisation.type.in_),
+        'participating-org.role': (PARTICIPATION, Participation.role.in_),
+        'policy-marker': (POLICY_MARKER, PolicyMarker.code.in_),
+        'policy-marker.code': (POLICY_MARKER, PolicyMarker.code.in_),
+        'policy-marker.significance': (POLICY_MARKER, PolicyMarker.significance.in_),
+        'related-activity': (RELATED_ACTIVITY, RelatedActivity.ref.in_),
+        'related-activity.ref': (RELATED_ACTIVITY, RelatedActivity.ref.in_),
+        'transaction': (TRANSACTION, Transaction.ref.in_),
+        'transaction.ref': (TRANSACTION, Transaction.ref.in_),
+        'transaction_provider-org': (TRANSACTION, ProviderOrg.ref.in_),
+        'transaction_provider-org.ref': (TRANSACTION, ProviderOrg.ref.in_),
+        'transaction_provider-org.text': (TRANSACTION, ProviderOrg.name.in_),
+        'transaction_provider-org.type': (TRANSACTION, ProviderOrg.type.in_),
+        'transaction_provider-org.provider-activity-id': (TRANSACTION, Transaction.provider_org_activity_id.in_),
+        'transaction_receiver-org': (TRANSACTION, ReceiverOrg.ref.in_),
+        'transaction_receiver-org.ref': (TRANSACTION, ReceiverOrg.ref.in_),
+        'transaction_receiver-org.text': (TRANSACTION, ReceiverOrg.name.in_),
+        'transaction_receiver-org.type': (TRANSACTION, ReceiverOrg.type.in_),
+        'transaction_receiver-org.receiver-activity-id': (TRANSACTION, Transaction.receiver_org_activity_id.in_),
+}
+for role in ('1', '2', '3', '4'):
+    for suffix, column in (('', Organisation.ref), ('.ref', Organisation.ref),
+                           ('.text', Organisation.name),
+                           ('.type', Organisation.type)):
+        path_conditions['participating-org-role-{}{}'.format(role, suffix)] = (
+            PARTICIPATION,
+            partial(participating_org_with_role, column, role=role))
 
-    def date_condition(condition, actual_date, planned_date, date):
-        return or_(
-                condition(actual_date, date),
-                and_(condition(planned_date, date), actual_date == None),
-        )
-
-    def registry_dataset(dataset_id):
-        return Activity.resource.has(
-            Resource.dataset_id == dataset_id
-        )
 
+def _filter(query, args):
+    # Each condition takes the list of terms for its filter (the values
+    # separated by "|") and matches activities that have any of them.
+    # A filter that also has a path condition uses the one here when it
+    # is the only filter on its path, as the denormalised columns are
+    # quicker to search.
     def title(title):
         locale = request.args.get("locale", "en")
-        return or_(
-            Activity.title.ilike("%{}%".format(title)),
-            Activity.title_all_values['default'].astext.ilike("%{}%".format(title)),
-            Activity.title_all_values[locale].astext.ilike("%{}%".format(title)),
+        # title_search holds every title value, so checking it first lets
+        # the trigram index rule out most activities
+        return and_(
+            Activity.title_search.ilike("%{}%".format(title)),
+            or_(
+                Activity.title.ilike("%{}%".format(title)),
+                Activity.title_all_values['default'].astext.ilike("%{}%".format(title)),
+                Activity.title_all_values[locale].astext.ilike("%{}%".format(title)),
+            )
         )
 
     def description(description):
         locale = request.args.get("locale", "en")
-        return func.jsonb_path_exists(Activity.description_all_values,
-               '$[*] ? (@.{}.* like_regex "{}" || @.default.* like_regex "{}")'.format(locale, description, description))
+        pattern = jsonpath_string(description)
+        condition = func.jsonb_path_exists(Activity.description_all_values,
+               '$[*] ? (@.{}.* like_regex {} || @.default.* like_regex {})'.format(
+                   jsonpath_string(locale), pattern, pattern))
+        if REGEX_METACHARACTERS.isdisjoint(description):
+            # A plain string can only match where it is a substring, which
+            # the trigram index on description_search can narrow down
+            condition = and_(
+                Activity.description_search.contains(description),
+                condition
+            )
+        return condition
+
+    def role_codes(organisations, role='1'):
+        return codes(
+            Activity.participating_org_role_refs,
+            [u'{}:{}'.format(role, organisation) for organisation in organisations]
+        )
 
     filter_conditions = {
-            'iati-identifier': partial(eq, Activity.iati_identifier),
-            'activity-status': partial(eq, Activity.activity_status),
-            'title': title,
-            'description': description,
-            'recipient-country': recipient_country,
-            'recipient-country.code': recipient_country,
-            'recipient-country.text': recipient_country_text,
-            'recipient-region': recipient_region,
-            'recipient-region.code': recipient_region,
-            'recipient-region.text': recipient_region_text,
-            'reporting-org': reporting_org,
-            'reporting-org.ref': reporting_org,
-            'reporting-org.type': reporting_org_type,
-            'reporting-org.text': reporting_org_text,
-            'sector': sector,
-            'sector.code': sector,
-            'sector.text': sector_text,
-            'policy-marker': policy_marker,
-            'policy-marker.code': policy_marker,
-            'policy-marker.significance': policy_significance,
-            'participating-org': participating_org,
-            'participating-org.ref': participating_org,
-            'participating-org.text': participating_org_text,
-            'participating-org.role': participating_org_role,
-            'related-activity': related_activity,
-            'related-activity.ref': related_activity,
-            'transaction.ref': transaction_ref,
-            'transaction': transaction_ref,
-            'transaction_provider-org': transaction_provider_org,
-            'transaction_provider-org.ref': transaction_provider_org,
-            'transaction_provider-org.text': transaction_provider_org_name,
-            'transaction_provider-org.type': transaction_provider_org_type,
-            'transaction_provider-org.provider-activity-id': transaction_provider_org_activity_id,
-            'transaction_receiver-org': transaction_receiver_org,
-            'transaction_receiver-org.ref': transaction_receiver_org,
-            'transaction_receiver-org.text': transaction_receiver_org_name,
-            'transaction_receiver-org.type': transaction_receiver_org_type,
-            'transaction_receiver-org.receiver-activity-id': transaction_receiver_org_activity_id,
-            'start-date__gt': partial(date_condition, gt, Activity.start_actual, Activity.start_planned),
-            'start-date__lt': partial(date_condition, lt, Activity.start_actual, Activity.start_planned),
-            'end-date__gt': partial(date_condition, gt, Activity.end_actual, Activity.end_planned),
-            'end-date__lt': partial(date_condition, lt, Activity.end_actual, Activity.end_planned),
-            'last-change__gt': partial(gt, Activity.last_change_datetime),
-            'last-change__lt': partial(lt, Activity.last_change_datetime),
-            'last-updated-datetime__gt': partial(gt, Activity.last_updated_datetime),
-            'last-updated-datetime__lt': partial(lt, Activity.last_updated_datetime),
-            'registry-dataset': registry_dataset,
-            'participating-org-role-1': partial(participating_org_with_role, role='1'),
-            'participating-org-role-1.ref': partial(participating_org_with_role, role='1'),
-            'participating-org-role-1.text': partial(participating_org_with_role_name, role='1'),
-            'participating-org-role-1.type': partial(participating_org_with_role_type, role='1'),
-            'participating-org-role-2': partial(participating_org_with_role, role='2'),
-            'participating-org-role-2.ref': partial(participating_org_with_role, role='2'),
-            'participating-org-role-2.text': partial(participating_org_with_role_name, role='2'),
-            'participating-org-role-2.type': partial(participating_org_with_role_type, role='2'),
-            'participating-org-role-3': partial(participating_org_with_role, role='3'),
-            'participating-org-role-3.ref': partial(participating_org_with_role, role='3'),
-            'participating-org-role-3.text': partial(participating_org_with_role_name, role='3'),
-            'participating-org-role-3.type': partial(participating_org_with_role_type, role='3'),
-            'participating-org-role-4': partial(participating_org_with_role, role='4'),
-            'participating-org-role-4.ref': partial(participating_org_with_role, role='4'),
-            'participating-org-role-4.text': partial(participating_org_with_role_name, role='4'),
-            'participating-org-role-4.type': partial(participating_org_with_role_type, role='4'),
+            'iati-identifier': Activity.iati_identifier.in_,
+            'activity-status': Activity.activity_status.in_,
+            'title': any_term(title),
+            'description': any_term(description),
+            'recipient-country': partial(codes, Activity.recipient_country_codes),
+            'recipient-country.code': partial(codes, Activity.recipient_country_codes),
+            'recipient-country.text': partial(facet, 'recipient-country.text'),
+            'recipient-region': partial(codes, Activity.recipient_region_codes),
+            'recipient-region.code': partial(codes, Activity.recipient_region_codes),
+            'recipient-region.text': partial(facet, 'recipient-region.text'),
+            'sector': partial(codes, Activity.sector_codes),
+            'sector.code': partial(codes, Activity.sector_codes),
+            'sector.text': partial(facet, 'sector.text'),
+            'policy-marker': partial(codes, Activity.policy_marker_codes),
+            'policy-marker.code': partial(codes, Activity.policy_marker_codes),
+            'participating-org': partial(codes, Activity.participating_org_refs),
+            'participating-org.ref': partial(codes, Activity.participating_org_refs),
+            'participating-org.text': partial(facet, 'participating-org.text'),
+            'transaction_provider-org': partial(facet, 'transaction_provider-org'),
+            'transaction_provider-org.ref': partial(facet, 'transaction_provider-org'),
+            'transaction_provider-org.text': partial(facet, 'transaction_provider-org.text'),
+            'transaction_receiver-org': partial(facet, 'transaction_receiver-org'),
+            'transaction_receiver-org.ref': partial(facet, 'transaction_receiver-org'),
+            'transaction_receiver-org.text': partial(facet, 'transaction_receiver-org.text'),
+            'start-date__gt': any_term(partial(gt, Activity.start_effective)),
+            'start-date__lt': any_term(partial(lt, Activity.start_effective)),
+            'end-date__gt': any_term(partial(gt, Activity.end_effective)),
+            'end-date__lt': any_term(partial(lt, Activity.end_effective)),
+            'last-change__gt': any_term(partial(gt, Activity.last_change_datetime)),
+            'last-change__lt': any_term(partial(lt, Activity.last_change_datetime)),
+            'last-updated-datetime__gt': any_term(partial(gt, Activity.last_updated_datetime)),
+            'last-updated-datetime__lt': any_term(partial(lt, Activity.last_updated_datetime)),
+            'registry-dataset': Activity.dataset_id.in_,
+            'publisher': Activity.publisher.in_,
+            'participating-org-role-1': partial(role_codes, role='1'),
+            'participating-org-role-1.ref': partial(role_codes, role='1'),
+            'participating-org-role-2': partial(role_codes, role='2'),
+            'participating-org-role-2.ref': partial(role_codes, role='2'),
+            'participating-org-role-3': partial(role_codes, role='3'),
+            'participating-org-role-3.ref': partial(role_codes, role='3'),
+            'participating-org-role-4': partial(role_codes, role='4'),
+            'participating-org-role-4.ref': partial(role_codes, role='4'),
     }
 
+    same_row = args.get('same-row', False)
+    on_paths = OrderedDict()
     for filter, search_string in args.items():
-        filter_condition = filter_conditions.get(filter, None)
-        if filter_condition:
-            if isinstance(search_string, six.string_types):
-                terms = search_string.split('|')
-                if len(terms) >= 1:
-                    conditions = tuple([filter_condition(term) for term in terms])
-                    query = query.filter(or_(*conditions))
-                else:
-                    query = query.filter(filter_condition(search_string))
-
-            elif isinstance(search_string, list):
-                if len(search_string) == 1:
-                    query = query.filter(filter_condition(search_string[0]))
-                elif len(search_string) >= 1:
-                    conditions = tuple([filter_condition(term) for term in search_string])
-                    query = query.filter(or_(*conditions))
-            else:
-                query = query.filter(filter_condition(search_string))
+        terms = split_terms(search_string)
+        if filter in path_conditions:
+            path, condition = path_conditions[filter]
+            on_paths.setdefault(path, []).append((filter, condition, terms))
+        elif filter in filter_conditions:
+            query = query.filter(filter_conditions[filter](terms))
+
+    for path, conditions in on_paths.items():
+        if len(conditions) == 1 and conditions[0][0] in filter_conditions:
+            filter, _, terms = conditions[0]
+            query = query.filter(filter_conditions[filter](terms))
+        else:
+            query = query.filter(path_condition(
+                path,
+                [condition(terms) for _, condition, terms in conditions],
+                same_row))
 
     return query
 
@@ -376,23 +299,69 @@ def activities_for_csv(args):
     )
 
 
+# The activity level recipient countries and sectors the by_* queries
+# join, aliased so the filters can join the tables themselves. Rows still
+# have the r.CountryPercentage and r.SectorPercentage the serializers
+# expect.
+CountryRow = orm.aliased(CountryPercentage, name="CountryPercentage")
+SectorRow = orm.aliased(SectorPercentage, name="SectorPercentage")
+
+
 def activities_by_country(args):
+    # The CSV totals come from the activity's stored ActivityTotal
     return _filter(
-        db.session.query(Activity, CountryPercentage).join(CountryPercentage),
+        db.session.query(Activity, CountryRow, ActivityTotal)
+        .join(CountryRow, CountryRow.activity_id == Activity.iati_identifier)
+        .outerjoin(
+            ActivityTotal,
+            ActivityTotal.activity_id == Activity.iati_identifier),
         args
     )
 
 
 def activities_by_sector(args):
     return _filter(
-        db.session.query(Activity, SectorPercentage).join(SectorPercentage),
+        db.session.query(Activity, SectorRow, ActivityTotal)
+        .join(SectorRow, SectorRow.activity_id == Activity.iati_identifier)
+        .outerjoin(
+            ActivityTotal,
+            ActivityTotal.activity_id == Activity.iati_identifier),
         args
     )
 
 
+def percentage_transactions(column, terms):
+    return Transaction.id.in_(
+        select(column.class_.transaction_id).where(
+            column.in_(term_values(terms))))
+
+
+# Filters on the transactions themselves rather than their activities,
+# only for the transaction endpoints
+transaction_conditions = {
+        'transaction-date__gt': any_term(partial(gt, Transaction.date)),
+        'transaction-date__lt': any_term(partial(lt, Transaction.date)),
+        'transaction-type': Transaction.type.in_,
+        'value-usd__gt': any_term(partial(gt, Transaction.value_usd)),
+        'value-usd__lt': any_term(partial(lt, Transaction.value_usd)),
+        'transaction_recipient-country': partial(
+            percentage_transactions, CountryPercentage.country),
+        'transaction_sector': partial(
+            percentage_transactions, SectorPercentage.sector),
+}
+
+
+def _filter_transactions(query, args):
+    for filter, search_string in args.items():
+        if filter in transaction_conditions:
+            query = query.filter(
+                transaction_conditions[filter](split_terms(search_string)))
+    return _filter(query, args)
+
+
 def transactions(args):
     # For performance reasons, eager load some extra data we will use later for CSV's.
-    return _filter(
+    return _filter_transactions(
         db.session.query(Transaction).join(Activity).options(
             orm.selectinload(Transaction.recipient_country_percentages),
             orm.selectinload(Transaction.recipient_region_percentages),
@@ -402,11 +371,35 @@ def transactions(args):
     )
 
 
+def split_values(model, *rows):
+    """model's values split by the percentages of breakdown rows
+
+    A row without a percentage takes the whole value.
+    """
+    values = [model.value_amount, model.value_usd, model.value_eur]
+    for row in rows:
+        share = func.coalesce(row.percentage, 100) / 100
+        values = [value * share for value in values]
+    return [
+        value.label(name) for value, name in zip(
+            values, ('split_value', 'split_value_usd', 'split_value_eur'))]
+
+
+def _with_split_values(query, model, row, args):
+    if not args.get('split', False):
+        return query
+    return query.add_columns(*[
+        func.round(column, 2).label(column.name)
+        for column in split_values(model, row)])
+
+
 def transactions_by_country(args):
-    return _filter(
-        db.session.query(Transaction, CountryPercentage)
+    return _filter_transactions(
+        _with_split_values(
+            db.session.query(Transaction, CountryRow),
+            Transaction, CountryRow, args)
         .join(Activity, Activity.iati_identifier==Transaction.activity_id)
-        .join(CountryPercentage)
+        .join(CountryRow, CountryRow.activity_id == Activity.iati_identifier)
         .options(
             orm.selectinload(Transaction.recipient_country_percentages),
             orm.selectinload(Transaction.recipient_region_percentages),
@@ -417,10 +410,12 @@ def transactions_by_country(args):
 
 
 def transactions_by_sector(args):
-    return _filter(
-        db.session.query(Transaction, SectorPercentage)
+    return _filter_transactions(
+        _with_split_values(
+            db.session.query(Transaction, SectorRow),
+            Transaction, SectorRow, args)
         .join(Activity, Activity.iati_identifier==Transaction.activity_id)
-        .join(SectorPercentage)
+        .join(SectorRow, SectorRow.activity_id == Activity.iati_identifier)
         .options(
             orm.selectinload(Transaction.recipient_country_percentages),
             orm.selectinload(Transaction.recipient_region_percentages),
@@ -436,17 +431,99 @@ def budgets(args):
 
 def budgets_by_country(args):
     return _filter(
-        db.session.query(Budget, CountryPercentage)
+        _with_split_values(
+            db.session.query(Budget, CountryRow), Budget, CountryRow, args)
         .join(Activity, Activity.iati_identifier==Budget.activity_id)
-        .join(CountryPercentage),
+        .join(CountryRow, CountryRow.activity_id == Activity.iati_identifier),
         args
     )
 
 
 def budgets_by_sector(args):
     return _filter(
-        db.session.query(Budget, SectorPercentage)
+        _with_split_values(
+            db.session.query(Budget, SectorRow), Budget, SectorRow, args)
         .join(Activity, Activity.iati_identifier==Budget.activity_id)
-        .join(SectorPercentage),
+        .join(SectorRow, SectorRow.activity_id == Activity.iati_identifier),
         args
     )
+
+
+# The aggregate endpoints join their own copies of the activity level
+# countries and sectors and the reporting org, so that grouping doesn't change what the filters
+# above match.
+CountryGroup = orm.aliased(CountryPercentage)
+SectorGroup = orm.aliased(SectorPercentage)
+ReportingOrgGroup = orm.aliased(Organisation)
+
+# Version 1 transaction types by the code of the same type in version 2
+V2_TRANSACTION_TYPES = {
+    v1.value: v2.value
+    for v1 in codelists.by_major_version['1'].TransactionType
+    for v2 in codelists.by_major_version['2'].TransactionType
+    if transaction_type_name(v1) == transaction_type_name(v2)
+}
+
+
+def _aggregate(query, model, date, group_by):
+    """Sums and counts of the rows of query for each combination of groups
+
+    Each group is a column of the result named after it. A row with more
+    than one recipient country or sector is counted in full under each,
+    and grouping by either also sums the values split by their
+    percentages.
+    """
+    columns = []
+    breakdowns = []
+    for group in group_by:
+        if group == 'country':
+            query = query.join(
+                CountryGroup,
+                CountryGroup.activity_id == Activity.iati_identifier)
+            column = cast(CountryGroup.country, Unicode)
+            breakdowns.append(CountryGroup)
+        elif group == 'sector':
+            query = query.join(
+                SectorGroup,
+                SectorGroup.activity_id == Activity.iati_identifier)
+            column = cast(SectorGroup.sector, Unicode)
+            breakdowns.append(SectorGroup)
+        elif group == 'year':
+            column = cast(func.extract('year', date), Integer)
+        elif group == 'type':
+            column = cast(model.type, Unicode)
+            if model is Transaction:
+                column = case(V2_TRANSACTION_TYPES, value=column, else_=column)
+        elif group == 'reporting-org':
+            query = query.outerjoin(
+                ReportingOrgGroup,
+                ReportingOrgGroup.id == Activity.reporting_org_id)
+            column = ReportingOrgGroup.ref
+        elif group == 'publisher':
+            column = Activity.publisher
+        columns.append(column.label(group))
+    sums = [
+        func.count(model.id).label('count'),
+        func.sum(model.value_usd).label('value-usd'),
+        func.sum(model.value_eur).label('value-eur'),
+    ]
+    if breakdowns:
+        _, split_usd, split_eur = split_values(model, *breakdowns)
+        sums += [
+            func.sum(split_usd).label('split-value-usd'),
+            func.sum(split_eur).label('split-value-eur'),
+        ]
+    return query.with_entities(*columns, *sums).group_by(
+        *columns).order_by(*columns)
+
+
+def transaction_aggregate(args):
+    return _aggregate(
+        _filter_transactions(
+            db.session.query(Transaction).join(Activity), args),
+        Transaction, Transaction.date, args.get('group_by', []))
+
+
+def budget_aggregate(args):
+    return _aggregate(
+        budgets(args), Budget, Budget.period_start, args.get('group_by', []))
@@ -0,0 +1,251 @@
+"""
+Bulk dumps of the access API, written after each crawl.
+
+Most of the stream=True traffic is for the same few exports: every
+activity, every transaction, or everything from one publisher or for one
+recipient country. Those are written once per crawl to gzipped files
+under DUMP_DIR, one directory per slice:
+
+    all/activity.csv.gz
+    publisher/<publisher>/transaction.csv.gz
+    recipient-country/<code>/activity.xml.gz
+
+and served as static files, with range requests, by /api/1/dumps/ or by
+the web server in front of it, so downloading them never touches
+Postgres.
+
+Each slice keeps a signature of the activities it covers: how many there
+are, when the newest was created, which changes whenever one of their
+datasets is parsed again, a digest of their datasets and publishers, and
+the exchange rates version. A slice whose signature hasn't changed since
+its files were written is skipped, so a crawl that changes a handful of
+datasets rewrites a handful of slices.
+
+The crawler queues update_dumps on DUMP_QUEUE once it has queued its
+dataset updates. Writing the dumps can take hours, so that queue needs a
+worker of its own, apart from the crawler's:
+
+    iati queue background --queue dumps
+
+For as long as any crawler job is waiting or running, update_dumps waits
+DUMP_RETRY_INTERVAL seconds and goes to the back of its queue again.
+"""
+import datetime
+import gzip
+import json
+import logging
+import os
+import shutil
+import time
+
+import sqlalchemy as sa
+from flask import current_app, jsonify, send_from_directory, url_for
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from werkzeug.datastructures import MultiDict
+from werkzeug.utils import secure_filename
+
+from iatilib import db, rq
+from iatilib.currency_conversion import RATES_VERSION
+from iatilib.model import Activity, DataVersion
+
+from . import dsfilter, exports, validators
+
+log = logging.getLogger(__name__)
+
+# The files written for each slice, and the access API URL each is the
+# whole response to
+DUMP_FILES = (
+    ('activity.csv', '/api/1/access/activity.csv'),
+    ('activity.json', '/api/1/access/activity.json'),
+    ('activity.xml', '/api/1/access/activity.xml'),
+    ('transaction.csv', '/api/1/access/transaction.csv'),
+    ('budget.csv', '/api/1/access/budget.csv'),
+)
+SUFFIX = '.gz'
+# Holds the signature a slice's files were written from
+SIGNATURE = 'signature.json'
+# Set while update_dumps is on the queue, so a crawl starting before the
+# last one's dumps are written doesn't queue them twice
+QUEUED_KEY = 'dumps:queued'
+# The jobs of a crawl, which the dumps wait for
+CRAWLER_JOBS = 'iatilib.crawler.'
+
+
+def dump_dir():
+    return current_app.config['DUMP_DIR']
+
+
+def slices():
+    """(directory, filter arguments) for each slice to dump"""
+    yield 'all', {}
+    kinds = current_app.config['DUMP_SLICES']
+    if 'publisher' in kinds:
+        publishers = db.session.query(Activity.publisher).filter(
+            Activity.publisher.isnot(None)).distinct()
+        for publisher, in publishers:
+            yield 'publisher/' + publisher, {'publisher': publisher}
+    if 'recipient-country' in kinds:
+        # The codes the recipient-country filter matches, which include
+        # those only given on an activity's transactions
+        countries = db.session.query(
+            sa.func.unnest(Activity.recipient_country_codes)).distinct()
+        for country, in countries:
+            yield ('recipient-country/' + country,
+                   {'recipient-country': country})
+
+
+def valid_directory(directory):
+    """Whether each part of a slice's directory is a safe file name"""
+    return all(
+        part and secure_filename(part) == part
+        for part in directory.split('/'))
+
+
+def signature(args):
+    """What a slice's files are written from, to tell when it changes"""
+    query = dsfilter.activities(validators.activity_api_args(MultiDict(args)))
+    # Changes when a dataset's publisher does, without it being parsed
+    dataset = (sa.func.coalesce(Activity.dataset_id, '') + ':'
+               + sa.func.coalesce(Activity.publisher, ''))
+    count, created, datasets = query.with_entities(
+        sa.func.count(Activity.iati_identifier),
+        sa.func.max(Activity.created),
+        sa.func.md5(sa.func.string_agg(
+            sa.distinct(dataset), aggregate_order_by(sa.literal(','), dataset))),
+    ).one()
+    return [
+        count,
+        created.isoformat() if created else None,
+        datasets,
+        DataVersion.current(RATES_VERSION),
+    ]
+
+
+def read_signature(directory):
+    try:
+        with open(os.path.join(directory, SIGNATURE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_dump(target, path, args):
+    """Write the gzipped response to a GET of path with args to target"""
+    level = current_app.config['STREAM_COMPRESSION_LEVELS']['gzip']
+    with gzip.open(target + exports.PART_SUFFIX, 'wb', level) as out:
+        exports.render(path, args, out)
+    os.replace(target + exports.PART_SUFFIX, target)
+
+
+def update_slice(directory, args):
+    """Rewrite a slice's files if it has changed, and say whether it had"""
+    target_dir = os.path.join(dump_dir(), directory)
+    new_signature = signature(args)
+    # Ends the read transaction, so the dumps don't hold one open
+    db.session.commit()
+    if read_signature(target_dir) == new_signature:
+        return False
+    log.info("Writing the dumps of %s", directory)
+    os.makedirs(target_dir, exist_ok=True)
+    for name, path in DUMP_FILES:
+        write_dump(os.path.join(target_dir, name + SUFFIX), path, args)
+    with open(os.path.join(target_dir, SIGNATURE), 'w') as f:
+        json.dump(new_signature, f)
+    return True
+
+
+def remove_slices(directories):
+    """Delete the dumps of slices no longer in directories"""
+    root = dump_dir()
+    for kind in os.listdir(root) if os.path.isdir(root) else []:
+        if kind == 'all':
+            continue
+        for name in os.listdir(os.path.join(root, kind)):
+            directory = kind + '/' + name
+            if directory not in directories:
+                log.info("Removing the dumps of %s", directory)
+                shutil.rmtree(os.path.join(root, directory), ignore_errors=True)
+
+
+def update_slices():
+    """Rewrite the dumps of every slice that changed, and count them"""
+    directories = set()
+    updated = 0
+    for directory, args in list(slices()):
+        if not valid_directory(directory):
+            log.warning("Not dumping %s, which isn't a safe path", directory)
+            continue
+        directories.add(directory)
+        updated += update_slice(directory, args)
+    remove_slices(directories)
+    return updated
+
+
+def queue():
+    return rq.get_queue(current_app.config['DUMP_QUEUE'])
+
+
+def enqueue():
+    """Queue update_dumps, unless it already is"""
+    if rq.connection.set(QUEUED_KEY, 1, nx=True):
+        queue().enqueue(
+            update_dumps, result_ttl=0,
+            job_timeout=current_app.config['DUMP_JOB_TIMEOUT'])
+
+
+def crawling():
+    """Whether any crawler job is waiting, deferred or running"""
+    crawler_queue = rq.get_queue()
+    job_ids = (
+        crawler_queue.started_job_registry.get_job_ids()
+        + crawler_queue.deferred_job_registry.get_job_ids()
+        + crawler_queue.get_job_ids())
+    for job_id in job_ids:
+        try:
+            job = Job.fetch(job_id, connection=rq.connection)
+        except NoSuchJobError:
+            continue
+        if job.func_name.startswith(CRAWLER_JOBS):
+            return True
+    return False
+
+
+def update_dumps():
+    """The post-crawl job: update_slices, once the crawl has finished"""
+    rq.connection.delete(QUEUED_KEY)
+    if crawling():
+        # Check again in a while, rather than straight away
+        time.sleep(current_app.config['DUMP_RETRY_INTERVAL'])
+        enqueue()
+        return
+    log.info("Updated the dumps of %d slices", update_slices())
+
+
+def index():
+    """JSON listing every dump file"""
+    root = dump_dir()
+    files = []
+    for directory, _, names in sorted(os.walk(root)):
+        for name in sorted(names):
+            if not name.endswith(SUFFIX):
+                continue
+            path = os.path.relpath(os.path.join(directory, name), root)
+            stat = os.stat(os.path.join(directory, name))
+            files.append({
+                "path": path,
+                "url": url_for(
+                    'api1.dump_download', path=path, _external=True),
+                "size": stat.st_size,
+                "updated": datetime.datetime.utcfromtimestamp(stat.st_mtime),
+            })
+    return jsonify(ok=True, dumps=files)
+
+
+def download(path):
+    if not path.endswith(SUFFIX):
+        return None
+    return send_from_directory(
+        dump_dir(), path, mimetype='application/gzip', as_attachment=True,
+        conditional=True)
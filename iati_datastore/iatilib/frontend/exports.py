@@ -0,0 +1,198 @@
+"""
+Export jobs for access API downloads too big to wait for.
+
+POSTing to an access API URL, with the same arguments as a GET, queues an
+rq job that writes everything the request matches, as stream=True
+would, to a file under EXPORT_DIR. The response points to a status URL
+to poll, which gives the download URL once the file is written.
+
+Exports are named after the request and the data version, so the same
+request again before the next crawl gets the pending or finished export
+instead of another job. Files older than EXPORT_MAX_AGE are removed by
+`iati cleanup`.
+
+The jobs go on their own queue, EXPORT_QUEUE, so that a few long exports
+can't hold up a crawl. It needs a worker of its own:
+
+    iati queue background --queue exports
+"""
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import re
+import shutil
+import time
+
+from flask import (
+    current_app, jsonify, request, send_from_directory, url_for)
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+
+from iatilib import rq
+
+from . import cache
+
+log = logging.getLogger(__name__)
+
+# Marks a file still being written
+PART_SUFFIX = '.part'
+# Marks an export whose job failed
+FAILED = 'failed'
+# What export_id makes, the only ids the export URLs accept
+EXPORT_ID = re.compile(r'^[0-9a-f]{40}$')
+
+
+def export_id():
+    """The id of the export of the current request"""
+    version, _ = cache.data_version()
+    args = sorted(
+        (name, value) for name, value in request.args.items(multi=True)
+        if name != 'ref')
+    return hashlib.sha1(json.dumps(
+        [request.path, version, args]).encode('utf-8')).hexdigest()
+
+
+def valid_id(export_id):
+    return EXPORT_ID.match(export_id) is not None
+
+
+def queue():
+    return rq.get_queue(current_app.config['EXPORT_QUEUE'])
+
+
+def export_dir(export_id):
+    return os.path.join(current_app.config['EXPORT_DIR'], export_id)
+
+
+def pending_key(export_id):
+    return 'export:{0}'.format(export_id)
+
+
+def filename(path):
+    """The file an export of the URL path is written to"""
+    name = posixpath.basename(path.rstrip('/'))
+    if '.' not in name:
+        name += '.json'
+    return name
+
+
+def export_file(export_id):
+    """The path of the finished export, or None"""
+    directory = export_dir(export_id)
+    if not os.path.isdir(directory):
+        return None
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if (name != FAILED and not name.endswith(PART_SUFFIX)
+                and os.path.isfile(path)):
+            return path
+    return None
+
+
+def status(export_id):
+    """finished, failed, an rq job status, or None for no such export"""
+    if export_file(export_id) is not None:
+        return 'finished'
+    if os.path.exists(os.path.join(export_dir(export_id), FAILED)):
+        return 'failed'
+    if not rq.connection.exists(pending_key(export_id)):
+        return None
+    try:
+        return Job.fetch(export_id, connection=rq.connection).get_status()
+    except NoSuchJobError:
+        return 'queued'
+
+
+def enqueue():
+    """Queue an export of the current request, unless there already is one"""
+    export = export_id()
+    state = status(export)
+    if state in (None, 'failed'):
+        timeout = current_app.config['EXPORT_JOB_TIMEOUT']
+        # Only the first of simultaneous identical requests gets a job
+        if rq.connection.set(pending_key(export), 1, nx=True, ex=timeout):
+            shutil.rmtree(export_dir(export), ignore_errors=True)
+            queue().enqueue(
+                run_export,
+                args=(export, request.path, request.args.to_dict(flat=False)),
+                job_id=export, result_ttl=0, job_timeout=timeout)
+        state = 'queued'
+    response = status_response(export, state)
+    response.status_code = 200 if state == 'finished' else 202
+    response.headers['Location'] = url_for(
+        'api1.export_status', export_id=export, _external=True)
+    return response
+
+
+def status_response(export_id, state):
+    data = {
+        "ok": state != 'failed',
+        "id": export_id,
+        "status": state,
+        "status-url": url_for(
+            'api1.export_status', export_id=export_id, _external=True),
+    }
+    if state == 'finished':
+        data["download-url"] = url_for(
+            'api1.export_download', export_id=export_id, _external=True)
+    return jsonify(data)
+
+
+def run_export(export_id, path, args):
+    """Write the whole response to the GET of path with args to a file"""
+    directory = export_dir(export_id)
+    os.makedirs(directory, exist_ok=True)
+    target = os.path.join(directory, filename(path))
+    try:
+        with open(target + PART_SUFFIX, 'wb') as out:
+            render(path, args, out)
+        os.rename(target + PART_SUFFIX, target)
+    except Exception:
+        open(os.path.join(directory, FAILED), 'w').close()
+        raise
+    finally:
+        rq.connection.delete(pending_key(export_id))
+
+
+def render(path, args, out):
+    """Write the whole response to a GET of path with args to the file out"""
+    with current_app.test_request_context(path, query_string=args):
+        view = current_app.view_functions[request.endpoint].view_class()
+        view.export_to = out
+        view.dispatch_request(**request.view_args)
+
+
+def write(body, out):
+    """Write a serializer's output to the file out"""
+    if isinstance(body, dict):
+        # From a file_mode serializer such as XLSX
+        shutil.copyfileobj(body['file'], out)
+        return
+    for chunk in body:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        out.write(chunk)
+
+
+def download(export_id):
+    path = export_file(export_id)
+    if path is None:
+        return None
+    return send_from_directory(
+        export_dir(export_id), os.path.basename(path), as_attachment=True,
+        conditional=True)
+
+
+def remove_old_exports():
+    """Delete the exports older than EXPORT_MAX_AGE"""
+    root = current_app.config['EXPORT_DIR']
+    if not os.path.isdir(root):
+        return
+    oldest = time.time() - current_app.config['EXPORT_MAX_AGE']
+    for name in os.listdir(root):
+        directory = os.path.join(root, name)
+        if os.path.getmtime(directory) < oldest:
+            log.info("Removing old export %s", name)
+            shutil.rmtree(directory, ignore_errors=True)
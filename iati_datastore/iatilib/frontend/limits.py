@@ -0,0 +1,76 @@
+"""
+Limits on the queries behind the access API.
+
+A few filter combinations, mostly streamed breakdowns, run for long
+enough to hold up every uwsgi process. Each endpoint has a statement
+timeout and a limit on the planner's cost of its query, so that those
+requests are turned away instead. Both are looked up by endpoint name,
+falling back to the None entry:
+
+    STATEMENT_TIMEOUTS = {None: 300000, 'api1.transaction_by_sector': 60000}
+    QUERY_COST_LIMITS = {None: 5e7, 'api1.transaction_by_sector': 1e7}
+
+Only the cost limit protects stream=True responses. A stream is read
+through a server-side cursor, and statement_timeout then applies to each
+FETCH of 100 rows rather than to the whole export, so a long stream is
+never cut off. A FETCH that does time out does so after the response
+has started, which truncates the body instead of giving the 400 page.
+"""
+import logging
+
+import sqlalchemy as sa
+from flask import current_app, request
+from psycopg2.errors import QueryCanceled
+
+from iatilib import db
+
+from . import counts
+
+log = logging.getLogger(__name__)
+
+
+class QueryRejected(Exception):
+    pass
+
+
+def endpoint_setting(name):
+    settings = current_app.config[name]
+    return settings.get(request.endpoint, settings.get(None))
+
+
+def set_statement_timeout():
+    """Limit each statement for the rest of the request's transaction
+
+    For a stream, that is each fetch from its cursor. See above.
+    """
+    timeout = endpoint_setting('STATEMENT_TIMEOUTS')
+    if timeout is not None:
+        db.session.execute(
+            sa.text("SELECT set_config('statement_timeout', :timeout, true)"),
+            {"timeout": str(timeout)})
+
+
+def cost_limit():
+    return endpoint_setting('QUERY_COST_LIMITS')
+
+
+def check_cost(query):
+    """Raise QueryRejected if the planner expects query to cost too much"""
+    limit = cost_limit()
+    if limit is None:
+        return
+    cost = counts.query_plan(query)['Total Cost']
+    if cost > limit:
+        raise QueryRejected(
+            u"The query would cost {0:.0f}, over the limit of {1:.0f} for "
+            u"this endpoint".format(cost, limit))
+
+
+def timed_out(error):
+    return isinstance(getattr(error, 'orig', None), QueryCanceled)
+
+
+def log_rejection(reason):
+    log.warning(
+        "Rejected %s with %r: %s",
+        request.endpoint, request.args.to_dict(flat=False), reason)
@@ -9,24 +9,32 @@ from .csv import (
     xlsx, xlsx_activity_by_country, xlsx_activity_by_sector,
     transaction_xlsx, xlsx_transaction_by_country, xlsx_transaction_by_sector,
     budget_xlsx, xlsx_budget_by_country, xlsx_budget_by_sector,
+    csv_transaction_by_country_split, csv_transaction_by_sector_split,
+    csv_budget_by_country_split, csv_budget_by_sector_split,
+    xlsx_transaction_by_country_split, xlsx_transaction_by_sector_split,
+    xlsx_budget_by_country_split, xlsx_budget_by_sector_split,
+    aggregate_csv,
 )
-from .jsonserializer import json, datastore_json
+from .jsonserializer import json, datastore_json, aggregate_json
 
 
 def xml(pagination, wrapped=True):
     generated_datetime = datetime.now().isoformat()
     if wrapped:
+        total = pagination.total
         yield """<result xmlns:iati-extra="https://datastore.codeforiati.org/ns">
       <ok>True</ok>
       <iati-activities generated-datetime="{generated_datetime}">
-        <query>
-          <total-count>{total}</total-count>
+        <query>{total}
           <start>{offset}</start>
           <limit>{limit}</limit>
+          <next-cursor>{next_cursor}</next-cursor>
         </query>""".format(
-        total=pagination.total,
+        total="" if total is None else """
+          <total-count>{0}</total-count>""".format(total),
         offset=pagination.offset,
         limit=pagination.limit,
+        next_cursor=pagination.next_cursor or "",
         generated_datetime=generated_datetime)
     else:
         yield """<iati-activities xmlns:iati-extra="https://datastore.codeforiati.org/ns" generated-datetime="{generated_datetime}">""".format(
@@ -681,17 +681,66 @@ def adapt_activity(func):
 
 def adapt_activity_other(func):
     """
-    Adapt an accessor for an activity to accept (Activity, other)
+    Adapt an accessor for an activity to accept (Activity, other, ...)
 
     other is Country or Sector, but that param is ignored anyway.
     """
     # can't use functools.wraps on attrgetter
     def wrapper(args):
-        a, c = args
-        return func(a)
+        return func(args[0])
     return wrapper
 
 
+def stored_currency(row):
+    totals = row.ActivityTotal
+    if totals is None:
+        return ""
+    if totals.mixed_currency:
+        return "!Mixed currency"
+    return totals.currency.value if totals.currency else ""
+
+
+def stored_total(column):
+    """Accessor for a total from the row's ActivityTotal"""
+    def accessor(row):
+        totals = row.ActivityTotal
+        if totals is None:
+            return 0
+        value = getattr(totals, column)
+        if value is None:
+            return "!Mixed currency"
+        return value
+    return accessor
+
+
+# The currency and totals of the by_country and by_sector rows, which
+# come with the activity's ActivityTotal rather than its transactions
+_activity_total_fields = (
+    (u"currency", stored_currency),
+    (u'total-Commitment', stored_total("commitment")),
+    (u"total-Disbursement", stored_total("disbursement")),
+    (u"total-Expenditure", stored_total("expenditure")),
+    (u"total-Incoming Funds", stored_total("incoming_funds")),
+    (u"total-Interest Repayment", stored_total("interest_repayment")),
+    (u"total-Loan Repayment", stored_total("loan_repayment")),
+    (u"total-Reimbursement", stored_total("reimbursement")),
+    (u'total-Commitment-USD', stored_total("commitment_usd")),
+    (u"total-Disbursement-USD", stored_total("disbursement_usd")),
+    (u"total-Expenditure-USD", stored_total("expenditure_usd")),
+    (u"total-Incoming Funds-USD", stored_total("incoming_funds_usd")),
+    (u"total-Interest Repayment-USD", stored_total("interest_repayment_usd")),
+    (u"total-Loan Repayment-USD", stored_total("loan_repayment_usd")),
+    (u"total-Reimbursement-USD", stored_total("reimbursement_usd")),
+    (u'total-Commitment-EUR', stored_total("commitment_eur")),
+    (u"total-Disbursement-EUR", stored_total("disbursement_eur")),
+    (u"total-Expenditure-EUR", stored_total("expenditure_eur")),
+    (u"total-Incoming Funds-EUR", stored_total("incoming_funds_eur")),
+    (u"total-Interest Repayment-EUR", stored_total("interest_repayment_eur")),
+    (u"total-Loan Repayment-EUR", stored_total("loan_repayment_eur")),
+    (u"total-Reimbursement-EUR", stored_total("reimbursement_eur")),
+)
+
+
 _activity_by_country_fields = (
     ("recipient-country-code", lambda r: r.CountryPercentage.country.value if r.CountryPercentage.country is not None else ""),
     ("recipient-country", lambda r: r.CountryPercentage.country.description.title() if r.CountryPercentage.country and r.CountryPercentage.country.description is not None else ""),
@@ -744,29 +793,7 @@ _activity_by_country_fields = (
     u"default-flow-type-code",
     u"default-aid-type-code",
     u"default-tied-status-code",
-    u"currency",
-    u'total-Commitment',
-    u"total-Disbursement",
-    u"total-Expenditure",
-    u"total-Incoming Funds",
-    u"total-Interest Repayment",
-    u"total-Loan Repayment",
-    u"total-Reimbursement",
-    u'total-Commitment-USD',
-    u"total-Disbursement-USD",
-    u"total-Expenditure-USD",
-    u"total-Incoming Funds-USD",
-    u"total-Interest Repayment-USD",
-    u"total-Loan Repayment-USD",
-    u"total-Reimbursement-USD",
-    u'total-Commitment-EUR',
-    u"total-Disbursement-EUR",
-    u"total-Expenditure-EUR",
-    u"total-Incoming Funds-EUR",
-    u"total-Interest Repayment-EUR",
-    u"total-Loan Repayment-EUR",
-    u"total-Reimbursement-EUR",
-)
+) + _activity_total_fields
 
 csv_activity_by_country = CSVSerializer(_activity_by_country_fields, adapter=adapt_activity_other)
 
@@ -821,29 +848,7 @@ _activity_by_sector_fields = (
     u"default-flow-type-code",
     u"default-aid-type-code",
     u"default-tied-status-code",
-    u"currency",
-    u'total-Commitment',
-    u"total-Disbursement",
-    u"total-Expenditure",
-    u"total-Incoming Funds",
-    u"total-Interest Repayment",
-    u"total-Loan Repayment",
-    u"total-Reimbursement",
-    u'total-Commitment-USD',
-    u"total-Disbursement-USD",
-    u"total-Expenditure-USD",
-    u"total-Incoming Funds-USD",
-    u"total-Interest Repayment-USD",
-    u"total-Loan Repayment-USD",
-    u"total-Reimbursement-USD",
-    u'total-Commitment-EUR',
-    u"total-Disbursement-EUR",
-    u"total-Expenditure-EUR",
-    u"total-Incoming Funds-EUR",
-    u"total-Interest Repayment-EUR",
-    u"total-Loan Repayment-EUR",
-    u"total-Reimbursement-EUR",
-)
+) + _activity_total_fields
 
 csv_activity_by_sector = CSVSerializer(_activity_by_sector_fields, adapter=adapt_activity_other)
 
@@ -941,20 +946,24 @@ transaction_csv = CSVSerializer(_transaction_fields, adapter=adapt_activity)
 transaction_xlsx = XLSXSerializer(_transaction_fields, adapter=adapt_activity, client_filename='transactions.xlsx')
 
 
+# The by_* rows are (transaction or budget, breakdown row), followed by
+# the split values when they are asked for
 def trans(func):
     def wrapper(args):
-        t, c = args
-        return func(t)
+        return func(args[0])
     return wrapper
 
 
 def trans_activity(func):
     def wrapper(args):
-        t, c = args
-        return func(t.activity)
+        return func(args[0].activity)
     return wrapper
 
 
+def split_value(column):
+    return lambda r: getattr(r, column)
+
+
 _transaction_by_country_fields = (
     (u"recipient-country-code", lambda r: r.CountryPercentage.country.value if r.CountryPercentage.country is not None else ""),
     (u"recipient-country", lambda r: r.CountryPercentage.country.description.title() if (r.CountryPercentage.country is not None and r.CountryPercentage.country.description is not None) else ""),
@@ -1012,10 +1021,20 @@ _transaction_by_country_fields = (
      u"default-tied-status-code",
      )
 
+_split_transaction_fields = (
+    (u"transaction-value-split", split_value("split_value")),
+    (u"transaction-value-USD-split", split_value("split_value_usd")),
+    (u"transaction-value-EUR-split", split_value("split_value_eur")),
+)
+
 csv_transaction_by_country = CSVSerializer(_transaction_by_country_fields, adapter=trans_activity)
 
 xlsx_transaction_by_country = XLSXSerializer(_transaction_by_country_fields, adapter=trans_activity, client_filename='transactions_by_country.xlsx')
 
+csv_transaction_by_country_split = CSVSerializer(_transaction_by_country_fields + _split_transaction_fields, adapter=trans_activity)
+
+xlsx_transaction_by_country_split = XLSXSerializer(_transaction_by_country_fields + _split_transaction_fields, adapter=trans_activity, client_filename='transactions_by_country.xlsx')
+
 
 _transaction_by_sector_fields = (
     (u"sector-code", lambda r: r.SectorPercentage.sector.value if r.SectorPercentage.sector is not None else ""),
@@ -1079,6 +1098,10 @@ csv_transaction_by_sector = CSVSerializer(_transaction_by_sector_fields, adapter
 
 xlsx_transaction_by_sector = XLSXSerializer(_transaction_by_sector_fields, adapter=trans_activity, client_filename='transactions_by_sector.xlsx')
 
+csv_transaction_by_sector_split = CSVSerializer(_transaction_by_sector_fields + _split_transaction_fields, adapter=trans_activity)
+
+xlsx_transaction_by_sector_split = XLSXSerializer(_transaction_by_sector_fields + _split_transaction_fields, adapter=trans_activity, client_filename='transactions_by_sector.xlsx')
+
 _budget_fields = (
     (u'budget-period-start-date', period_start_date),
     (u'budget-period-end-date', period_end_date),
@@ -1119,10 +1142,20 @@ _budget_by_country_fields = (
     u"sector-percentage",
 )
 
+_split_budget_fields = (
+    (u"budget-value-split", split_value("split_value")),
+    (u"budget-value-USD-split", split_value("split_value_usd")),
+    (u"budget-value-EUR-split", split_value("split_value_eur")),
+)
+
 csv_budget_by_country = CSVSerializer(_budget_by_country_fields, adapter=trans_activity)
 
 xlsx_budget_by_country = XLSXSerializer(_budget_by_country_fields, adapter=trans_activity, client_filename='budgets_by_country.xlsx')
 
+csv_budget_by_country_split = CSVSerializer(_budget_by_country_fields + _split_budget_fields, adapter=trans_activity)
+
+xlsx_budget_by_country_split = XLSXSerializer(_budget_by_country_fields + _split_budget_fields, adapter=trans_activity, client_filename='budgets_by_country.xlsx')
+
 
 _budget_by_sector_fields = (
     (u"sector-code", lambda r: r.SectorPercentage.sector.value if r.SectorPercentage.sector is not None else ""),
@@ -1143,3 +1176,21 @@ csv_budget_by_sector = CSVSerializer(_budget_by_sector_fields, adapter=trans_act
 
 xlsx_budget_by_sector = XLSXSerializer(_budget_by_sector_fields, adapter=trans_activity, client_filename='budgets_by_sector.xlsx')
 
+csv_budget_by_sector_split = CSVSerializer(_budget_by_sector_fields + _split_budget_fields, adapter=trans_activity)
+
+xlsx_budget_by_sector_split = XLSXSerializer(_budget_by_sector_fields + _split_budget_fields, adapter=trans_activity, client_filename='budgets_by_sector.xlsx')
+
+
+
+def aggregate_csv(query, wrapped=True):
+    """
+    Return a generator of lines of csv, one for each group of the query
+    """
+    def line(row):
+        out = StringIO()
+        writer = unicodecsv.writer(out)
+        writer.writerow(row)
+        return out.getvalue()
+    yield line([column['name'] for column in query.column_descriptions])
+    for row in query:
+        yield line(row)
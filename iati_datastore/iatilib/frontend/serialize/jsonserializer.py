@@ -134,13 +134,14 @@ class JSONSerializer:
     def __call__(self, pagination, wrapped=True):
         yield '{'
         if wrapped:
-            yield jsonlib.dumps(
-                OrderedDict((
-                    ("ok", True),
-                    ("total-count", pagination.total),
-                    ("start", pagination.offset),
-                    ("limit", pagination.limit),
-                )))[1:-1] + ', '
+            query = OrderedDict((("ok", True),))
+            total = pagination.total
+            if total is not None:
+                query["total-count"] = total
+            query["start"] = pagination.offset
+            query["limit"] = pagination.limit
+            query["next-cursor"] = pagination.next_cursor
+            yield jsonlib.dumps(query)[1:-1] + ', '
         yield '"iati-activities": ['
         first = True
         for i in pagination.items:
@@ -154,3 +155,10 @@ class JSONSerializer:
 
 json = JSONSerializer(JSONEncoder)
 datastore_json = JSONSerializer(DatastoreJSONEncoder)
+
+
+def aggregate_json(query, wrapped=True):
+    results = [OrderedDict(row._mapping) for row in query]
+    if wrapped:
+        results = OrderedDict((("ok", True), ("results", results)))
+    yield jsonlib.dumps(results, cls=JSONEncoder)
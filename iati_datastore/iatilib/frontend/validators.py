@@ -1,4 +1,6 @@
+import base64
 import datetime
+import json
 from functools import partial
 
 import voluptuous as v
@@ -14,6 +16,29 @@ def apidate(value):
         raise Invalid(u"Date must be in the form yyyy-mm-dd")
 
 
+def cursor(value):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(
+            (value + '=' * (-len(value) % 4)).encode('ascii')))
+    except ValueError:
+        values = None
+    if not isinstance(values, list):
+        raise Invalid(u"Cursor must be a next-cursor returned by the datastore")
+    return values
+
+
+def cursor_matches(values, keyset):
+    """Whether each of a cursor's values is of its keyset column's type"""
+    return all(
+        type(value) is column.type.python_type
+        for value, column in zip(values, keyset))
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(
+        json.dumps(values).encode('utf-8')).decode('ascii').rstrip('=')
+
+
 def codelist_validator(Codelist, value):
     codes = []
     for i in value.split('|'):
@@ -21,6 +46,50 @@ def codelist_validator(Codelist, value):
     return codes
 
 
+# Transaction types renamed in version 2 of the codelist
+RENAMED_TRANSACTION_TYPES = {
+    'outgoing_commitment': 'commitment',
+    'interest_payment': 'interest_repayment',
+}
+
+
+def transaction_type_name(symbol):
+    return RENAMED_TRANSACTION_TYPES.get(symbol.name, symbol.name)
+
+
+def transaction_type(value):
+    """The stored codes of the types in value, from either codelist version"""
+    versions = codelists.by_major_version.values()
+    codes = []
+    for code in value.split('|'):
+        names = set(
+            transaction_type_name(version.TransactionType.from_string(code))
+            for version in versions) - {None}
+        if not names:
+            raise Invalid(u"Unknown transaction type {0}".format(code))
+        codes.extend(
+            symbol.value
+            for version in versions
+            for symbol in version.TransactionType
+            if transaction_type_name(symbol) in names)
+    return codes
+
+
+# The columns the aggregate endpoints can group by
+AGGREGATE_GROUPS = (
+    'country', 'sector', 'year', 'type', 'reporting-org', 'publisher')
+
+
+def group_by(value):
+    groups = value.split('|')
+    for group in groups:
+        if group not in AGGREGATE_GROUPS:
+            raise Invalid(u"Can't group by {0}".format(group))
+    if len(set(groups)) != len(groups):
+        raise Invalid(u"Groups must not be repeated")
+    return groups
+
+
 organisation_role = partial(codelist_validator, codelists.OrganisationRole)
 recipient_country = partial(codelist_validator, codelists.Country)
 recipient_region = partial(codelist_validator, codelists.Region)
@@ -39,6 +108,10 @@ activity_api_schema = {
     "date": apidate,
     "stream": v.All(v.Coerce(bool)),
     "unwrap": v.All(v.Coerce(bool)),
+    "count": v.Any("estimate", "exact", "none"),
+    "after": cursor,
+    "same-row": v.All(v.Coerce(bool)),
+    "split": v.All(v.Coerce(bool)),
     'iati-identifier': v.All(v.Coerce(str)),
     'activity-status': v.All(v.Coerce(str)),
     'title': v.All(v.Coerce(str)),
@@ -62,6 +135,7 @@ activity_api_schema = {
     'participating-org': v.All(v.Coerce(str)),
     'participating-org.ref': v.All(v.Coerce(str)),
     'participating-org.text': v.All(v.Coerce(str)),
+    'participating-org.type': v.All(v.Coerce(str), reporting_org_type),
     'participating-org.role': organisation_role,
     'related-activity': v.All(v.Coerce(str)),
     'related-activity.ref': v.All(v.Coerce(str)),
@@ -86,6 +160,14 @@ activity_api_schema = {
     'last-updated-datetime__gt': apidate,
     'last-updated-datetime__lt': apidate,
     'registry-dataset': v.All(v.Coerce(str)),
+    'transaction-date__gt': apidate,
+    'transaction-date__lt': apidate,
+    'transaction-type': v.All(v.Coerce(str), transaction_type),
+    'value-usd__gt': v.Coerce(float),
+    'value-usd__lt': v.Coerce(float),
+    'transaction_recipient-country': v.All(v.Coerce(str), recipient_country),
+    'transaction_sector': v.All(v.Coerce(str), sector),
+    'publisher': v.All(v.Coerce(str)),
     'participating-org-role-1': v.All(v.Coerce(str)),
     'participating-org-role-1.ref': v.All(v.Coerce(str)),
     'participating-org-role-1.text': v.All(v.Coerce(str)),
@@ -105,6 +187,11 @@ activity_api_schema = {
 }
 activity_api_args = v.Schema({**pagination_schema, **activity_api_schema})
 
+aggregate_api_schema = {
+    "group_by": v.All(v.Coerce(str), group_by),
+}
+aggregate_api_args = v.Schema({**activity_api_schema, **aggregate_api_schema})
+
 about_dataset_schema = {
     "detail": v.All(v.Coerce(bool)),
 }
@@ -6,6 +6,7 @@ import sqlalchemy as sa
 from sqlalchemy import event
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.declarative import declared_attr
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.dialects.postgresql import JSONB
 
 from . import codelists, db
@@ -116,6 +117,10 @@ class Activity(db.Model):
             sa.ForeignKey("resource.url", ondelete='CASCADE'),
             index=True,
             nullable=True)
+    # Copies of the resource's dataset name and publisher, set at ingest,
+    # so the registry-dataset and publisher filters need no joins
+    dataset_id = sa.Column(sa.Unicode, index=True, nullable=True)
+    publisher = sa.Column(sa.Unicode, index=True, nullable=True)
     reporting_org_id = sa.Column(
             sa.ForeignKey("organisation.id"),
             nullable=True,
@@ -124,6 +129,16 @@ class Activity(db.Model):
     start_actual = sa.Column(sa.Date, nullable=True)
     end_planned = sa.Column(sa.Date, nullable=True)
     end_actual = sa.Column(sa.Date, nullable=True)
+    # The actual date where there is one, else the planned date, stored
+    # so the start-date and end-date filters can use an index
+    start_effective = sa.Column(
+            sa.Date,
+            sa.Computed("COALESCE(start_actual, start_planned)"),
+            index=True)
+    end_effective = sa.Column(
+            sa.Date,
+            sa.Computed("COALESCE(end_actual, end_planned)"),
+            index=True)
     title = sa.Column(sa.Unicode, default=u"", nullable=False)
     # Collect multiple title values. Key is lang attribute.
     title_all_values = sa.Column(JSONB, nullable=True)
@@ -191,6 +206,109 @@ class Activity(db.Model):
     default_flow_type = sa.Column(codelists.FlowType.db_type())
     default_aid_type = sa.Column(codelists.AidType.db_type())
     default_tied_status = sa.Column(codelists.TiedStatus.db_type())
+    # Codes gathered from the activity's child rows - and for countries,
+    # regions and sectors from its transactions too - so that a filter
+    # on them is one GIN index probe. Participating orgs are stored both
+    # as plain refs and as "role:ref". Kept current by
+    # refresh_activity_facets below.
+    recipient_country_codes = sa.orm.deferred(sa.Column(
+            postgresql.ARRAY(sa.UnicodeText), nullable=True))
+    recipient_region_codes = sa.orm.deferred(sa.Column(
+            postgresql.ARRAY(sa.UnicodeText), nullable=True))
+    sector_codes = sa.orm.deferred(sa.Column(
+            postgresql.ARRAY(sa.UnicodeText), nullable=True))
+    participating_org_refs = sa.orm.deferred(sa.Column(
+            postgresql.ARRAY(sa.UnicodeText), nullable=True))
+    participating_org_role_refs = sa.orm.deferred(sa.Column(
+            postgresql.ARRAY(sa.UnicodeText), nullable=True))
+    policy_marker_codes = sa.orm.deferred(sa.Column(
+            postgresql.ARRAY(sa.UnicodeText), nullable=True))
+    # Every title and description value, one per line, so the title and
+    # description filters can be checked against a trigram index before
+    # looking inside the JSONB. The indexes need pg_trgm, so they only
+    # exist in migrations/versions/9d2f7b3e5c18_add_activity_search_columns.py
+    title_search = sa.orm.deferred(sa.Column(sa.UnicodeText, nullable=True))
+    description_search = sa.orm.deferred(sa.Column(
+            sa.UnicodeText, nullable=True))
+    __table_args__ = tuple(
+        sa.Index('ix_activity_' + column, column, postgresql_using='gin')
+        for column in (
+            'recipient_country_codes',
+            'recipient_region_codes',
+            'sector_codes',
+            'participating_org_refs',
+            'participating_org_role_refs',
+            'policy_marker_codes',
+        )
+    )
+
+
+class ActivityFacet(db.Model):
+    # A flattened copy of the values activities are most often filtered
+    # on, including those only found on transactions, so that a filter
+    # is one indexed lookup instead of a chain of EXISTS subqueries.
+    # Rows are kept in step with the source tables on every flush - see
+    # refresh_activity_facets below.
+    __tablename__ = "activity_facet"
+    facet = sa.Column(sa.Unicode, primary_key=True, nullable=False)
+    value = sa.Column(sa.Unicode, primary_key=True, nullable=False)
+    activity_id = sa.Column(
+            act_ForeignKey("activity.iati_identifier"),
+            primary_key=True,
+            nullable=False,
+            index=True)
+
+
+# The transaction types the activity CSVs total, as the ActivityTotal
+# column and the Activity attribute listing those transactions
+TRANSACTION_TOTALS = (
+    ('commitment', 'commitments'),
+    ('disbursement', 'disbursements'),
+    ('expenditure', 'expenditures'),
+    ('incoming_funds', 'incoming_funds'),
+    ('interest_repayment', 'interest_repayment'),
+    ('loan_repayment', 'loan_repayments'),
+    ('reimbursement', 'reembursements'),
+)
+
+
+class ActivityTotal(db.Model):
+    # The sums of an activity's transactions by type, in their own
+    # currency, in USD and in EUR, which the activity by_country and
+    # by_sector CSVs report on each of an activity's rows. Activities
+    # without transactions have no row. The row is rebuilt with the
+    # facets on every flush - see refresh_activity_facets below.
+    __tablename__ = "activity_total"
+    activity_id = sa.Column(
+            act_ForeignKey("activity.iati_identifier"),
+            primary_key=True,
+            nullable=False)
+    # The currency of all the transactions, or None if there are several
+    currency = sa.Column(codelists.Currency.db_type(), nullable=True)
+    mixed_currency = sa.Column(sa.Boolean, nullable=False)
+    # Each total in the transactions' own currency is None if they are in
+    # more than one
+    commitment = sa.Column(sa.Numeric, nullable=True)
+    commitment_usd = sa.Column(sa.Numeric, nullable=False)
+    commitment_eur = sa.Column(sa.Numeric, nullable=False)
+    disbursement = sa.Column(sa.Numeric, nullable=True)
+    disbursement_usd = sa.Column(sa.Numeric, nullable=False)
+    disbursement_eur = sa.Column(sa.Numeric, nullable=False)
+    expenditure = sa.Column(sa.Numeric, nullable=True)
+    expenditure_usd = sa.Column(sa.Numeric, nullable=False)
+    expenditure_eur = sa.Column(sa.Numeric, nullable=False)
+    incoming_funds = sa.Column(sa.Numeric, nullable=True)
+    incoming_funds_usd = sa.Column(sa.Numeric, nullable=False)
+    incoming_funds_eur = sa.Column(sa.Numeric, nullable=False)
+    interest_repayment = sa.Column(sa.Numeric, nullable=True)
+    interest_repayment_usd = sa.Column(sa.Numeric, nullable=False)
+    interest_repayment_eur = sa.Column(sa.Numeric, nullable=False)
+    loan_repayment = sa.Column(sa.Numeric, nullable=True)
+    loan_repayment_usd = sa.Column(sa.Numeric, nullable=False)
+    loan_repayment_eur = sa.Column(sa.Numeric, nullable=False)
+    reimbursement = sa.Column(sa.Numeric, nullable=True)
+    reimbursement_usd = sa.Column(sa.Numeric, nullable=False)
+    reimbursement_eur = sa.Column(sa.Numeric, nullable=False)
 
 
 class DeletedActivity(db.Model):
@@ -260,6 +378,11 @@ class PercentageMixin(object):
 class CountryPercentage(db.Model, PercentageMixin):
     __tablename__ = "country_percentage"
     country = sa.Column(codelists.Country.db_type(), index=True)
+    # For the transaction_recipient-country filter
+    __table_args__ = (
+        sa.Index('ix_country_percentage_country_transaction_id',
+                 'country', 'transaction_id'),
+    )
 
 
 class RegionPercentage(db.Model, PercentageMixin):
@@ -355,6 +478,15 @@ class Transaction(db.Model):
     recipient_region_percentages = act_relationship("RegionPercentage")
     sector_percentages = act_relationship("SectorPercentage")
 
+    # The transaction endpoints page through (activity_id, id), and
+    # filter on type, date and value_usd
+    __table_args__ = (
+        sa.Index('ix_transaction_activity_id_id', 'activity_id', 'id'),
+        sa.Index('ix_transaction_type_date', 'type', 'date'),
+        sa.Index('ix_transaction_date', 'date'),
+        sa.Index('ix_transaction_value_usd', 'value_usd'),
+    )
+
     def __repr__(self):
         return u"Transaction(id=%r)" % self.id
 
@@ -381,6 +513,11 @@ class SectorPercentage(db.Model):
             nullable=False)
     percentage = sa.Column(sa.Numeric, nullable=True)
     activity = sa.orm.relationship("Activity")
+    # For the transaction_sector filter
+    __table_args__ = (
+        sa.Index('ix_sector_percentage_sector_transaction_id',
+                 'sector', 'transaction_id'),
+    )
 
 
 class Budget(db.Model):
@@ -398,6 +535,8 @@ class Budget(db.Model):
     value_usd = sa.Column(sa.Numeric(), nullable=True)
     value_eur = sa.Column(sa.Numeric(), nullable=True)
     activity = sa.orm.relationship("Activity")
+    # The budget endpoints page through (activity_id, id)
+    __table_args__ = (sa.Index('ix_budget_activity_id_id', 'activity_id', 'id'),)
 
 
 class Dataset(db.Model):
@@ -447,8 +586,9 @@ class CurrencyConversion(db.Model):
     currency = sa.Column(sa.String)
     frequency = sa.Column(sa.String)
     source = sa.Column(sa.String)
-    country_code = sa.Column(sa.String)
+    country_code = sa.Column(sa.String, nullable=False, server_default='')
     country = sa.Column(sa.String)
+    __table_args__ = (sa.UniqueConstraint('currency', 'date', 'frequency', 'country_code'),)
 
 class Log(db.Model):
     # A table to use like a logfile. Personally I don't like doing this but
@@ -491,6 +631,285 @@ class Stats(db.Model):
         nullable=False)
 
 
+class DataVersion(db.Model):
+    # A version counter for data that gets cached outside of the
+    # database. Whatever changes the data bumps its row, so anything
+    # holding a copy only has to compare one integer to know whether
+    # it is stale.
+    __tablename__ = 'data_version'
+    label = sa.Column(
+        sa.Unicode, primary_key=True,
+        nullable=False)
+    version = sa.Column(
+        sa.Integer,
+        nullable=False,
+        default=0)
+    updated = sa.Column(
+        sa.DateTime(timezone=True),
+        nullable=False,
+        default=sa.func.now())
+
+    @classmethod
+    def current(cls, label):
+        with db.session.no_autoflush:
+            version = db.session.query(cls.version).filter_by(
+                label=label).scalar()
+        return version or 0
+
+    @classmethod
+    def bump(cls, label):
+        stmt = postgresql.insert(cls.__table__).values(
+            label=label, version=1, updated=sa.func.now())
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[cls.__table__.c.label],
+            set_={
+                'version': cls.__table__.c.version + 1,
+                'updated': sa.func.now(),
+            })
+        db.session.execute(stmt)
+
+
+def _facet_sources(activity_ids):
+    """Selects producing (activity_id, facet, value) rows for activities"""
+    transaction = Transaction.__table__
+    organisation = Organisation.__table__
+    participation = Participation.__table__
+
+    def percentages(facet, table, column):
+        # Both the activity's own percentages and those on its transactions
+        yield sa.select(
+            table.c.activity_id,
+            sa.literal(facet, sa.Unicode),
+            column,
+        ).where(table.c.activity_id.in_(activity_ids), column != None)
+        yield sa.select(
+            transaction.c.activity_id,
+            sa.literal(facet, sa.Unicode),
+            column,
+        ).select_from(
+            table.join(transaction, table.c.transaction_id == transaction.c.id)
+        ).where(transaction.c.activity_id.in_(activity_ids), column != None)
+
+    def organisations(facet, activity_column, org_column, column):
+        yield sa.select(
+            activity_column,
+            sa.literal(facet, sa.Unicode),
+            column,
+        ).select_from(
+            activity_column.table.join(
+                organisation, org_column == organisation.c.id)
+        ).where(activity_column.in_(activity_ids), column != None)
+
+    country = CountryPercentage.__table__
+    region = RegionPercentage.__table__
+    sector = SectorPercentage.__table__
+    yield from percentages('recipient-country.text', country, country.c.name)
+    yield from percentages('recipient-region.text', region, region.c.name)
+    yield from percentages('sector.text', sector, sector.c.text)
+    yield from organisations(
+        'participating-org.text',
+        participation.c.activity_identifier,
+        participation.c.organisation_id,
+        organisation.c.name)
+    for role in ('provider', 'receiver'):
+        for suffix, column in (('', organisation.c.ref),
+                               ('.text', organisation.c.name)):
+            yield from organisations(
+                'transaction_{}-org{}'.format(role, suffix),
+                transaction.c.activity_id,
+                transaction.c['{}_org_id'.format(role)],
+                column)
+
+
+def _derived_columns():
+    """Correlated subqueries for the Activity filter columns"""
+    activity = Activity.__table__
+    transaction = Transaction.__table__
+    organisation = Organisation.__table__
+    participation = Participation.__table__
+    policy_marker = PolicyMarker.__table__
+    resource = Resource.__table__
+    dataset = Dataset.__table__
+
+    def from_resource(column, current):
+        # Activities with no resource keep the value they were given
+        return sa.func.coalesce(
+            sa.select(column).select_from(
+                resource.outerjoin(
+                    dataset, dataset.c.name == resource.c.dataset_id)
+            ).where(
+                resource.c.url == activity.c.resource_url
+            ).scalar_subquery(),
+            current)
+
+    def percentages(table, column):
+        return sa.func.array(sa.union(
+            sa.select(column).where(
+                table.c.activity_id == activity.c.iati_identifier,
+                column != None),
+            sa.select(column).select_from(
+                table.join(transaction,
+                           table.c.transaction_id == transaction.c.id)
+            ).where(
+                transaction.c.activity_id == activity.c.iati_identifier,
+                column != None),
+        ).scalar_subquery())
+
+    def participating_orgs(value):
+        return sa.func.array(sa.select(value).distinct().select_from(
+            participation.join(
+                organisation,
+                participation.c.organisation_id == organisation.c.id)
+        ).where(
+            participation.c.activity_identifier == activity.c.iati_identifier
+        ).scalar_subquery())
+
+    country = CountryPercentage.__table__
+    region = RegionPercentage.__table__
+    sector = SectorPercentage.__table__
+    def search_text(column, path):
+        value = sa.func.jsonb_path_query(column, path).table_valued(
+            'value').render_derived()
+        return sa.select(
+            sa.func.string_agg(value.c.value.op('#>>')('{}'), '\n')
+        ).select_from(value).scalar_subquery()
+
+    return {
+        'dataset_id': from_resource(resource.c.dataset_id, activity.c.dataset_id),
+        'publisher': from_resource(dataset.c.publisher, activity.c.publisher),
+        'recipient_country_codes': percentages(country, country.c.country),
+        'recipient_region_codes': percentages(region, region.c.region),
+        'sector_codes': percentages(sector, sector.c.sector),
+        'participating_org_refs': participating_orgs(organisation.c.ref),
+        'participating_org_role_refs': participating_orgs(
+            participation.c.role + ':' + organisation.c.ref),
+        'policy_marker_codes': sa.func.array(
+            sa.select(policy_marker.c.code).distinct().where(
+                policy_marker.c.activity_id == activity.c.iati_identifier,
+                policy_marker.c.code != None,
+            ).scalar_subquery()),
+        'title_search': sa.func.concat_ws(
+            '\n', activity.c.title,
+            search_text(activity.c.title_all_values, 'lax $.*')),
+        'description_search': sa.func.concat_ws(
+            '\n', activity.c.description,
+            search_text(activity.c.description_all_values, 'lax $.*.*')),
+    }
+
+
+def refresh_activity_facets(session, activity_ids):
+    """Rebuild the facet rows, totals and filter columns for activities"""
+    activity_ids = list(activity_ids)
+    if not activity_ids:
+        return
+    facet = ActivityFacet.__table__
+    session.execute(
+        facet.delete().where(facet.c.activity_id.in_(activity_ids)))
+    session.execute(
+        facet.insert().from_select(
+            ['activity_id', 'facet', 'value'],
+            sa.union(*_facet_sources(activity_ids))))
+    total = ActivityTotal.__table__
+    source = _total_source(activity_ids)
+    session.execute(
+        total.delete().where(total.c.activity_id.in_(activity_ids)))
+    session.execute(
+        total.insert().from_select(
+            [column.name for column in source.selected_columns], source))
+    activity = Activity.__table__
+    derived = _derived_columns()
+    session.execute(
+        activity.update()
+        .where(activity.c.iati_identifier.in_(activity_ids))
+        .values(**derived))
+    for activity_id in activity_ids:
+        obj = session.identity_map.get(
+            sa.orm.util.identity_key(Activity, activity_id))
+        if obj is not None:
+            session.expire(obj, list(derived))
+
+
+def _total_source(activity_ids):
+    """Select producing the activity_total rows for activities"""
+    transaction = Transaction.__table__
+    currencies = sa.func.count(
+        sa.distinct(sa.func.coalesce(transaction.c.value_currency, '')))
+    columns = [
+        transaction.c.activity_id,
+        sa.case(
+            (currencies == 1, sa.func.max(transaction.c.value_currency)),
+        ).label('currency'),
+        (currencies > 1).label('mixed_currency'),
+    ]
+    for name, transactions in TRANSACTION_TOTALS:
+        of_type = transaction.c.type.in_(
+            vars(Activity)[transactions].type_codes)
+        columns += [
+            sa.case(
+                (currencies.filter(of_type) > 1, None),
+                else_=sa.func.coalesce(
+                    sa.func.sum(transaction.c.value_amount).filter(of_type), 0),
+            ).label(name),
+            sa.func.coalesce(
+                sa.func.sum(transaction.c.value_usd).filter(of_type), 0,
+            ).label(name + '_usd'),
+            sa.func.coalesce(
+                sa.func.sum(transaction.c.value_eur).filter(of_type), 0,
+            ).label(name + '_eur'),
+        ]
+    return (
+        sa.select(*columns)
+        .where(transaction.c.activity_id.in_(activity_ids))
+        .group_by(transaction.c.activity_id))
+
+
+def _changed(obj, name):
+    return sa.inspect(obj).attrs[name].history.has_changes()
+
+
+@event.listens_for(sa.orm.Session, "after_flush")
+def update_activity_facets(session, flush_context):
+    activity_ids = set()
+    transaction_ids = set()
+    # Activities copy their resource's dataset name and its publisher
+    dataset_names = set()
+    resource_urls = set()
+    for obj in session.new | session.dirty | session.deleted:
+        state = sa.inspect(obj).dict
+        if isinstance(obj, Dataset):
+            if _changed(obj, 'publisher'):
+                dataset_names.add(state.get('name'))
+        elif isinstance(obj, Resource):
+            if _changed(obj, 'dataset_id'):
+                resource_urls.add(state.get('url'))
+        elif isinstance(obj, Activity):
+            activity_ids.add(state.get('iati_identifier'))
+        elif isinstance(obj, Participation):
+            activity_ids.add(state.get('activity_identifier'))
+        elif isinstance(obj, (Transaction, PolicyMarker)):
+            activity_ids.add(state.get('activity_id'))
+        elif isinstance(obj, (CountryPercentage, RegionPercentage,
+                              SectorPercentage)):
+            activity_ids.add(state.get('activity_id'))
+            transaction_ids.add(state.get('transaction_id'))
+    transaction_ids.discard(None)
+    if transaction_ids:
+        transaction = Transaction.__table__
+        activity_ids.update(session.execute(
+            sa.select(transaction.c.activity_id).where(
+                transaction.c.id.in_(transaction_ids))).scalars())
+    dataset_names.discard(None)
+    resource_urls.discard(None)
+    if dataset_names or resource_urls:
+        activity = Activity.__table__
+        activity_ids.update(session.execute(
+            sa.select(activity.c.iati_identifier).where(sa.or_(
+                activity.c.dataset_id.in_(dataset_names),
+                activity.c.resource_url.in_(resource_urls)))).scalars())
+    activity_ids.discard(None)
+    refresh_activity_facets(session, activity_ids)
+
+
 # We use sqlite for testing and postgres for prod. Sadly sqlite will only
 # pay attention to forign keys if you tell it to.
 from sqlalchemy.engine import Engine
@@ -1,5 +1,6 @@
 import traceback
 
+import click
 from flask import Blueprint
 
 from iatilib import db, rq
@@ -35,25 +36,31 @@ def db_log_exception(job, exc_type, exc_value, tb):
     job.delete()
 
 
-def get_worker():
+def get_worker(*queues):
     # Set up the worker to log errors to the db rather than pushing them
     # into the failed queue.
-    worker = rq.get_worker()
+    worker = rq.get_worker(*queues)
     # worker.pop_exc_handler()
     worker.push_exc_handler(db_log_exception)
     return worker
 
 
+@click.option('--queue', 'queues', multiple=True,
+              help="a queue to run jobs from, instead of the default one, \
+              e.g. exports")
 @manager.cli.command('burst')
-def burst():
+def burst(queues):
     "Run jobs then exit when queue is empty"
-    get_worker().work(burst=True)
+    get_worker(*queues).work(burst=True)
 
 
+@click.option('--queue', 'queues', multiple=True,
+              help="a queue to run jobs from, instead of the default one, \
+              e.g. exports")
 @manager.cli.command('background')
-def background():
+def background(queues):
     "Monitor queue for jobs and run when they are there"
-    get_worker().work(burst=False)
+    get_worker(*queues).work(burst=False)
 
 
 @manager.cli.command('empty')
@@ -0,0 +1,76 @@
+"""
+The figures reported by /api/1/about/.
+
+Load balancers and uptime monitors poll /about/ constantly, and working
+out its figures takes a scan of the dataset and resource tables. They
+only change when the crawler commits, so the crawler works them out
+then and keeps them in the Redis that rq already uses, and /about/ just
+reads them back. They expire after ABOUT_CACHE_TIMEOUT seconds, which
+bounds how stale the queue length, and anything changed outside the
+crawler, can get.
+"""
+import datetime
+import json
+import logging
+
+import sqlalchemy as sa
+from flask import current_app
+from redis.exceptions import RedisError
+
+from iatilib import db, rq
+from iatilib.model import Dataset, Resource, Stats
+
+log = logging.getLogger(__name__)
+
+SUMMARY_KEY = 'about:summary'
+# The resource times reported, each the latest of its column
+TIMES = ('last_fetch', 'last_succ', 'last_parsed')
+
+
+def compute():
+    """The figures, worked out from the database"""
+    counts = dict(db.session.query(Stats.label, Stats.count).filter(
+        Stats.label.in_(('activities', 'transactions', 'budgets'))))
+    updated = db.session.query(*(
+        sa.func.max(getattr(Resource, name)).label(name) for name in TIMES
+    )).first()
+    return {
+        'activities': counts.get('activities'),
+        'transactions': counts.get('transactions'),
+        'budgets': counts.get('budgets'),
+        'datasets': Dataset.query.count(),
+        'items_on_queue': rq.get_queue().count,
+        **{name: getattr(updated, name) for name in TIMES},
+    }
+
+
+def refresh():
+    """Work out the figures again and keep them, and return them"""
+    figures = compute()
+    entry = dict(figures)
+    for name in TIMES:
+        if entry[name] is not None:
+            entry[name] = entry[name].isoformat()
+    try:
+        rq.connection.set(
+            SUMMARY_KEY, json.dumps(entry),
+            ex=current_app.config['ABOUT_CACHE_TIMEOUT'])
+    except RedisError:
+        log.warning("About cache unavailable", exc_info=True)
+    return figures
+
+
+def get():
+    """The figures, as last kept, or worked out if they have expired"""
+    try:
+        entry = rq.connection.get(SUMMARY_KEY)
+    except RedisError:
+        log.warning("About cache unavailable", exc_info=True)
+        return compute()
+    if entry is None:
+        return refresh()
+    figures = json.loads(entry)
+    for name in TIMES:
+        if figures[name] is not None:
+            figures[name] = datetime.datetime.fromisoformat(figures[name])
+    return figures
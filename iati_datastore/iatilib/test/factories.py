@@ -7,7 +7,7 @@ from iatilib import db
 from iatilib.model import (
     Activity, Transaction, Organisation, SectorPercentage, CountryPercentage,
     Participation, Budget, Resource, RegionPercentage, PolicyMarker,
-    RelatedActivity, Dataset, Log
+    RelatedActivity, Dataset, Log, ActivityTotal
 )
 
 from factory.alchemy import SQLAlchemyModelFactory as Factory
@@ -105,6 +105,34 @@ class TransactionFactory(TestFactory):
     date = datetime.date(1973, 2, 2)
 
 
+class ActivityTotalFactory(TestFactory):
+    class Meta:
+        model = ActivityTotal
+    currency = codelists.Currency.us_dollar
+    mixed_currency = False
+    commitment = 0
+    commitment_usd = 0
+    commitment_eur = 0
+    disbursement = 0
+    disbursement_usd = 0
+    disbursement_eur = 0
+    expenditure = 0
+    expenditure_usd = 0
+    expenditure_eur = 0
+    incoming_funds = 0
+    incoming_funds_usd = 0
+    incoming_funds_eur = 0
+    interest_repayment = 0
+    interest_repayment_usd = 0
+    interest_repayment_eur = 0
+    loan_repayment = 0
+    loan_repayment_usd = 0
+    loan_repayment_eur = 0
+    reimbursement = 0
+    reimbursement_usd = 0
+    reimbursement_eur = 0
+
+
 class BudgetFactory(TestFactory):
     class Meta:
         model = Budget
@@ -1,19 +1,30 @@
 import os
+import gzip
 import json
-from datetime import datetime
+import shutil
+import tempfile
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 from xml.etree import ElementTree as ET
 import csv
-from io import StringIO
+from io import BytesIO, StringIO
 from tempfile import mkstemp
 
 import mock
 import openpyxl
+import sqlalchemy as sa
 
 from . import factories as fac
-from . import ClientTestCase
-from iatilib import parse, db, model
+from . import ClientTestCase, TestConfig
+import iatilib
+from iatilib import codelists, crawler, parse, db, model, rq, summary
 
 from iatilib.currency_conversion import update_exchange_rates
+from iatilib.frontend import (
+    api1, cache, compression, counts, dsfilter, dumps, exports, limits,
+    validators)
 
 def read_fixture(fix_name, encoding='utf-8'):
     """Read and convert fixture from csv file"""
@@ -40,6 +51,32 @@ class TestAbout(ClientTestCase):
         resp = self.client.get('/api/1/about/')
         self.assertEquals(200, resp.status_code)
 
+    def test_about_figures(self):
+        now = datetime.now()
+        fac.DatasetFactory.create(resources=[fac.ResourceFactory.create(
+            last_fetch=now, last_succ=now, last_parsed=now)])
+        db.session.query(model.Stats).filter_by(
+            label='activities').update({'count': 1})
+        data = json.loads(
+            self.client.get('/api/1/about/').get_data(as_text=True))
+        self.assertEquals("healthy", data["status"])
+        self.assertEquals(1, data["num_datasets"])
+        self.assertEquals(1, data["indexed_activities"])
+        self.assertEquals(0, data["items_on_queue"])
+
+    def test_about_is_kept_between_crawler_commits(self):
+        self.client.get('/api/1/about/').get_data()
+        fac.DatasetFactory.create(resources=[])
+        with self.app.test_request_context('/api/1/about/'):
+            with mock.patch.object(db.session, 'execute') as execute:
+                data = json.loads(api1.about().get_data(as_text=True))
+                self.assertFalse(execute.called)
+        self.assertEquals(0, data["num_datasets"])
+        summary.refresh()
+        data = json.loads(
+            self.client.get('/api/1/about/').get_data(as_text=True))
+        self.assertEquals(1, data["num_datasets"])
+
 
 class TestAboutDatasets(ClientTestCase):
     def test_about(self):
@@ -446,6 +483,1064 @@ class TestPagination(ClientTestCase):
         self.assertEquals(400, resp.status_code)
 
 
+class TestCountCache(ClientTestCase):
+    # Filtered, as unfiltered counts are read from Stats instead
+    url = '/api/1/access/activity/?last-change__gt=2000-01-01'
+
+    def total(self, url):
+        return json.loads(self.client.get(url).get_data(as_text=True))[
+            "total-count"]
+
+    def test_count_reused_between_pages(self):
+        fac.ActivityFactory.create(iati_identifier=u"a1")
+        self.assertEquals(1, self.total(self.url))
+        fac.ActivityFactory.create(iati_identifier=u"a2")
+        self.assertEquals(1, self.total(self.url + '&offset=1'))
+
+    def test_count_reused_between_cursor_pages(self):
+        for ident in (u"a1", u"a2"):
+            fac.ActivityFactory.create(iati_identifier=ident)
+        with mock.patch.object(
+                sa.orm.Query, 'count', autospec=True,
+                side_effect=sa.orm.Query.count) as count:
+            data = json.loads(self.client.get(
+                self.url + '&limit=1').get_data(as_text=True))
+            data = json.loads(self.client.get(
+                self.url + '&limit=1&after=' + data["next-cursor"]
+            ).get_data(as_text=True))
+            # Unfiltered, so counted from Stats
+            self.client.get(
+                '/api/1/access/activity/?after=' + validators.encode_cursor(
+                    [u"a1"])).get_data()
+        self.assertEquals(2, data["total-count"])
+        self.assertEquals(1, count.call_count)
+
+    def test_count_keyed_on_filters(self):
+        fac.ActivityFactory.create(
+            iati_identifier=u"a1",
+            reporting_org=fac.OrganisationFactory.build(ref=u"AAA"))
+        self.assertEquals(
+            1, self.total('/api/1/access/activity/?reporting-org=AAA'))
+        self.assertEquals(
+            0, self.total('/api/1/access/activity/?reporting-org=ZZZ'))
+
+    def test_count_shared_by_term_orders(self):
+        for ident, country in ((u"a1", codelists.Country.afghanistan),
+                               (u"a2", codelists.Country.somalia)):
+            fac.ActivityFactory.create(
+                iati_identifier=ident,
+                recipient_country_percentages=[
+                    fac.CountryPercentageFactory.build(country=country)])
+        self.assertEquals(
+            2, self.total('/api/1/access/activity/?recipient-country=AF|SO'))
+        fac.ActivityFactory.create(
+            iati_identifier=u"a3",
+            recipient_country_percentages=[
+                fac.CountryPercentageFactory.build(
+                    country=codelists.Country.somalia)])
+        self.assertEquals(
+            2, self.total('/api/1/access/activity/?recipient-country=SO|AF'))
+
+    def test_no_key_without_exact_count(self):
+        with mock.patch.object(counts, 'count_key') as count_key:
+            self.client.get(self.url + '&count=none').get_data()
+            self.client.get(self.url + '&count=estimate').get_data()
+            self.client.get('/api/1/access/activity.csv').get_data()
+        self.assertFalse(count_key.called)
+
+    def test_crawl_invalidates_count(self):
+        fac.ActivityFactory.create(iati_identifier=u"a1")
+        self.assertEquals(1, self.total(self.url))
+        fac.ActivityFactory.create(iati_identifier=u"a2")
+        model.DataVersion.bump(crawler.CRAWL_VERSION)
+        db.session.commit()
+        self.assertEquals(2, self.total(self.url))
+
+
+class TestQueryLimits(ClientTestCase):
+    url = '/api/1/access/activity.csv'
+
+    def setUp(self):
+        super().setUp()
+        self.timeouts = self.app.config['STATEMENT_TIMEOUTS']
+        self.cost_limits = self.app.config['QUERY_COST_LIMITS']
+
+    def tearDown(self):
+        self.app.config['STATEMENT_TIMEOUTS'] = self.timeouts
+        self.app.config['QUERY_COST_LIMITS'] = self.cost_limits
+        super().tearDown()
+
+    def slow_filter(self):
+        return mock.patch.object(
+            api1.ActivityCSVView, 'filter', staticmethod(
+                lambda args: model.Activity.query.filter(
+                    sa.func.pg_sleep(0.5).is_(None))))
+
+    def test_statement_timeout(self):
+        fac.ActivityFactory.create(iati_identifier=u"a1")
+        self.app.config['STATEMENT_TIMEOUTS'] = {None: 10}
+        with self.slow_filter(), self.assertLogs(limits.log, 'WARNING') as logs:
+            resp = self.client.get(self.url + '?recipient-country=MW')
+        self.assertEquals(400, resp.status_code)
+        self.assertIn(u"took too long", resp.get_data(as_text=True))
+        self.assertIn("api1.activity-csv-view", logs.output[0])
+        self.assertIn("'recipient-country': ['MW']", logs.output[0])
+
+    def test_statement_timeout_per_endpoint(self):
+        fac.ActivityFactory.create(iati_identifier=u"a1")
+        self.app.config['STATEMENT_TIMEOUTS'] = {
+            None: 10, 'api1.activity-csv-view': None}
+        with self.slow_filter():
+            resp = self.client.get(self.url)
+        self.assertEquals(200, resp.status_code)
+
+    def test_cost_limit(self):
+        self.app.config['QUERY_COST_LIMITS'] = {None: 0.001}
+        with self.assertLogs(limits.log, 'WARNING'):
+            resp = self.client.get(self.url)
+        self.assertEquals(400, resp.status_code)
+        self.assertIn(u"over the limit", resp.get_data(as_text=True))
+
+    def test_cost_limit_for_streams(self):
+        self.app.config['QUERY_COST_LIMITS'] = {
+            'api1.activity-csv-view': 0.001}
+        with self.assertLogs(limits.log, 'WARNING'):
+            resp = self.client.get(self.url + '?stream=True')
+        self.assertEquals(400, resp.status_code)
+        resp = self.client.get('/api/1/access/transaction.csv?stream=True')
+        self.assertEquals(200, resp.status_code)
+
+    def test_default_cost_limit_for_streams(self):
+        # A filter that multiplies the rows a breakdown stream has to
+        # work through, as some filter combinations do on the full data
+        def runaway(args):
+            return dsfilter.transactions_by_sector(args).join(
+                sa.func.generate_series(1, 10 ** 8).alias('n'), sa.true())
+        url = '/api/1/access/transaction/by_sector.csv?stream=True'
+        self.assertEquals(200, self.client.get(url).status_code)
+        with mock.patch.object(
+                api1.TransactionsBySectorView, 'filter',
+                staticmethod(runaway)), \
+                self.assertLogs(limits.log, 'WARNING'):
+            resp = self.client.get(url)
+        self.assertEquals(400, resp.status_code)
+        self.assertIn(u"over the limit", resp.get_data(as_text=True))
+
+    def test_costly_count_estimated(self):
+        for ident in (u"a1", u"a2", u"a3"):
+            fac.ActivityFactory.create(iati_identifier=ident)
+        query = model.Activity.query
+        self.assertEquals(
+            counts.estimated_count(query),
+            counts.cached_count(query, 'count-key', max_cost=0.001))
+        self.assertEquals(None, rq.connection.get('count-key'))
+        self.assertEquals(3, counts.cached_count(query, 'count-key'))
+
+
+class TestResponseCache(ClientTestCase):
+    url = '/api/1/access/activity.csv'
+
+    def setUp(self):
+        super().setUp()
+        self.app.config['RESPONSE_CACHE_MAX_BYTES'] = 1024 * 1024
+        self.statements = []
+
+    def tearDown(self):
+        self.app.config['RESPONSE_CACHE_MAX_BYTES'] = 0
+        self.app.config['RESPONSE_CACHE_MAX_ENTRY_BYTES'] = \
+            TestConfig.RESPONSE_CACHE_MAX_ENTRY_BYTES
+        super().tearDown()
+
+    def record(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def get_counted(self, url):
+        sa.event.listen(db.engine, 'before_cursor_execute', self.record)
+        try:
+            return self.client.get(url)
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', self.record)
+
+    def test_hit_skips_database(self):
+        fac.ActivityFactory.create(iati_identifier=u"a1")
+        first = self.client.get(self.url)
+        second = self.get_counted(self.url)
+        self.assertEquals([], self.statements)
+        self.assertEquals(first.get_data(), second.get_data())
+        self.assertEquals(first.mimetype, second.mimetype)
+        self.assertIn(u"a1", second.get_data(as_text=True))
+
+    def test_locale_is_part_of_key(self):
+        self.client.get(self.url)
+        self.get_counted(self.url + '?locale=fr')
+        self.assertTrue(self.statements)
+
+    def test_new_crawl_version(self):
+        self.client.get(self.url)
+        fac.ActivityFactory.create(iati_identifier=u"a1")
+        model.DataVersion.bump(crawler.CRAWL_VERSION)
+        db.session.commit()
+        # As if RESPONSE_CACHE_VERSION_TIMEOUT had passed
+        rq.connection.delete(cache.VERSION_KEY)
+        resp = self.client.get(self.url)
+        self.assertIn(u"a1", resp.get_data(as_text=True))
+
+    def test_evicts_least_recently_used(self):
+        self.client.get(self.url + '?limit=1')
+        size = int(rq.connection.get(cache.BYTES_KEY))
+        self.app.config['RESPONSE_CACHE_MAX_BYTES'] = size * 2
+        self.client.get(self.url + '?limit=2')
+        self.client.get(self.url + '?limit=1')
+        self.client.get(self.url + '?limit=3')
+        self.assertEquals(2, rq.connection.zcard(cache.LRU_KEY))
+        self.assertEquals(size * 2, int(rq.connection.get(cache.BYTES_KEY)))
+        self.get_counted(self.url + '?limit=1')
+        self.assertEquals([], self.statements)
+        self.get_counted(self.url + '?limit=2')
+        self.assertTrue(self.statements)
+
+    def test_large_pages_not_cached(self):
+        self.app.config['RESPONSE_CACHE_MAX_ENTRY_BYTES'] = 10
+        self.client.get(self.url)
+        self.get_counted(self.url)
+        self.assertTrue(self.statements)
+
+    def test_streams_not_cached(self):
+        self.client.get(self.url + '?stream=True')
+        self.get_counted(self.url + '?stream=True')
+        self.assertTrue(self.statements)
+
+    def test_xlsx(self):
+        first = self.client.get('/api/1/access/activity.xlsx')
+        second = self.get_counted('/api/1/access/activity.xlsx')
+        self.assertEquals([], self.statements)
+        self.assertEquals(first.get_data(), second.get_data())
+        self.assertEquals(
+            first.headers['Content-Disposition'],
+            second.headers['Content-Disposition'])
+
+
+class TestConditionalRequests(ClientTestCase):
+    url = '/api/1/access/activity.csv'
+
+    def setUp(self):
+        super().setUp()
+        self.statements = []
+
+    def record(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def get_counted(self, url, **headers):
+        sa.event.listen(db.engine, 'before_cursor_execute', self.record)
+        try:
+            return self.client.get(url, headers=headers)
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', self.record)
+
+    def bump(self):
+        model.DataVersion.bump(crawler.CRAWL_VERSION)
+        db.session.commit()
+        # As if RESPONSE_CACHE_VERSION_TIMEOUT had passed
+        rq.connection.delete(cache.VERSION_KEY)
+
+    def test_validators(self):
+        self.bump()
+        resp = self.client.get(self.url)
+        self.assertTrue(resp.headers['ETag'].startswith('W/"1.0-'))
+        self.assertIn('Last-Modified', resp.headers)
+
+    def test_last_modified_is_in_gmt(self):
+        # Bumped by a connection whose time zone isn't UTC
+        db.session.execute("SET LOCAL TIME ZONE 'America/New_York'")
+        self.bump()
+        resp = self.client.get(self.url)
+        modified = parsedate_to_datetime(resp.headers['Last-Modified'])
+        self.assertLess(
+            abs(datetime.now(timezone.utc) - modified), timedelta(minutes=1))
+
+    def test_no_last_modified_before_a_crawl(self):
+        resp = self.client.get(self.url)
+        self.assertIn('ETag', resp.headers)
+        self.assertNotIn('Last-Modified', resp.headers)
+
+    def test_if_none_match(self):
+        etag = self.client.get(self.url).headers['ETag']
+        resp = self.get_counted(self.url, **{'If-None-Match': etag})
+        self.assertEquals(304, resp.status_code)
+        self.assertEquals(b'', resp.get_data())
+        self.assertEquals([], self.statements)
+
+    def test_etag_depends_on_arguments(self):
+        etag = self.client.get(self.url).headers['ETag']
+        resp = self.client.get(
+            self.url + '?limit=1', headers={'If-None-Match': etag})
+        self.assertEquals(200, resp.status_code)
+
+    def test_new_crawl(self):
+        etag = self.client.get(self.url).headers['ETag']
+        self.bump()
+        resp = self.client.get(self.url, headers={'If-None-Match': etag})
+        self.assertEquals(200, resp.status_code)
+
+    def test_if_modified_since(self):
+        self.bump()
+        modified = self.client.get(self.url).headers['Last-Modified']
+        resp = self.get_counted(self.url, **{'If-Modified-Since': modified})
+        self.assertEquals(304, resp.status_code)
+        self.assertEquals([], self.statements)
+        resp = self.client.get(self.url, headers={
+            'If-Modified-Since': 'Mon, 01 Jan 2001 00:00:00 GMT'})
+        self.assertEquals(200, resp.status_code)
+
+    def test_errors_have_no_validators(self):
+        resp = self.client.get(self.url + '?limit=junk')
+        self.assertEquals(400, resp.status_code)
+        self.assertNotIn('ETag', resp.headers)
+
+
+class TestStreamCompression(ClientTestCase):
+    url = '/api/1/access/transaction.csv?stream=True'
+
+    def setUp(self):
+        super().setUp()
+        activity = fac.ActivityFactory.create(iati_identifier=u"a1")
+        for ref in (u"t1", u"t2", u"t3"):
+            fac.TransactionFactory.create(activity=activity, ref=ref)
+
+    def test_gzip(self):
+        plain = self.client.get(self.url).get_data()
+        resp = self.client.get(self.url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEquals('gzip', resp.headers['Content-Encoding'])
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertEquals(plain, gzip.decompress(resp.get_data()))
+
+    def test_not_accepted(self):
+        resp = self.client.get(
+            self.url, headers={'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertIn(u"t1", resp.get_data(as_text=True))
+
+    def test_pages_not_compressed(self):
+        resp = self.client.get(
+            '/api/1/access/transaction.csv',
+            headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+    def test_flushes(self):
+        with mock.patch.object(compression, 'FLUSH_BYTES', 1):
+            chunks = list(compression.compress(
+                [u"a,b\n", u"c,d\n"], 'gzip', 6))
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEquals(b"a,b\n", decompressor.decompress(chunks[0]))
+
+
+class TestServerSideCursors(ClientTestCase):
+    url = '/api/1/access/transaction.csv'
+
+    def setUp(self):
+        super().setUp()
+        activity = fac.ActivityFactory.create(iati_identifier=u"a1")
+        fac.TransactionFactory.create(activity=activity, ref=u"t1")
+        self.cursors = []
+
+    def record(self, conn, cursor, statement, *args):
+        if u"FROM transaction" in statement:
+            self.cursors.append(cursor.name)
+
+    def get_recorded(self, url):
+        sa.event.listen(db.engine, 'before_cursor_execute', self.record)
+        try:
+            return self.client.get(url).get_data(as_text=True)
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', self.record)
+
+    def test_stream(self):
+        self.assertIn(u"t1", self.get_recorded(self.url + '?stream=True'))
+        self.assertTrue(any(self.cursors))
+
+    def test_page(self):
+        self.assertIn(u"t1", self.get_recorded(self.url))
+        self.assertTrue(self.cursors)
+        self.assertFalse(any(self.cursors))
+
+
+class TestExports(ClientTestCase):
+    url = '/api/1/access/transaction.csv?reporting-org=org-1'
+
+    def setUp(self):
+        super().setUp()
+        self.app.config['EXPORT_DIR'] = tempfile.mkdtemp()
+        activity = fac.ActivityFactory.create(
+            reporting_org=fac.OrganisationFactory.create(ref=u"org-1"))
+        for ref in (u"t1", u"t2"):
+            fac.TransactionFactory.create(activity=activity, ref=ref)
+
+    def tearDown(self):
+        shutil.rmtree(self.app.config['EXPORT_DIR'])
+        self.app.config['EXPORT_DIR'] = TestConfig.EXPORT_DIR
+        super().tearDown()
+
+    def run_jobs(self):
+        queue = exports.queue()
+        jobs = queue.jobs
+        rq.connection.delete(queue.key)
+        for job in jobs:
+            job.func(*job.args)
+
+    def test_post_queues_job(self):
+        resp = self.client.post(self.url)
+        self.assertEquals(202, resp.status_code)
+        data = json.loads(resp.get_data(as_text=True))
+        self.assertEquals("queued", data["status"])
+        self.assertEquals(data["status-url"], resp.headers["Location"])
+        self.assertEquals([data["id"]], exports.queue().job_ids)
+
+    def test_identical_requests_share_a_job(self):
+        first = json.loads(self.client.post(self.url).get_data(as_text=True))
+        second = json.loads(
+            self.client.post(self.url).get_data(as_text=True))
+        self.assertEquals(first["id"], second["id"])
+        self.assertEquals(1, exports.queue().count)
+        other = json.loads(self.client.post(
+            self.url + '&transaction-type=3').get_data(as_text=True))
+        self.assertNotEquals(first["id"], other["id"])
+
+    def test_download(self):
+        data = json.loads(self.client.post(self.url).get_data(as_text=True))
+        self.run_jobs()
+        status = json.loads(self.client.get(
+            data["status-url"]).get_data(as_text=True))
+        self.assertEquals("finished", status["status"])
+        resp = self.client.get(status["download-url"])
+        self.assertEquals(200, resp.status_code)
+        self.assertIn("transaction.csv", resp.headers["Content-Disposition"])
+        streamed = self.client.get(self.url + '&stream=True').get_data()
+        self.assertEquals(streamed, resp.get_data())
+        resp.close()
+
+    def test_finished_export_is_reused(self):
+        self.client.post(self.url)
+        self.run_jobs()
+        resp = self.client.post(self.url)
+        self.assertEquals(200, resp.status_code)
+        self.assertEquals(0, exports.queue().count)
+
+    def test_xlsx(self):
+        data = json.loads(self.client.post(
+            '/api/1/access/transaction.xlsx').get_data(as_text=True))
+        self.run_jobs()
+        resp = self.client.get(data["status-url"].replace(
+            "http://localhost", "") + "download")
+        workbook = openpyxl.load_workbook(BytesIO(resp.get_data()))
+        self.assertEquals(3, workbook.active.max_row)
+        resp.close()
+
+    def test_invalid_arguments(self):
+        resp = self.client.post('/api/1/access/transaction.csv?limit=junk')
+        self.assertEquals(400, resp.status_code)
+        self.assertEquals(0, exports.queue().count)
+
+    def test_unknown_export(self):
+        resp = self.client.get('/api/1/exports/junk/')
+        self.assertEquals(404, resp.status_code)
+        resp = self.client.get('/api/1/exports/junk/download')
+        self.assertEquals(404, resp.status_code)
+
+    def test_only_export_ids_are_accepted(self):
+        for export_id in ('%2e%2e', '..', 'A' * 40):
+            resp = self.client.get('/api/1/exports/%s/' % export_id)
+            self.assertEquals(404, resp.status_code)
+            resp = self.client.get('/api/1/exports/%s/download' % export_id)
+            self.assertEquals(404, resp.status_code)
+
+    def test_jobs_use_their_own_queue(self):
+        self.client.post(self.url)
+        self.assertEquals(1, exports.queue().count)
+        self.assertEquals(0, rq.get_queue().count)
+
+    def test_failed_job(self):
+        data = json.loads(self.client.post(self.url).get_data(as_text=True))
+        with mock.patch.object(
+                api1.TransactionsView, 'filter', side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                self.run_jobs()
+        status = json.loads(self.client.get(
+            data["status-url"]).get_data(as_text=True))
+        self.assertEquals("failed", status["status"])
+        self.assertEquals(202, self.client.post(self.url).status_code)
+        self.assertEquals(1, exports.queue().count)
+
+    def test_remove_old_exports(self):
+        data = json.loads(self.client.post(self.url).get_data(as_text=True))
+        self.run_jobs()
+        directory = exports.export_dir(data["id"])
+        os.utime(directory, (0, 0))
+        exports.remove_old_exports()
+        self.assertFalse(os.path.exists(directory))
+
+
+class TestDumps(ClientTestCase):
+    def setUp(self):
+        super().setUp()
+        self.app.config['DUMP_DIR'] = tempfile.mkdtemp()
+        activity = fac.ActivityFactory.create(
+            iati_identifier=u"a1", publisher=u"pub-a",
+            recipient_country_percentages=[
+                fac.CountryPercentageFactory.build(
+                    country=codelists.Country.malawi)])
+        fac.TransactionFactory.create(activity=activity)
+        fac.ActivityFactory.create(iati_identifier=u"a2", publisher=u"pub-b")
+
+    def tearDown(self):
+        shutil.rmtree(self.app.config['DUMP_DIR'])
+        self.app.config['DUMP_DIR'] = TestConfig.DUMP_DIR
+        super().tearDown()
+
+    def dump(self, path):
+        with gzip.open(os.path.join(
+                self.app.config['DUMP_DIR'], path)) as f:
+            return f.read()
+
+    def test_writes_slices(self):
+        self.assertEquals(4, dumps.update_slices())
+        streamed = self.client.get(
+            '/api/1/access/transaction.csv?stream=True').get_data()
+        self.assertEquals(streamed, self.dump('all/transaction.csv.gz'))
+        rows = list(csv.DictReader(StringIO(self.dump(
+            'publisher/pub-b/activity.csv.gz').decode('utf-8'))))
+        self.assertEquals([u"a2"], [r["iati-identifier"] for r in rows])
+        data = json.loads(self.dump('recipient-country/MW/activity.json.gz'))
+        self.assertEquals(1, data["total-count"])
+        ET.fromstring(self.dump('all/activity.xml.gz'))
+
+    def test_only_changed_slices_are_rewritten(self):
+        dumps.update_slices()
+        self.assertEquals(0, dumps.update_slices())
+        fac.ActivityFactory.create(iati_identifier=u"a3", publisher=u"pub-b")
+        self.assertEquals(2, dumps.update_slices())
+        rows = list(csv.DictReader(StringIO(self.dump(
+            'publisher/pub-b/activity.csv.gz').decode('utf-8'))))
+        self.assertEquals(2, len(rows))
+
+    def test_removes_old_slices(self):
+        dumps.update_slices()
+        db.session.query(model.Activity).filter_by(
+            publisher=u"pub-b").delete()
+        self.assertEquals(1, dumps.update_slices())
+        self.assertFalse(os.path.exists(os.path.join(
+            self.app.config['DUMP_DIR'], 'publisher', 'pub-b')))
+
+    def test_download(self):
+        dumps.update_slices()
+        index = json.loads(
+            self.client.get('/api/1/dumps/').get_data(as_text=True))
+        self.assertIn(
+            'publisher/pub-a/budget.csv.gz',
+            [dump["path"] for dump in index["dumps"]])
+        with mock.patch.object(db.session, 'execute') as execute:
+            resp = self.client.get(
+                '/api/1/dumps/all/activity.csv.gz',
+                headers={'Range': 'bytes=0-9'})
+            self.assertEquals(206, resp.status_code)
+            self.assertEquals(10, len(resp.get_data()))
+            resp.close()
+            self.assertFalse(execute.called)
+
+    def test_download_only_dumps(self):
+        dumps.update_slices()
+        for path in ('all/signature.json', 'all/missing.csv.gz',
+                     '../../etc/passwd.gz'):
+            resp = self.client.get('/api/1/dumps/' + path)
+            self.assertEquals(404, resp.status_code)
+
+    def test_waits_for_the_crawl(self):
+        dumps.enqueue()
+        dumps.enqueue()
+        queue = dumps.queue()
+        self.assertEquals(1, queue.count)
+        self.assertEquals(0, rq.get_queue().count)
+        rq.get_queue().enqueue(crawler.update_dataset, args=(u"dataset", False))
+        job = queue.jobs[0]
+        queue.remove(job)
+        with mock.patch.object(dumps.time, 'sleep') as sleep:
+            job.func()
+        sleep.assert_called_once_with(self.app.config['DUMP_RETRY_INTERVAL'])
+        self.assertEquals(1, queue.count)
+        self.assertEquals([], os.listdir(self.app.config['DUMP_DIR']))
+        rq.connection.delete(rq.get_queue().key)
+        dumps.update_dumps()
+        self.assertTrue(os.path.exists(os.path.join(
+            self.app.config['DUMP_DIR'], 'all', 'activity.csv.gz')))
+
+    def test_waits_for_running_crawler_jobs(self):
+        crawler_queue = rq.get_queue()
+        job = crawler_queue.enqueue(
+            crawler.update_activities, args=(u"dataset",))
+        crawler_queue.remove(job)
+        crawler_queue.started_job_registry.add(job, 60)
+        with mock.patch.object(dumps.time, 'sleep'):
+            dumps.update_dumps()
+        self.assertEquals(1, dumps.queue().count)
+        self.assertEquals([], os.listdir(self.app.config['DUMP_DIR']))
+
+    def test_ignores_other_jobs(self):
+        rq.get_queue().enqueue(exports.remove_old_exports)
+        dumps.update_dumps()
+        self.assertTrue(os.path.exists(os.path.join(
+            self.app.config['DUMP_DIR'], 'all', 'activity.csv.gz')))
+
+    def test_transaction_country_slices(self):
+        activity = fac.ActivityFactory.create(
+            iati_identifier=u"a3", publisher=u"pub-b")
+        fac.TransactionFactory.create(
+            activity=activity, recipient_country_percentages=[
+                fac.CountryPercentageFactory.build(
+                    country=codelists.Country.kenya)])
+        self.assertEquals(
+            ['recipient-country/KE', 'recipient-country/MW'],
+            sorted(d for d, _ in dumps.slices()
+                   if d.startswith('recipient-country/')))
+        dumps.update_slices()
+        data = json.loads(self.dump('recipient-country/KE/activity.json.gz'))
+        self.assertEquals(1, data["total-count"])
+
+    def test_publisher_change_rewrites_slices(self):
+        dumps.update_slices()
+        db.session.query(model.Activity).filter_by(
+            iati_identifier=u"a1").update({"publisher": u"pub-c"})
+        # all, the new pub-c and MW, where a1 is
+        self.assertEquals(3, dumps.update_slices())
+
+
+class TestCountModes(ClientTestCase):
+    def query(self, url):
+        return json.loads(self.client.get(url).get_data(as_text=True))
+
+    def test_exact_unfiltered_reads_stats(self):
+        fac.ActivityFactory.create(iati_identifier=u"a1")
+        model.Stats.query.get('activities').count = 42
+        db.session.commit()
+        self.assertEquals(
+            42, self.query('/api/1/access/activity/')["total-count"])
+        self.assertEquals(1, self.query(
+            '/api/1/access/activity/?iati-identifier=a1')["total-count"])
+
+    def test_estimate(self):
+        fac.ActivityFactory.create(iati_identifier=u"a1")
+        data = self.query('/api/1/access/activity/?count=estimate')
+        self.assertIsInstance(data["total-count"], int)
+        self.assertEquals(1, len(data["iati-activities"]))
+
+    def test_none_omits_count(self):
+        fac.ActivityFactory.create(iati_identifier=u"a1")
+        data = self.query('/api/1/access/activity/?count=none')
+        self.assertNotIn("total-count", data)
+        self.assertEquals(1, len(data["iati-activities"]))
+
+    def test_none_omits_xml_count(self):
+        resp = self.client.get('/api/1/access/activity.xml?count=none')
+        xml = ET.fromstring(resp.get_data(as_text=True))
+        self.assertEquals(None, xml.find('.//total-count'))
+        self.assertEquals('0', xml.find('.//start').text)
+
+    def test_invalid_mode(self):
+        resp = self.client.get('/api/1/access/activity/?count=some')
+        self.assertEquals(400, resp.status_code)
+
+
+class TestReplica(ClientTestCase):
+    # The test database stands in for the replica unless
+    # TEST_SQLALCHEMY_REPLICA_URI names a second one
+    replica_uri = os.getenv(
+        "TEST_SQLALCHEMY_REPLICA_URI", TestConfig.SQLALCHEMY_DATABASE_URI)
+
+    def setUp(self):
+        super().setUp()
+        self.binds = self.app.config['SQLALCHEMY_BINDS']
+        self.app.config['SQLALCHEMY_BINDS'] = {'replica': self.replica_uri}
+        self.replica = db.get_engine(bind='replica')
+        db.Model.metadata.create_all(self.replica)
+        self.statements = []
+        sa.event.listen(self.replica, 'before_cursor_execute', self.record)
+
+    def tearDown(self):
+        sa.event.remove(self.replica, 'before_cursor_execute', self.record)
+        db.session.remove()
+        if self.replica.url != db.engine.url:
+            db.Model.metadata.drop_all(self.replica)
+        self.replica.dispose()
+        self.app.config['SQLALCHEMY_BINDS'] = self.binds
+        super().tearDown()
+
+    def record(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def test_access_reads_from_replica(self):
+        resp = self.client.get('/api/1/access/activity.db.json')
+        self.assertEquals(200, resp.status_code)
+        self.assertTrue(any("FROM activity" in s for s in self.statements))
+
+    def test_about_reads_from_replica(self):
+        resp = self.client.get('/api/1/about/')
+        self.assertEquals(200, resp.status_code)
+        self.assertTrue(self.statements)
+
+    def test_writes_use_primary(self):
+        with self.app.test_request_context('/api/1/about/'):
+            db.session.add(model.Activity(
+                iati_identifier=u"a1", raw_xml=u"<test />"))
+            db.session.commit()
+        self.assertEquals([], self.statements)
+        self.assertEquals(1, model.Activity.query.count())
+
+    def test_other_requests_use_primary(self):
+        self.client.get('/')
+        model.Activity.query.all()
+        self.assertEquals([], self.statements)
+
+
+class TestNoReplica(ClientTestCase):
+    def test_falls_back_to_primary(self):
+        with self.app.test_request_context('/api/1/about/'):
+            self.assertIs(db.engine, db.session.get_bind())
+
+    def test_explicit_bind_is_used(self):
+        engine = sa.create_engine(TestConfig.SQLALCHEMY_DATABASE_URI)
+        with self.app.test_request_context('/api/1/about/'):
+            self.assertIs(engine, db.session.get_bind(bind=engine))
+
+
+class TestReplicaDown(ClientTestCase):
+    def setUp(self):
+        super().setUp()
+        self.binds = self.app.config['SQLALCHEMY_BINDS']
+        self.app.config['SQLALCHEMY_BINDS'] = {
+            'replica': 'postgresql://postgres:@/replica?host=/nonexistent'}
+
+    def tearDown(self):
+        db.session.remove()
+        db.get_engine(bind='replica').dispose()
+        iatilib._replica_down_until.clear()
+        self.app.config['SQLALCHEMY_BINDS'] = self.binds
+        super().tearDown()
+
+    def test_reads_from_primary(self):
+        fac.ActivityFactory.create(iati_identifier=u"a1")
+        resp = self.client.get('/api/1/access/activity.db.json')
+        self.assertEquals(200, resp.status_code)
+        self.assertEquals(1, len(json.loads(resp.data)['iati-activities']))
+
+    def test_connect_timeout(self):
+        replica = db.get_engine(bind='replica')
+        with mock.patch.object(replica.dialect, 'connect') as connect:
+            connect.side_effect = replica.dialect.dbapi.OperationalError
+            self.client.get('/api/1/access/activity.db.json').close()
+        self.assertEquals(
+            self.app.config['REPLICA_CONNECT_TIMEOUT'],
+            connect.call_args[1]['connect_timeout'])
+
+    def test_not_retried_until_interval(self):
+        replica = db.get_engine(bind='replica')
+        with mock.patch.object(replica, 'connect', wraps=replica.connect) \
+                as connect:
+            self.client.get('/api/1/access/activity.db.json').close()
+            self.client.get('/api/1/access/activity.db.json').close()
+            self.assertEquals(1, connect.call_count)
+            with mock.patch('iatilib.time.monotonic',
+                            return_value=time.monotonic() + 60):
+                self.client.get('/api/1/access/activity.db.json').close()
+            self.assertEquals(2, connect.call_count)
+
+
+class TestTransactionFilters(ClientTestCase):
+    def test_transaction_endpoint(self):
+        activity = fac.ActivityFactory.create(iati_identifier=u"a1")
+        fac.TransactionFactory.create(
+            activity=activity, ref=u"t-in",
+            type=codelists.TransactionType.disbursement)
+        fac.TransactionFactory.create(activity=activity, ref=u"t-not")
+        resp = self.client.get(
+            '/api/1/access/transaction.csv?transaction-type=3')
+        self.assertEquals(200, resp.status_code)
+        output = resp.get_data(as_text=True)
+        self.assertIn(u"t-in", output)
+        self.assertNotIn(u"t-not", output)
+
+    def test_unknown_type(self):
+        resp = self.client.get(
+            '/api/1/access/transaction.csv?transaction-type=ZZ')
+        self.assertEquals(400, resp.status_code)
+
+    def test_activity_endpoint(self):
+        resp = self.client.get(
+            '/api/1/access/activity.csv?transaction-date__gt=2020-01-01')
+        self.assertEquals(400, resp.status_code)
+        self.assertIn(u"transaction-date__gt", resp.get_data(as_text=True))
+
+
+class TestAggregate(ClientTestCase):
+    def query(self, url):
+        resp = self.client.get(url)
+        self.assertEquals(200, resp.status_code)
+        return json.loads(resp.get_data(as_text=True))["results"]
+
+    def test_total(self):
+        fac.TransactionFactory.create(value_usd=10, value_eur=8)
+        fac.TransactionFactory.create(value_usd=5, value_eur=4)
+        self.assertEquals(
+            [{"count": 2, "value-usd": "15.00", "value-eur": "12.00"}],
+            self.query('/api/1/access/transaction/aggregate'))
+
+    def test_group_by_country_and_year(self):
+        activity = fac.ActivityFactory.create(
+            recipient_country_percentages=[
+                fac.CountryPercentageFactory.build(
+                    country=codelists.Country.malawi, percentage=60),
+                fac.CountryPercentageFactory.build(
+                    country=codelists.Country.zambia, percentage=40),
+            ])
+        fac.TransactionFactory.create(
+            activity=activity, value_usd=10, date=datetime(2020, 3, 1).date())
+        fac.TransactionFactory.create(
+            activity=activity, value_usd=5, date=datetime(2021, 3, 1).date())
+        results = self.query(
+            '/api/1/access/transaction/aggregate?group_by=country|year')
+        self.assertEquals(
+            [("MW", 2020, 1, "10.00"), ("MW", 2021, 1, "5.00"),
+             ("ZM", 2020, 1, "10.00"), ("ZM", 2021, 1, "5.00")],
+            [(r["country"], r["year"], r["count"], r["value-usd"])
+             for r in results])
+
+    def test_types_across_versions(self):
+        fac.TransactionFactory.create(
+            type=codelists.TransactionType.disbursement, value_usd=1)
+        fac.TransactionFactory.create(
+            type=codelists.by_major_version['2'].TransactionType.disbursement,
+            value_usd=2)
+        self.assertEquals(
+            [{"type": "3", "count": 2, "value-usd": "3.00",
+              "value-eur": None}],
+            self.query('/api/1/access/transaction/aggregate?group_by=type'))
+
+    def test_filters(self):
+        fac.TransactionFactory.create(
+            type=codelists.TransactionType.disbursement, value_usd=1)
+        fac.TransactionFactory.create(value_usd=2)
+        results = self.query(
+            '/api/1/access/transaction/aggregate?transaction-type=3')
+        self.assertEquals([(1, "1.00")], [
+            (r["count"], r["value-usd"]) for r in results])
+
+    def test_csv(self):
+        fac.TransactionFactory.create(
+            activity=fac.ActivityFactory.create(publisher=u"pub"),
+            value_usd=10)
+        resp = self.client.get(
+            '/api/1/access/transaction/aggregate.csv?group_by=publisher')
+        self.assertEquals(200, resp.status_code)
+        self.assertEquals("text/csv", resp.mimetype)
+        rows = list(csv.reader(StringIO(resp.get_data(as_text=True))))
+        self.assertEquals(
+            [["publisher", "count", "value-usd", "value-eur"],
+             ["pub", "1", "10", ""]],
+            rows)
+
+    def test_budget(self):
+        org = fac.OrganisationFactory.create(ref=u"org-1")
+        activity = fac.ActivityFactory.create(reporting_org=org)
+        fac.BudgetFactory.create(activity=activity, value_usd=7)
+        fac.BudgetFactory.create(activity=activity, value_usd=3)
+        self.assertEquals(
+            [{"reporting-org": "org-1", "count": 2, "value-usd": "10.00",
+              "value-eur": None}],
+            self.query(
+                '/api/1/access/budget/aggregate?group_by=reporting-org'))
+
+    def test_unknown_group(self):
+        resp = self.client.get(
+            '/api/1/access/transaction/aggregate?group_by=colour')
+        self.assertEquals(400, resp.status_code)
+
+    def test_budget_transaction_filter(self):
+        resp = self.client.get(
+            '/api/1/access/budget/aggregate?transaction-type=3')
+        self.assertEquals(400, resp.status_code)
+
+    def test_invalid_format(self):
+        resp = self.client.get('/api/1/access/transaction/aggregate.xml')
+        self.assertEquals(404, resp.status_code)
+
+
+class TestActivityBreakdownTotals(ClientTestCase):
+    def rows(self, url):
+        resp = self.client.get(url)
+        self.assertEquals(200, resp.status_code)
+        return list(csv.DictReader(StringIO(resp.get_data(as_text=True))))
+
+    def test_totals_on_each_country(self):
+        activity = fac.ActivityFactory.create(
+            recipient_country_percentages=[
+                fac.CountryPercentageFactory.build(
+                    country=codelists.Country.malawi),
+                fac.CountryPercentageFactory.build(
+                    country=codelists.Country.zambia),
+            ])
+        for amount in (10, 5):
+            fac.TransactionFactory.create(
+                activity=activity, value_amount=amount, value_usd=amount)
+        fac.TransactionFactory.create(
+            activity=activity, value_amount=1, value_usd=1,
+            value_currency=codelists.Currency.euro,
+            type=codelists.TransactionType.disbursement)
+        rows = self.rows('/api/1/access/activity/by_country.csv')
+        self.assertEquals(
+            [("MW", "!Mixed currency", "15", "15", "1"),
+             ("ZM", "!Mixed currency", "15", "15", "1")],
+            sorted(
+                (r["recipient-country-code"], r["currency"],
+                 r["total-Commitment"], r["total-Commitment-USD"],
+                 r["total-Disbursement"])
+                for r in rows))
+
+    def test_activity_without_transactions(self):
+        fac.ActivityFactory.create(
+            sector_percentages=[fac.SectorPercentageFactory.build()])
+        rows = self.rows('/api/1/access/activity/by_sector.csv')
+        self.assertEquals(
+            [("", "0", "0")],
+            [(r["currency"], r["total-Commitment"], r["total-Commitment-EUR"])
+             for r in rows])
+
+
+class TestSplitValues(ClientTestCase):
+    def setUp(self):
+        super().setUp()
+        self.activity = fac.ActivityFactory.create(
+            recipient_country_percentages=[
+                fac.CountryPercentageFactory.build(
+                    country=codelists.Country.malawi, percentage=60),
+                fac.CountryPercentageFactory.build(
+                    country=codelists.Country.zambia, percentage=None),
+            ],
+            sector_percentages=[
+                fac.SectorPercentageFactory.build(percentage=25),
+            ])
+
+    def rows(self, url):
+        resp = self.client.get(url)
+        self.assertEquals(200, resp.status_code)
+        return list(csv.DictReader(StringIO(resp.get_data(as_text=True))))
+
+    def test_transaction_by_country(self):
+        fac.TransactionFactory.create(
+            activity=self.activity, value_amount=10, value_usd=20,
+            value_eur=30)
+        rows = self.rows(
+            '/api/1/access/transaction/by_country.csv?split=True')
+        self.assertEquals(
+            [("MW", "6.00", "12.00", "18.00"),
+             ("ZM", "10.00", "20.00", "30.00")],
+            sorted(
+                (r["recipient-country-code"], r["transaction-value-split"],
+                 r["transaction-value-USD-split"],
+                 r["transaction-value-EUR-split"])
+                for r in rows))
+
+    def test_budget_by_sector(self):
+        fac.BudgetFactory.create(
+            activity=self.activity, value_amount=8, value_usd=4)
+        rows = self.rows('/api/1/access/budget/by_sector.csv?split=True')
+        self.assertEquals(
+            [("2.00", "1.00", "")],
+            [(r["budget-value-split"], r["budget-value-USD-split"],
+              r["budget-value-EUR-split"]) for r in rows])
+
+    def test_optional(self):
+        fac.TransactionFactory.create(activity=self.activity)
+        rows = self.rows('/api/1/access/transaction/by_country.csv')
+        self.assertNotIn("transaction-value-split", rows[0])
+
+    def test_not_on_lists(self):
+        resp = self.client.get('/api/1/access/transaction.csv?split=True')
+        self.assertEquals(400, resp.status_code)
+
+    def test_aggregate(self):
+        fac.TransactionFactory.create(activity=self.activity, value_usd=20)
+        resp = self.client.get(
+            '/api/1/access/transaction/aggregate?group_by=country|sector')
+        results = json.loads(resp.get_data(as_text=True))["results"]
+        self.assertEquals(
+            [("MW", "20.00", "3.00"), ("ZM", "20.00", "5.00")],
+            [(r["country"], r["value-usd"], r["split-value-usd"])
+             for r in results])
+
+
+class TestCursorPaging(ClientTestCase):
+    def query(self, url):
+        return json.loads(self.client.get(url).get_data(as_text=True))
+
+    def test_walk_activities(self):
+        for ident in (u"a1", u"a2", u"a3"):
+            fac.ActivityFactory.create(iati_identifier=ident)
+        data = self.query('/api/1/access/activity.db.json?limit=2')
+        self.assertEquals(
+            [u"a1", u"a2"],
+            [a["iati-identifier"] for a in data["iati-activities"]])
+        data = self.query(
+            '/api/1/access/activity.db.json?limit=2&after=' + data["next-cursor"])
+        self.assertEquals(
+            [u"a3"], [a["iati-identifier"] for a in data["iati-activities"]])
+        self.assertEquals(None, data["next-cursor"])
+
+    def test_offset_still_works(self):
+        for ident in (u"a1", u"a2", u"a3"):
+            fac.ActivityFactory.create(iati_identifier=ident)
+        data = self.query('/api/1/access/activity.db.json?limit=1&offset=1')
+        self.assertEquals(
+            [u"a2"], [a["iati-identifier"] for a in data["iati-activities"]])
+
+    def test_transaction_link_header(self):
+        activity = fac.ActivityFactory.create(iati_identifier=u"a1")
+        for ref in (u"t1", u"t2", u"t3"):
+            fac.TransactionFactory.create(activity=activity, ref=ref)
+        resp = self.client.get(
+            '/api/1/access/transaction.csv?limit=2&offset=0')
+        self.assertEquals(3, len(resp.get_data(as_text=True).splitlines()))
+        link = resp.headers["Link"]
+        self.assertTrue(link.endswith('>; rel="next"'))
+        self.assertNotIn("offset=", link)
+        next_url = link[1:link.index('>')]
+        resp = self.client.get(next_url)
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEquals(2, len(lines))
+        self.assertIn(u"t3", lines[1])
+        self.assertNotIn("Link", resp.headers)
+
+    def test_invalid_cursor(self):
+        resp = self.client.get('/api/1/access/activity/?after=junk')
+        self.assertEquals(400, resp.status_code)
+
+    def test_cursor_for_other_endpoint(self):
+        cursor = validators.encode_cursor([u"a1", 1])
+        resp = self.client.get('/api/1/access/activity/?after=' + cursor)
+        self.assertEquals(400, resp.status_code)
+
+    def test_cursor_of_wrong_types(self):
+        for values in ([1], [{}], [None], [[u"a1"]]):
+            cursor = validators.encode_cursor(values)
+            resp = self.client.get('/api/1/access/activity/?after=' + cursor)
+            self.assertEquals(400, resp.status_code)
+        cursor = validators.encode_cursor([u"a1", u"1"])
+        resp = self.client.get('/api/1/access/transaction.csv?after=' + cursor)
+        self.assertEquals(400, resp.status_code)
+
+    def test_no_cursor_for_breakdowns(self):
+        cursor = validators.encode_cursor([u"a1"])
+        resp = self.client.get(
+            '/api/1/access/activity/by_country.csv?after=' + cursor)
+        self.assertEquals(400, resp.status_code)
+
+
 class ApiViewMixin(object):
     @mock.patch('iatilib.frontend.api1.validators.activity_api_args')
     def test_validator_called(self, mock):
@@ -46,6 +46,27 @@ class ConsoleTestCase(AppTestCase):
         self.assertEquals(1, prompt_mock.call_count)
         self.assertEquals(1, drop_all_mock.call_count)
 
+    def test_benchmark_compression(self):
+        activity = fac.ActivityFactory.create()
+        for ref in (u"t1", u"t2"):
+            fac.TransactionFactory.create(activity=activity, ref=ref)
+        result = self.runner.invoke(console.benchmark_compression)
+        self.assertEquals(0, result.exit_code)
+        lines = result.output.splitlines()
+        self.assertTrue(lines[1].startswith("identity"))
+        self.assertTrue(lines[2].startswith("gzip"))
+
+    def test_benchmark_compression_is_capped(self):
+        activity = fac.ActivityFactory.create()
+        for ref in (u"t1", u"t2"):
+            fac.TransactionFactory.create(activity=activity, ref=ref)
+        result = self.runner.invoke(
+            console.benchmark_compression, ['--max-mb', '0.0001'])
+        self.assertEquals(0, result.exit_code)
+        lines = result.output.splitlines()
+        self.assertTrue(lines[0].startswith("Compressing the first"))
+        self.assertTrue(lines[2].startswith("identity"))
+
     @mock.patch('iatilib.rq.get_queue')
     def test_status_cmd(self, rq_mock):
         result = self.runner.invoke(crawler.status_cmd)
@@ -1,10 +1,12 @@
 import csv
 import datetime
 
+import mock
+
 from iatilib.test import db, AppTestCase, fixture_filename
 from iatilib import model
 from iatilib import codelists
-from iatilib.currency_conversion import update_exchange_rates, convert_currency_usd, convert_currency_eur
+from iatilib.currency_conversion import update_exchange_rates, convert_currency_usd, convert_currency_eur, RATES_VERSION
 
 def read_fixture(fix_name, encoding='utf-8'):
     """Read and convert fixture from csv file"""
@@ -35,6 +37,37 @@ class TestUpdateExchangeRates(AppTestCase):
         self.assertEquals(db.session.query(model.CurrencyConversion).first().rate, 16.926)
         self.assertEquals(db.session.query(model.CurrencyConversion).first().currency, "AFN")
 
+    def test_reload_is_idempotent(self):
+        update_exchange_rates(self.data)
+        data = read_fixture("imf_exchangerates.csv")
+        next(data, None)
+        update_exchange_rates(data)
+
+        self.assertEquals(db.session.query(model.CurrencyConversion).count(), 6035)
+        self.assertEquals(model.DataVersion.current(RATES_VERSION), 1)
+
+    def test_reload_applies_corrected_rate(self):
+        rows = list(self.data)
+        update_exchange_rates(rows)
+        rows[0][1] = '17.5'
+        update_exchange_rates(rows)
+
+        self.assertEquals(db.session.query(model.CurrencyConversion).count(), 6035)
+        rate = db.session.query(model.CurrencyConversion.rate).filter_by(
+            currency=rows[0][2], date=create_date(rows[0][0]),
+            country_code=rows[0][5]).scalar()
+        self.assertEquals(rate, 17.5)
+        self.assertEquals(model.DataVersion.current(RATES_VERSION), 2)
+
+    def test_reload_without_country_code_is_idempotent(self):
+        rows = [row[:5] + ['', ''] for row in self.data if row[2] == 'AFN']
+        update_exchange_rates(rows)
+        update_exchange_rates(rows)
+
+        self.assertEquals(db.session.query(model.CurrencyConversion).count(), len(rows))
+        self.assertEquals(db.session.query(model.CurrencyConversion).filter_by(country_code='').count(), len(rows))
+        self.assertEquals(model.DataVersion.current(RATES_VERSION), 1)
+
 
 class TestConvertCurrencyUSD(AppTestCase):
     """Test converting currencies to USD"""
@@ -72,3 +105,32 @@ class TestConvertCurrencyEUR(AppTestCase):
         self.assertEquals(convert_currency_eur(99.12, create_date("2021-06-15"), create_currency("USD"), cache_key='test-imf'), 81.24)
         self.assertEquals(convert_currency_eur(0.00, create_date("2005-12-05"), create_currency("AFN"), cache_key='test-imf'), 0.00)
         self.assertEquals(convert_currency_eur(32.49, create_date("2017-06-01"), create_currency("ZZZ"), cache_key='test-imf'), None)
+
+
+class TestRatesVersion(AppTestCase):
+    """Test the conversion cache follows the rates table version"""
+    def setUp(self):
+        super().setUp()
+        self.data = read_fixture("imf_exchangerates.csv")
+        next(self.data, None)
+        update_exchange_rates(self.data)
+
+    def change_afn_rate(self, rate):
+        db.session.query(model.CurrencyConversion).filter(
+            model.CurrencyConversion.currency == 'AFN').update({'rate': rate})
+        model.DataVersion.bump(RATES_VERSION)
+        db.session.commit()
+
+    def test_update_bumps_version(self):
+        self.assertEquals(model.DataVersion.current(RATES_VERSION), 1)
+
+    def test_cache_kept_between_version_checks(self):
+        self.assertEquals(convert_currency_usd(512.87, create_date("1973-12-05"), create_currency("AFN"), cache_key='test-imf'), 13.47)
+        self.change_afn_rate(1.0)
+        self.assertEquals(convert_currency_usd(512.87, create_date("1973-12-05"), create_currency("AFN"), cache_key='test-imf'), 13.47)
+
+    def test_cache_rebuilt_when_version_changes(self):
+        self.assertEquals(convert_currency_usd(512.87, create_date("1973-12-05"), create_currency("AFN"), cache_key='test-imf'), 13.47)
+        self.change_afn_rate(1.0)
+        with mock.patch('iatilib.currency_conversion.VERSION_CHECK_INTERVAL', 0):
+            self.assertEquals(convert_currency_usd(512.87, create_date("1973-12-05"), create_currency("AFN"), cache_key='test-imf'), 512.87)
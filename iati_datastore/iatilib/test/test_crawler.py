@@ -8,8 +8,9 @@ import iatikit
 from . import AppTestCase, fixture_filename
 from . import factories as fac
 
-from iatilib import crawler, db, parse
-from iatilib.model import Dataset, Log, Resource, Activity, DeletedActivity
+from iatilib import crawler, db, parse, summary
+from iatilib.model import (
+    Dataset, Log, Resource, Activity, DeletedActivity, DataVersion)
 
 
 registry = iatikit.data(
@@ -317,3 +318,61 @@ class TestResourceUpdate(AppTestCase):
             u"orig",
             Activity.query.get(u"47045-ARM-202-G05-H-00").title
         )
+
+    def test_update_activities_copies_dataset(self):
+        fac.DatasetFactory.create(
+            name='tst-b',
+            publisher=u"tst",
+            resources=[fac.ResourceFactory.create(
+                url=u"http://res2",
+                document=open(fixture_filename("single_activity.xml")).read().encode()
+            )]
+        )
+        crawler.update_activities("tst-b")
+        activity = Activity.query.one()
+        self.assertEquals(u"tst-b", activity.dataset_id)
+        self.assertEquals(u"tst", activity.publisher)
+
+    @mock.patch('iatikit.data')
+    def test_fetch_dataset_updates_activity_publisher(self, iatikit_mock):
+        iatikit_mock.return_value = registry
+        dataset = fac.DatasetFactory.create(
+            name='old-org-acts', publisher=u"older-org", resources=[])
+        fac.ActivityFactory.create(resource=fac.ResourceFactory.build(
+            url=u"https://old-org.nl/sites/default/files/IATI/activities.xml",
+            dataset_id=u"old-org-acts"))
+        self.assertEquals(u"older-org", Activity.query.one().publisher)
+        crawler.fetch_dataset_metadata(dataset)
+        db.session.commit()
+        self.assertEquals(u"old-org", Activity.query.one().publisher)
+        self.assertEquals(1, DataVersion.current(crawler.CRAWL_VERSION))
+
+    def test_activities_copy_dataset_and_publisher(self):
+        fac.DatasetFactory.create(name=u"tst", publisher=u"pub", resources=[])
+        activity = fac.ActivityFactory.create(resource=fac.ResourceFactory.build(
+            url=u"http://res", dataset_id=u"tst"))
+        self.assertEquals(
+            (u"tst", u"pub"), (activity.dataset_id, activity.publisher))
+
+    def test_update_activities_bumps_crawl_version(self):
+        fac.DatasetFactory.create(
+            name='tst-b',
+            resources=[fac.ResourceFactory.create(
+                url=u"http://res2",
+                document=open(fixture_filename("single_activity.xml")).read().encode()
+            )]
+        )
+        crawler.update_activities("tst-b")
+        self.assertEquals(1, DataVersion.current(crawler.CRAWL_VERSION))
+
+    def test_update_activities_refreshes_summary(self):
+        fac.DatasetFactory.create(
+            name='tst-b',
+            resources=[fac.ResourceFactory.create(
+                url=u"http://res2",
+                document=open(fixture_filename("single_activity.xml")).read().encode()
+            )]
+        )
+        self.assertIsNone(summary.get()['last_parsed'])
+        crawler.update_activities("tst-b")
+        self.assertIsNotNone(summary.get()['last_parsed'])
@@ -47,6 +47,26 @@ class TestActivityFilter(AppTestCase):
         self.assertIn(act_in, activities.all())
         self.assertNotIn(act_not, activities.all())
 
+    def test_by_description_regex(self):
+        act_in = fac.ActivityFactory.create(description_all_values={'en': {'1': 'Phase 2 of the programme'}})
+        act_not = fac.ActivityFactory.create(description_all_values={'en': {'1': 'Phase two of the programme'}})
+        with self.app.test_request_context('/'):
+            activities = dsfilter.activities({
+                "description": u"Phase [0-9]"
+            })
+        self.assertIn(act_in, activities.all())
+        self.assertNotIn(act_not, activities.all())
+
+    def test_by_description_with_quote(self):
+        act_in = fac.ActivityFactory.create(description_all_values={'en': {'1': 'The "Clean Water" programme'}})
+        act_not = fac.ActivityFactory.create(description_all_values={'en': {'1': 'The Clean Water programme'}})
+        with self.app.test_request_context('/'):
+            activities = dsfilter.activities({
+                "description": u'"Clean Water"'
+            })
+        self.assertIn(act_in, activities.all())
+        self.assertNotIn(act_not, activities.all())
+
     def test_by_country_code(self):
         act_in = fac.ActivityFactory.create(
             recipient_country_percentages=[
@@ -303,6 +323,30 @@ class TestActivityFilter(AppTestCase):
         self.assertIn(act_a, activities.all())
         self.assertIn(act_b, activities.all())
         self.assertNotIn(act_not, activities.all())
+        self.assertEquals(2, str(activities.statement).count("SELECT"))
+
+    def test_or_filter_many_countries(self):
+        act_a = fac.ActivityFactory.create(
+            recipient_country_percentages=[
+                fac.CountryPercentageFactory.build(country=cl.Country.libya),
+            ])
+        act_b = fac.ActivityFactory.create()
+        fac.TransactionFactory.create(
+            activity=act_b,
+            recipient_country_percentages=[
+                fac.CountryPercentageFactory.build(country=cl.Country.somalia),
+            ])
+        act_not = fac.ActivityFactory.create(
+            recipient_country_percentages=[
+                fac.CountryPercentageFactory.build(country=cl.Country.zambia),
+            ])
+        activities = dsfilter.activities({
+            "recipient-country": u"LY|SO|KE|AF|UG"
+        })
+        self.assertIn(act_a, activities.all())
+        self.assertIn(act_b, activities.all())
+        self.assertNotIn(act_not, activities.all())
+        self.assertEquals(1, str(activities.statement).count("&&"))
 
     def test_by_recipient_region_text(self):
         act_in = fac.ActivityFactory.create(
@@ -593,6 +637,17 @@ class TestActivityFilter(AppTestCase):
         self.assertIn(act_in, activities.all())
         self.assertNotIn(act_not, activities.all())
 
+    def test_start_actual_overrides_planned(self):
+        act_in = fac.ActivityFactory.create(start_planned=datetime.date(2000, 1, 1))
+        act_not = fac.ActivityFactory.create(
+            start_planned=datetime.date(2000, 1, 1),
+            start_actual=datetime.date(2013, 1, 1))
+        activities = dsfilter.activities({
+            "start-date__lt": datetime.date(2010, 1, 1)
+        })
+        self.assertIn(act_in, activities.all())
+        self.assertNotIn(act_not, activities.all())
+
     def test_end_actual_lesser_than(self):
         act_in = fac.ActivityFactory.create(end_actual=datetime.date(2000, 1, 1))
         act_not = fac.ActivityFactory.create(end_actual=datetime.date(2013, 1, 1))
@@ -681,6 +736,15 @@ class TestActivityFilter(AppTestCase):
         self.assertIn(act_in, activities.all())
         self.assertNotIn(act_not, activities.all())
 
+    def test_publisher(self):
+        act_in = fac.ActivityFactory.create(publisher=u"aaa")
+        act_not = fac.ActivityFactory.create(publisher=u"zzz")
+        activities = dsfilter.activities({
+            "publisher": u"aaa|bbb"
+        })
+        self.assertIn(act_in, activities.all())
+        self.assertNotIn(act_not, activities.all())
+
 
 class TestTransactionFilter(AppTestCase):
     def test_by_country_code(self):
@@ -763,6 +827,74 @@ class TestTransactionFilter(AppTestCase):
         self.assertIn(trans_in, transactions.all())
         self.assertNotIn(trans_not, transactions.all())
 
+    def test_by_transaction_date(self):
+        activity = fac.ActivityFactory.create()
+        trans_in = fac.TransactionFactory.create(
+            activity=activity, date=datetime.date(2020, 1, 1))
+        trans_not = fac.TransactionFactory.create(
+            activity=activity, date=datetime.date(2019, 1, 1))
+        transactions = dsfilter.transactions({
+            "transaction-date__gt": datetime.date(2019, 6, 1)
+        })
+        self.assertIn(trans_in, transactions.all())
+        self.assertNotIn(trans_not, transactions.all())
+
+    def test_by_transaction_type(self):
+        activity = fac.ActivityFactory.create()
+        trans_in = fac.TransactionFactory.create(
+            activity=activity, type=cl.TransactionType.disbursement)
+        trans_not = fac.TransactionFactory.create(
+            activity=activity, type=cl.TransactionType.commitment)
+        transactions = dsfilter.transactions({
+            "transaction-type": [u"D", u"3"]
+        })
+        self.assertEquals([trans_in], transactions.all())
+        self.assertNotIn(trans_not, transactions.all())
+
+    def test_by_value_usd(self):
+        activity = fac.ActivityFactory.create()
+        trans_in = fac.TransactionFactory.create(
+            activity=activity, value_usd=100)
+        trans_not = fac.TransactionFactory.create(
+            activity=activity, value_usd=1)
+        transactions = dsfilter.transactions({
+            "value-usd__gt": 50.0
+        })
+        self.assertEquals([trans_in], transactions.all())
+        self.assertNotIn(trans_not, transactions.all())
+
+    def test_by_transaction_country(self):
+        activity = fac.ActivityFactory.create()
+        trans_in = fac.TransactionFactory.create(
+            activity=activity,
+            recipient_country_percentages=[
+                fac.CountryPercentageFactory.build(country=cl.Country.libya)])
+        trans_not = fac.TransactionFactory.create(
+            activity=activity,
+            recipient_country_percentages=[
+                fac.CountryPercentageFactory.build(country=cl.Country.zambia)])
+        transactions = dsfilter.transactions({
+            "transaction_recipient-country": [cl.Country.libya]
+        })
+        self.assertEquals([trans_in], transactions.all())
+        self.assertNotIn(trans_not, transactions.all())
+
+    def test_by_transaction_sector(self):
+        activity = fac.ActivityFactory.create()
+        trans_in = fac.TransactionFactory.create(
+            activity=activity,
+            sector_percentages=[fac.SectorPercentageFactory.build(
+                sector=cl.Sector.teacher_training)])
+        trans_not = fac.TransactionFactory.create(
+            activity=activity,
+            sector_percentages=[fac.SectorPercentageFactory.build(
+                sector=cl.Sector.primary_education)])
+        transactions = dsfilter.transactions({
+            "transaction_sector": [cl.Sector.teacher_training]
+        })
+        self.assertEquals([trans_in], transactions.all())
+        self.assertNotIn(trans_not, transactions.all())
+
 
 class TestBudgetFilter(AppTestCase):
     def test_by_country_code(self):
@@ -906,6 +1038,116 @@ class TestParticipatingOrgWithRoleFilter(AppTestCase):
         self.assertNotIn(act_out2, activities.all())
 
 
+class TestSharedPathFilter(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        # AAA funds and BBB implements, so the ref and role filters
+        # below match different participation rows
+        self.act_split = fac.ActivityFactory.create(
+                participating_orgs=[
+                    fac.ParticipationFactory.build(
+                        organisation__ref=u"AAA",
+                        organisation__type="10",
+                        role="1"),
+                    fac.ParticipationFactory.build(
+                        organisation__ref=u"BBB",
+                        role="4"),
+                ])
+        self.act_same = fac.ActivityFactory.create(
+                participating_orgs=[
+                    fac.ParticipationFactory.build(
+                        organisation__ref=u"AAA",
+                        organisation__name=u"aaa",
+                        organisation__type="10",
+                        role="4"),
+                ])
+        self.act_not = fac.ActivityFactory.create(
+                participating_orgs=[
+                    fac.ParticipationFactory.build(
+                        organisation__ref=u"BBB",
+                        role="1"),
+                ])
+
+    def test_any_row(self):
+        activities = dsfilter.activities({
+            "participating-org.ref": u"AAA",
+            "participating-org.role": u"4",
+            "participating-org.type": u"10",
+        })
+        self.assertIn(self.act_split, activities.all())
+        self.assertIn(self.act_same, activities.all())
+        self.assertNotIn(self.act_not, activities.all())
+        self.assertEquals(2, str(activities.statement).count("SELECT"))
+
+    def test_same_row(self):
+        activities = dsfilter.activities({
+            "participating-org.ref": u"AAA",
+            "participating-org.role": u"4",
+            "participating-org.type": u"10",
+            "same-row": True,
+        })
+        self.assertEquals([self.act_same], activities.all())
+
+    def test_transactions_on_shared_path(self):
+        trans_in = fac.TransactionFactory.create(
+            activity=self.act_split,
+            ref=u"t1",
+            provider_org=fac.OrganisationFactory.build(ref=u"prov"))
+        trans_sibling = fac.TransactionFactory.create(
+            activity=self.act_split,
+            ref=u"t2")
+        trans_not = fac.TransactionFactory.create(
+            activity=self.act_same,
+            ref=u"t1")
+        transactions = dsfilter.transactions({
+            "transaction.ref": u"t1",
+            "transaction_provider-org.ref": u"prov",
+            "same-row": True,
+        })
+        self.assertIn(trans_in, transactions.all())
+        self.assertIn(trans_sibling, transactions.all())
+        self.assertNotIn(trans_not, transactions.all())
+
+
+class TestBreakdownFilter(AppTestCase):
+    def test_activities_by_country(self):
+        act_in = fac.ActivityFactory.create(
+            recipient_country_percentages=[
+                fac.CountryPercentageFactory.build(
+                    country=cl.Country.libya, percentage=60),
+                fac.CountryPercentageFactory.build(
+                    country=cl.Country.zambia, percentage=40),
+            ])
+        fac.ActivityFactory.create(
+            recipient_country_percentages=[
+                fac.CountryPercentageFactory.build(
+                    country=cl.Country.zambia),
+            ])
+        rows = dsfilter.activities_by_country({
+            "recipient-country": cl.Country.from_string(u"LY")
+        }).all()
+        self.assertEquals(
+            [(act_in, cl.Country.libya, 60), (act_in, cl.Country.zambia, 40)],
+            sorted(
+                [(r.Activity, r.CountryPercentage.country,
+                  r.CountryPercentage.percentage) for r in rows],
+                key=lambda r: -r[2])
+        )
+
+    def test_transactions_by_sector(self):
+        trans = fac.TransactionFactory.create(
+            activity=fac.ActivityFactory.build(
+                sector_percentages=[
+                    fac.SectorPercentageFactory.build(
+                        sector=cl.Sector.teacher_training),
+                ]))
+        rows = dsfilter.transactions_by_sector({}).all()
+        self.assertEquals(
+            [(trans, cl.Sector.teacher_training)],
+            [(r.Transaction, r.SectorPercentage.sector) for r in rows]
+        )
+
+
 class TestActivityFile2ManyTitlesAndDescriptions(AppTestCase):
 
     def setUp(self):
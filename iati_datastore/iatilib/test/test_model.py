@@ -1,8 +1,10 @@
+import datetime
+
 from . import AppTestCase
 from . import factories as fac
 
-from iatilib.model import Activity, Resource
-from iatilib import db
+from iatilib.model import Activity, ActivityFacet, ActivityTotal, Resource
+from iatilib import codelists, db
 
 
 class TestResource(AppTestCase):
@@ -64,6 +66,165 @@ class TestResource(AppTestCase):
         db.engine.echo = False
 
 
+class TestActivityFacet(AppTestCase):
+    def facets(self, activity):
+        return set(
+            db.session.query(ActivityFacet.facet, ActivityFacet.value)
+            .filter_by(activity_id=activity.iati_identifier)
+        )
+
+    def test_facets_from_activity_and_transactions(self):
+        act = fac.ActivityFactory.create(
+            recipient_country_percentages=[
+                fac.CountryPercentageFactory.build(
+                    country=codelists.Country.libya, name=u"Libya"),
+            ],
+        )
+        fac.TransactionFactory.create(
+            activity=act,
+            sector_percentages=[fac.SectorPercentageFactory.build()],
+            provider_org=fac.OrganisationFactory.build(
+                ref=u"prov", name=u"Provider"),
+        )
+        self.assertEquals(self.facets(act), {
+            (u"recipient-country.text", u"Libya"),
+            (u"transaction_provider-org", u"prov"),
+            (u"transaction_provider-org.text", u"Provider"),
+        })
+
+    def test_facets_follow_changes(self):
+        act = fac.ActivityFactory.create(
+            recipient_country_percentages=[
+                fac.CountryPercentageFactory.build(
+                    country=codelists.Country.libya),
+            ],
+        )
+        act.recipient_country_percentages = [
+            fac.CountryPercentageFactory.build(
+                country=codelists.Country.somalia),
+        ]
+        db.session.commit()
+        self.assertEquals(self.facets(act), {
+            (u"recipient-country.text", u""),
+        })
+        self.assertEquals(act.recipient_country_codes, [u"SO"])
+
+    def test_code_arrays(self):
+        act = fac.ActivityFactory.create(
+            recipient_country_percentages=[
+                fac.CountryPercentageFactory.build(
+                    country=codelists.Country.libya),
+            ],
+            participating_orgs=[
+                fac.ParticipationFactory.build(
+                    organisation=fac.OrganisationFactory.build(ref=u"org"),
+                    role=codelists.OrganisationRole.funding),
+            ],
+            policy_markers=[fac.PolicyMarkerFactory.build()],
+        )
+        fac.TransactionFactory.create(
+            activity=act,
+            recipient_country_percentages=[
+                fac.CountryPercentageFactory.build(
+                    country=codelists.Country.somalia),
+            ],
+            sector_percentages=[fac.SectorPercentageFactory.build()],
+        )
+        self.assertEquals(
+            sorted(act.recipient_country_codes), [u"LY", u"SO"])
+        self.assertEquals(act.recipient_region_codes, [])
+        self.assertEquals(act.sector_codes, [u"11130"])
+        self.assertEquals(act.participating_org_refs, [u"org"])
+        self.assertEquals(act.participating_org_role_refs, [u"Funding:org"])
+        self.assertEquals(act.policy_marker_codes, [u"1"])
+
+    def test_search_columns(self):
+        act = fac.ActivityFactory.create(
+            title=u"Title",
+            title_all_values={u"en": u"Title", u"fr": u"Titre"},
+            description=u"",
+            description_all_values={u"en": {u"1": u"General", u"2": u"Goals"}},
+        )
+        self.assertEquals(act.title_search, u"Title\nTitle\nTitre")
+        self.assertEquals(act.description_search, u"\nGeneral\nGoals")
+
+    def test_facets_removed_with_activity(self):
+        res = fac.ResourceFactory.create(
+            activities=[fac.ActivityFactory.build(
+                participating_orgs=[fac.ParticipationFactory.build()],
+            )]
+        )
+        Activity.query.filter_by(resource_url=res.url).delete()
+        db.session.commit()
+        self.assertEquals(ActivityFacet.query.count(), 0)
+
+
+class TestActivityTotal(AppTestCase):
+    def test_totals_by_type(self):
+        act = fac.ActivityFactory.create()
+        for amount in (10, 2.5):
+            fac.TransactionFactory.create(
+                activity=act, value_amount=amount, value_usd=amount * 2,
+                value_currency=codelists.Currency.pound_sterling)
+        fac.TransactionFactory.create(
+            activity=act, type=codelists.TransactionType.disbursement,
+            value_amount=7, value_eur=6,
+            value_currency=codelists.Currency.pound_sterling)
+        total = ActivityTotal.query.get(act.iati_identifier)
+        self.assertEquals(total.currency, codelists.Currency.pound_sterling)
+        self.assertFalse(total.mixed_currency)
+        self.assertEquals(total.commitment, 12.5)
+        self.assertEquals(total.commitment_usd, 25)
+        self.assertEquals(total.disbursement, 7)
+        self.assertEquals(total.disbursement_eur, 6)
+        self.assertEquals(total.expenditure, 0)
+
+    def test_mixed_currency(self):
+        act = fac.ActivityFactory.create()
+        fac.TransactionFactory.create(
+            activity=act, value_amount=1,
+            value_currency=codelists.Currency.us_dollar)
+        fac.TransactionFactory.create(
+            activity=act, value_amount=1, value_currency=None)
+        fac.TransactionFactory.create(
+            activity=act, type=codelists.TransactionType.disbursement,
+            value_amount=1, value_currency=codelists.Currency.us_dollar)
+        total = ActivityTotal.query.get(act.iati_identifier)
+        self.assertIsNone(total.currency)
+        self.assertTrue(total.mixed_currency)
+        self.assertIsNone(total.commitment)
+        self.assertEquals(total.disbursement, 1)
+
+    def test_totals_follow_changes(self):
+        trans = fac.TransactionFactory.create(value_amount=1)
+        act = trans.activity
+        trans.value_amount = 5
+        db.session.commit()
+        self.assertEquals(
+            ActivityTotal.query.get(act.iati_identifier).commitment, 5)
+        db.session.delete(trans)
+        db.session.commit()
+        self.assertIsNone(ActivityTotal.query.get(act.iati_identifier))
+
+
+class TestActivityEffectiveDates(AppTestCase):
+    def test_actual_over_planned(self):
+        act = fac.ActivityFactory.create(
+            start_planned=datetime.date(2012, 1, 1),
+            start_actual=datetime.date(2012, 2, 1),
+            end_planned=datetime.date(2014, 1, 1),
+        )
+        db.session.commit()
+        self.assertEquals(act.start_effective, datetime.date(2012, 2, 1))
+        self.assertEquals(act.end_effective, datetime.date(2014, 1, 1))
+
+    def test_follows_changes(self):
+        act = fac.ActivityFactory.create(end_planned=datetime.date(2014, 1, 1))
+        act.end_actual = datetime.date(2015, 1, 1)
+        db.session.commit()
+        self.assertEquals(act.end_effective, datetime.date(2015, 1, 1))
+
+
 class TestOrganisation(AppTestCase):
     def test_organisation_repr(self):
         org = fac.OrganisationFactory.build(ref='org ref')
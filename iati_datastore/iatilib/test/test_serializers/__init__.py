@@ -3,7 +3,8 @@ from io import StringIO
 
 import csv
 
-TestWrapper = namedtuple('TestWrapper', 'items total offset limit')
+TestWrapper = namedtuple(
+    'TestWrapper', 'items total offset limit next_cursor', defaults=[None])
 
 
 def load_csv(data):
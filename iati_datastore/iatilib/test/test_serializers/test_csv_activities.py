@@ -626,18 +626,21 @@ class TestActivityByCountry(CSVTstMixin, ActivityExample, AppTestCaseNoDb):
 
     def example(self):
         activity = super().example()
-        NT = namedtuple('ActivityCountryPercentage', 'Activity CountryPercentage')
+        NT = namedtuple('ActivityCountryPercentage', 'Activity CountryPercentage ActivityTotal')
+        totals = fac.ActivityTotalFactory.build(
+            currency=cl.Currency.pound_sterling, commitment=130000)
         return [
-            NT(activity, activity.recipient_country_percentages[0]),
-            NT(activity, activity.recipient_country_percentages[1])
+            NT(activity, activity.recipient_country_percentages[0], totals),
+            NT(activity, activity.recipient_country_percentages[1], totals)
         ]
 
     def test_column_list(self):
-        NT = namedtuple('ActivityCountryPercentage', 'Activity CountryPercentage')
+        NT = namedtuple('ActivityCountryPercentage', 'Activity CountryPercentage ActivityTotal')
         data = self.process([
             NT(
                 fac.ActivityFactory.build(iati_identifier=u"GB-1-123"),
-                fac.CountryPercentageFactory.build()
+                fac.CountryPercentageFactory.build(),
+                None
             )
         ])
         cols = [
@@ -785,6 +788,23 @@ class TestActivityByCountry(CSVTstMixin, ActivityExample, AppTestCaseNoDb):
         data = self.process(self.example())
         self.assertField({"total-Commitment": u"130000"}, data[0])
 
+    def test_mixed_currency(self):
+        rows = [
+            row._replace(ActivityTotal=fac.ActivityTotalFactory.build(
+                currency=None, mixed_currency=True, commitment=None,
+                commitment_usd=150))
+            for row in self.example()]
+        data = self.process(rows)
+        self.assertField({"currency": u"!Mixed currency"}, data[0])
+        self.assertField({"total-Commitment": u"!Mixed currency"}, data[0])
+        self.assertField({"total-Commitment-USD": u"150"}, data[0])
+
+    def test_no_transactions(self):
+        data = self.process(
+            [row._replace(ActivityTotal=None) for row in self.example()])
+        self.assertField({"currency": u""}, data[0])
+        self.assertField({"total-Commitment": u"0"}, data[0])
+
 
 class TestActivityBySector(CSVTstMixin, ActivityExample, AppTestCaseNoDb):
     def serialize(self, data):
@@ -792,18 +812,21 @@ class TestActivityBySector(CSVTstMixin, ActivityExample, AppTestCaseNoDb):
 
     def example(self):
         activity = super().example()
-        NT = namedtuple('ActivitySectorPercentage', 'Activity SectorPercentage')
+        NT = namedtuple('ActivitySectorPercentage', 'Activity SectorPercentage ActivityTotal')
+        totals = fac.ActivityTotalFactory.build(
+            currency=cl.Currency.pound_sterling, commitment=130000)
         return [
-            NT(activity, activity.sector_percentages[0]),
-            NT(activity, activity.sector_percentages[1])
+            NT(activity, activity.sector_percentages[0], totals),
+            NT(activity, activity.sector_percentages[1], totals)
         ]
 
     def test_column_list(self):
-        NT = namedtuple('ActivitySectorPercentage', 'Activity SectorPercentage')
+        NT = namedtuple('ActivitySectorPercentage', 'Activity SectorPercentage ActivityTotal')
         data = self.process([
             NT(
                 fac.ActivityFactory.build(iati_identifier=u"GB-1-123"),
-                fac.SectorPercentageFactory.build()
+                fac.SectorPercentageFactory.build(),
+                None
             )
         ])
         cols = [
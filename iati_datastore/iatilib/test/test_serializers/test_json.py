@@ -11,6 +11,7 @@ class FakePage(object):
         self.items = items
         self.offset = 0
         self.limit = 50
+        self.next_cursor = None
 
     @property
     def total(self):